@@ -0,0 +1,270 @@
+import asyncio
+import concurrent.futures as futures
+import json
+import os
+import time
+import urllib.parse as urlparse
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import aiohttp
+
+import utils
+from import_remote import DOWNLOAD_CONFIG, NETWORK_CONFIG, OUTPUT_CONFIG, imageHeaders, pageRequest, printInfo, \
+    printWarn, saveTags, tagRequest, writeFailLog
+
+PIXIV_URL = "https://www.pixiv.net"
+IMAGE_URL = "https://i.pximg.net"
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        """
+        Rate limit of one host: a request takes a token, tokens refill at `rate` per second
+        and at most `burst` of them are saved up.
+
+        Args:
+        - rate (float): Requests per second.
+        - burst (int): Requests that may be sent at once after an idle period.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        # the lock is held while waiting, so requests get their tokens in arrival order
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        # the host asked to slow down (429 / Retry-After), stop handing out tokens for a while
+        self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+
+class _Page:
+    def __init__(self, url: str, content: bytes):
+        # what the selectors of import_remote use of a requests.Response
+        self.url = url
+        self.content = content
+        self.status_code = 200
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class AsyncCrawler:
+    def __init__(self, crawler, config: dict = None, base_url: str = PIXIV_URL, image_base_url: str = IMAGE_URL):
+        """
+        Runs a BookmarkCrawler, UserCrawler or KeywordCrawler on asyncio instead of thread pools.
+
+        The stages are connected by queues: artwork ids from the listing pages are resolved to image
+        urls as soon as they arrive, and images are downloaded as soon as their urls are known, so that
+        downloads start before the listing is complete. Requests are limited to `crawler-concurrency`
+        at once in total and to `crawler-host-rate` per second per host by token buckets, instead of
+        sleeping before every request. Downloaded images are handed to the import pipeline of the
+        Downloader on `N_THREAD` threads, which wait while embedding is behind, so downloads slow down
+        to the speed of the embedding stages.
+
+        Args:
+        - crawler: BookmarkCrawler, UserCrawler or KeywordCrawler providing the listing requests and the Downloader.
+        - config (dict): Configuration dictionary, utils.get_config() if None.
+        - base_url (str): Replaces https://www.pixiv.net in request urls, e.g. a local test server.
+        - image_base_url (str): Replaces https://i.pximg.net in image urls.
+        """
+        self.crawler = crawler
+        self.downloader = crawler.downloader
+        config = utils.get_config() if config is None else config
+        self.concurrency = config.get('crawler-concurrency', 16)
+        self.host_rate = config.get('crawler-host-rate', 8.0)
+        self.host_burst = config.get('crawler-host-burst', 8)
+        self.queue_size = config.get('crawler-queue-size', 256)
+        self.base_urls = {PIXIV_URL: base_url.rstrip("/"), IMAGE_URL: image_base_url.rstrip("/")}
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.flow_size = .0
+        self.tags: Dict[str, List] = {}
+
+    def run(self) -> float:
+        """
+        Crawl and import the images, stopping once the downloader's capacity is used up.
+
+        Returns:
+        - float: Downloaded size in MB.
+        """
+        self.crawler.prepare()
+        self.downloader.open()
+        printInfo("===== async crawler start =====")
+        try:
+            asyncio.run(self.crawl())
+        finally:
+            if DOWNLOAD_CONFIG["WITH_TAG"]:
+                saveTags(self.tags)
+            self.downloader.close()
+        printInfo(f"total images: {len(self.downloader.url_group)}, flow {self.flow_size:.2f}MB")
+        return self.flow_size
+
+    async def crawl(self) -> None:
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.full = asyncio.Event()
+        self.seen_ids: Set[str] = set()
+        id_queue = asyncio.Queue(self.queue_size)
+        url_queue = asyncio.Queue(self.queue_size)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(sock_connect=4, sock_read=10)
+
+        with futures.ThreadPoolExecutor(DOWNLOAD_CONFIG["N_THREAD"]) as executor:
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                             headers=NETWORK_CONFIG["HEADER"]) as session:
+                listers = [self._list(session, args, id_queue) for args in self.crawler.listingRequests()]
+                resolvers = [self._resolve(session, id_queue, url_queue) for _ in range(self.concurrency)]
+                downloaders = [self._download(session, url_queue, executor) for _ in range(self.concurrency)]
+                stages = asyncio.gather(
+                    self._stage(listers, id_queue, len(resolvers)),
+                    self._stage(resolvers, url_queue, len(downloaders)),
+                    self._stage(downloaders, None, 0))
+                full = asyncio.ensure_future(self.full.wait())
+                done, _ = await asyncio.wait({stages, full}, return_when=asyncio.FIRST_COMPLETED)
+                # capacity reached: drop the queued work, images already handed over are imported by Downloader.close
+                stages.cancel()
+                full.cancel()
+                await asyncio.gather(stages, full, return_exceptions=True)
+                if stages in done:
+                    stages.result()
+
+    async def _stage(self, workers, next_queue: Optional[asyncio.Queue], n_next: int) -> None:
+        await asyncio.gather(*workers)
+        # one end marker per worker of the next stage
+        for _ in range(n_next):
+            await next_queue.put(None)
+
+    async def _list(self, session: aiohttp.ClientSession, args: Tuple[str, Callable, Dict],
+                    id_queue: asyncio.Queue) -> None:
+        url, selector, headers = args
+        page = await self.fetch(session, url, headers)
+        if page is None:
+            return
+        for illust_id in self.select(selector, page):
+            if illust_id not in self.seen_ids:
+                self.seen_ids.add(illust_id)
+                await id_queue.put(illust_id)
+
+    async def _resolve(self, session: aiohttp.ClientSession, id_queue: asyncio.Queue,
+                       url_queue: asyncio.Queue) -> None:
+        while (illust_id := await id_queue.get()) is not None:
+            if DOWNLOAD_CONFIG["WITH_TAG"]:
+                url, selector, headers = tagRequest(illust_id)
+                page = await self.fetch(session, url, headers)
+                if page is not None:
+                    self.tags[illust_id] = self.select(selector, page)
+
+            url, selector, headers = pageRequest(illust_id)
+            page = await self.fetch(session, url, headers)
+            if page is None:
+                continue
+            for image_url in self.select(selector, page):
+                if image_url not in self.downloader.url_group:
+                    self.downloader.add([image_url])
+                    await url_queue.put(image_url)
+
+    async def _download(self, session: aiohttp.ClientSession, url_queue: asyncio.Queue,
+                        executor: futures.Executor) -> None:
+        loop = asyncio.get_running_loop()
+        while (url := await url_queue.get()) is not None:
+            image_name = url[url.rfind("/") + 1:]
+            image_path = DOWNLOAD_CONFIG["STORE_PATH"] + image_name
+            if os.path.exists(image_path):
+                printWarn(OUTPUT_CONFIG["VERBOSE"], f"{image_path} exists")
+                continue
+            page = await self.fetch(session, url, imageHeaders(url))
+            if page is None:
+                continue
+            try:
+                image_size = await loop.run_in_executor(
+                    executor, self.downloader.saveImage, image_path, url, page.content)
+            except Exception as e:
+                printWarn(OUTPUT_CONFIG["PRINT_ERROR"], e)
+                writeFailLog(f"fail to import {image_name} \n")
+                continue
+            self.flow_size += image_size
+            if OUTPUT_CONFIG["VERBOSE"]:
+                printInfo(f"{image_name} complete / flow {self.flow_size:.2f}MB")
+            if self.flow_size > self.downloader.capacity:
+                self.full.set()
+                return
+
+    def select(self, selector: Callable, page: _Page) -> list:
+        try:
+            return list(selector(page))
+        except Exception as e:
+            printWarn(OUTPUT_CONFIG["PRINT_ERROR"], e)
+            writeFailLog(f"fail to collect {page.url} \n")
+            return []
+
+    def rebase(self, url: str) -> str:
+        for origin, base_url in self.base_urls.items():
+            if url.startswith(origin):
+                return base_url + url[len(origin):]
+        return url
+
+    def bucket(self, url: str) -> TokenBucket:
+        host = urlparse.urlsplit(url).netloc
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.host_rate, self.host_burst)
+        return self.buckets[host]
+
+    async def fetch(self, session: aiohttp.ClientSession, url: str, headers: Optional[Dict]) -> Optional[_Page]:
+        """
+        GET a url with retries, waiting for a token of its host and a free connection slot first.
+
+        Args:
+        - session (aiohttp.ClientSession): Session of the crawl.
+        - url (str): Pixiv url, rebased onto the configured base urls.
+        - headers (dict): Headers added to NETWORK_CONFIG["HEADER"], may be None.
+
+        Returns:
+        - _Page: Response passed to the selectors of import_remote, None if every attempt failed.
+        """
+        url = self.rebase(url)
+        scheme = urlparse.urlsplit(url).scheme
+        proxy = NETWORK_CONFIG["PROXY"].get(scheme)
+        if proxy is not None and "://" not in proxy:
+            proxy = "http://" + proxy
+        error_output = OUTPUT_CONFIG["PRINT_ERROR"]
+        bucket = self.bucket(url)
+
+        for i in range(DOWNLOAD_CONFIG["N_TIMES"]):
+            await bucket.acquire()
+            try:
+                async with self.semaphore:
+                    async with session.get(url, headers=headers, proxy=proxy) as response:
+                        if response.status == 200:
+                            content = await response.read()
+                            # delete incomplete image
+                            if response.content_length is None or len(content) == response.content_length \
+                                    or "Content-Encoding" in response.headers:
+                                return _Page(str(response.url), content)
+                            printWarn(error_output, f"incomplete response of {url}")
+                        else:
+                            printWarn(error_output, f"{url} returned {response.status}")
+                            retry_after = response.headers.get("Retry-After", "")
+                            if retry_after.isdigit():
+                                bucket.pause(float(retry_after))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                printWarn(error_output, e)
+                printWarn(error_output, f"This is {i} attempt to fetch {url}")
+            await asyncio.sleep(DOWNLOAD_CONFIG["BACKOFF"] * 2 ** i)
+
+        printWarn(error_output, f"fail to fetch {url}")
+        writeFailLog(f"fail to fetch {url} \n")
+        return None
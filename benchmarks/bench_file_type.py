@@ -0,0 +1,62 @@
+"""
+In-process magic-byte detection (utils.get_file_type) vs. forking `file --mime-type` per image.
+
+Run from the repository root, optionally with a folder of images (defaults to import-image-base):
+
+    python -m benchmarks.bench_file_type [folder]
+"""
+import os
+import subprocess
+import sys
+import time
+from glob import glob
+
+import utils
+
+MAX_FILES = 2000
+
+
+def get_file_type_subprocess(image_path: str) -> str:
+    # the previous implementation of utils.get_file_type
+    result = subprocess.run(["file", "--mime-type", "-b", image_path], capture_output=True, text=True,
+                            encoding='utf-8')
+    libmagic_output = result.stdout.strip()
+    if "png" in libmagic_output:
+        return "png"
+    if "jpeg" in libmagic_output:
+        return "jpg"
+    if "gif" in libmagic_output:
+        return "gif"
+    if "bmp" in libmagic_output:
+        return "bmp"
+    return None
+
+
+def time_per_file(func, filelist):
+    start = time.perf_counter()
+    results = [func(filename) for filename in filelist]
+    return results, (time.perf_counter() - start) / len(filelist)
+
+
+def main():
+    base_dir = sys.argv[1] if len(sys.argv) > 1 else utils.get_config()['import-image-base']
+    filelist = [f for f in glob(os.path.join(base_dir, '**/*'), recursive=True) if os.path.isfile(f)]
+    filelist = filelist[:MAX_FILES]
+    if len(filelist) == 0:
+        print(f"No files found in {base_dir}")
+        return
+
+    old_results, old_time = time_per_file(get_file_type_subprocess, filelist)
+    new_results, new_time = time_per_file(utils.get_file_type, filelist)
+
+    print(f"{len(filelist)} files")
+    print(f"file --mime-type : {old_time * 1e6:10.1f} us/file")
+    print(f"magic bytes      : {new_time * 1e6:10.1f} us/file ({old_time / new_time:.0f}x faster)")
+    for filename, old, new in zip(filelist, old_results, new_results):
+        # webp and tiff were not recognized before
+        if old != new and old is not None:
+            print(f"mismatch {filename}: {old} vs {new}")
+
+
+if __name__ == "__main__":
+    main()
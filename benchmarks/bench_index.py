@@ -0,0 +1,66 @@
+"""
+Latency and recall@k of the feature index backends on the local collection.
+
+Run from the repository root with MongoDB started:
+
+    python -m benchmarks.bench_index
+"""
+import time
+
+import numpy as np
+
+import utils
+from feature_index import FeatureIndex, IVFFeatureIndex
+
+N_QUERIES = 100
+TOPN = 20
+NPROBE_LIST = [1, 4, 16, 64]
+
+
+def run_queries(index: FeatureIndex, queries: np.ndarray):
+    results = []
+    start = time.perf_counter()
+    for query in queries:
+        filenames, _ = index.search(query, topn=TOPN)
+        results.append(filenames)
+    elapsed = (time.perf_counter() - start) / len(queries)
+    return results, elapsed
+
+
+def recall_at_k(exact_results, approx_results) -> float:
+    hits = sum(len(set(exact) & set(approx)) for exact, approx in zip(exact_results, approx_results))
+    return hits / sum(len(exact) for exact in exact_results)
+
+
+def main():
+    config = utils.get_config()
+    mongo_collection = utils.get_mongo_collection()
+
+    exact = FeatureIndex(mongo_collection, config)
+    exact.load()
+    print(f"{len(exact)} features loaded")
+    if len(exact) == 0:
+        return
+
+    rng = np.random.default_rng(0)
+    rows = rng.choice(np.flatnonzero(exact.store.live), min(N_QUERIES, len(exact)), replace=False)
+    noise = rng.standard_normal((len(rows), exact.feat_dim)).astype(np.float32) * 0.01
+    queries = exact._rows_float(rows) + noise
+
+    exact_results, elapsed = run_queries(exact, queries)
+    print(f"flat          : {elapsed * 1000:8.3f} ms/query, recall@{TOPN} = 1.000")
+
+    ivf = IVFFeatureIndex(mongo_collection, config)
+    ivf.load()
+    start = time.perf_counter()
+    ivf.train()
+    print(f"ivf training  : {time.perf_counter() - start:8.3f} s (nlist = {ivf.nlist})")
+    for nprobe in NPROBE_LIST:
+        ivf.nprobe = nprobe
+        approx_results, elapsed = run_queries(ivf, queries)
+        recall = recall_at_k(exact_results, approx_results)
+        print(f"ivf nprobe={nprobe:<3d}: {elapsed * 1000:8.3f} ms/query, recall@{TOPN} = {recall:.3f}")
+
+
+if __name__ == "__main__":
+    main()
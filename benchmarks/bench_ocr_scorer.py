@@ -0,0 +1,66 @@
+"""
+OCR re-ranking: `fuzz.partial_ratio` pair by pair (the previous search_ocr_text path) vs. OCRScorer.
+
+Scores synthetic OCR text that mixes CJK and latin words, with a share of images without text,
+and checks that both paths give identical scores. Run from the repository root:
+
+    python -m benchmarks.bench_ocr_scorer
+"""
+import random
+import time
+
+from fuzzywuzzy import fuzz
+
+from ocr_scorer import OCRScorer
+
+SIZES = [10_000, 100_000]
+QUERIES = ["原神", "genshin impact", "今日の天気", "hello wrold"]
+EMPTY_RATIO = 0.3
+
+_CJK = [chr(code) for code in range(0x4e00, 0x4e00 + 2000)]
+_LATIN = ["genshin", "impact", "hello", "world", "pixiv", "anime", "art", "the", "and", "of", "2024"]
+
+
+def make_texts(n: int, rng: random.Random) -> list:
+    texts = []
+    for _ in range(n):
+        if rng.random() < EMPTY_RATIO:
+            texts.append("")
+            continue
+        words = []
+        for _ in range(rng.randint(1, 12)):
+            if rng.random() < 0.5:
+                words.append("".join(rng.choices(_CJK, k=rng.randint(1, 6))))
+            else:
+                words.append(rng.choice(_LATIN))
+        texts.append(" ".join(words))
+    return texts
+
+
+def main():
+    rng = random.Random(0)
+    scorer = OCRScorer({'ocr-score-parallel-min': 0})
+    scorer.start()
+    print(f"{scorer.n_workers} workers")
+    print(f"{'texts':>8} {'pairwise':>10} {'scorer':>10} {'speedup':>8}")
+    for size in SIZES:
+        texts = make_texts(size, rng)
+
+        t_old, t_new = .0, .0
+        for query in QUERIES:
+            start = time.perf_counter()
+            expected = [fuzz.partial_ratio(query, text) for text in texts]
+            t_old += time.perf_counter() - start
+
+            start = time.perf_counter()
+            scores = scorer.score(query, texts)
+            t_new += time.perf_counter() - start
+            assert scores == expected, f"scores differ for {query!r}"
+
+        t_old, t_new = t_old / len(QUERIES), t_new / len(QUERIES)
+        print(f"{size:>8} {t_old * 1e3:>8.1f}ms {t_new * 1e3:>8.1f}ms {t_old / t_new:>7.1f}x")
+    scorer.close()
+
+
+if __name__ == "__main__":
+    main()
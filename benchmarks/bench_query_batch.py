@@ -0,0 +1,48 @@
+"""
+Throughput of scoring concurrent queries one by one versus together with FeatureIndex.search_batch,
+on synthetic features.
+
+Run from the repository root (MongoDB is not needed):
+
+    python -m benchmarks.bench_query_batch
+"""
+import tempfile
+import time
+
+import numpy as np
+
+from feature_index import FeatureIndex
+
+SIZE = 300_000
+FEAT_DIM = 512
+BATCH_SIZES = [1, 8, 32]
+N_QUERIES = 64
+TOPN = 20
+
+
+class _Collection:
+    # the index only needs a name until it is loaded from MongoDB
+    name = "bench_query_batch"
+
+
+def main():
+    rng = np.random.default_rng(0)
+    features = rng.standard_normal((SIZE, FEAT_DIM), dtype=np.float32)
+    queries = rng.standard_normal((N_QUERIES, FEAT_DIM), dtype=np.float32)
+    print(f"{'type':>8} {'batch':>6} {'per query':>12}")
+    for storage_type in ["float32", "int8"]:
+        config = {'clip-model': 'ViT-B/32', 'storage-type': storage_type, 'index-path': tempfile.mkdtemp()}
+        index = FeatureIndex(_Collection(), config)
+        index.clear()
+        index.add([str(i) for i in range(SIZE)], features)
+        for batch_size in BATCH_SIZES:
+            start = time.perf_counter()
+            for batch_start in range(0, N_QUERIES, batch_size):
+                index.search_batch(queries[batch_start:batch_start + batch_size], topn=TOPN)
+            elapsed = (time.perf_counter() - start) / N_QUERIES
+            print(f"{storage_type:>8} {batch_size:>6} {elapsed * 1000:>10.2f}ms")
+        index.clear()
+
+
+if __name__ == "__main__":
+    main()
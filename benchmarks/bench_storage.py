@@ -0,0 +1,65 @@
+"""
+Memory, latency and recall@k of the storage types of the flat feature index, on synthetic features.
+
+Run from the repository root (MongoDB is not needed):
+
+    python -m benchmarks.bench_storage
+"""
+import tempfile
+import time
+
+import numpy as np
+
+from feature_index import STORAGE_TYPES, FeatureIndex
+
+SIZES = [100_000, 300_000]
+FEAT_DIM = 512
+N_CLUSTERS = 1000
+N_QUERIES = 50
+TOPN = 20
+
+
+class _Collection:
+    # the index only needs a name until it is loaded from MongoDB
+    name = "bench_storage"
+
+
+def make_features(n: int, rng: np.random.Generator) -> np.ndarray:
+    # clustered like CLIP features, so that neighbours are close and ranking errors show up
+    centers = rng.standard_normal((N_CLUSTERS, FEAT_DIM), dtype=np.float32)
+    features = centers[rng.integers(N_CLUSTERS, size=n)]
+    features += 0.5 * rng.standard_normal((n, FEAT_DIM), dtype=np.float32)
+    return features
+
+
+def main():
+    rng = np.random.default_rng(0)
+    index_dir = tempfile.mkdtemp()
+    print(f"{'rows':>8} {'type':>8} {'memory':>10} {'latency':>12} {'recall@' + str(TOPN):>10}")
+    for size in SIZES:
+        features = make_features(size, rng)
+        filenames = [str(i) for i in range(size)]
+        queries = features[rng.choice(size, N_QUERIES, replace=False)]
+        queries += 0.1 * rng.standard_normal(queries.shape, dtype=np.float32)
+
+        exact_results = None
+        for storage_type in STORAGE_TYPES:
+            config = {'clip-model': 'ViT-B/32', 'storage-type': storage_type, 'index-path': index_dir}
+            index = FeatureIndex(_Collection(), config)
+            index.clear()
+            index.add(filenames, features)
+
+            start = time.perf_counter()
+            results = [set(index.search(query, topn=TOPN)[0]) for query in queries]
+            elapsed = (time.perf_counter() - start) / N_QUERIES
+            if exact_results is None:
+                exact_results = results
+            recall = sum(len(a & b) for a, b in zip(exact_results, results)) / (TOPN * N_QUERIES)
+
+            memory = index.store.features.nbytes + (index.store.scales.nbytes if storage_type == "int8" else 0)
+            print(f"{size:>8} {storage_type:>8} {memory / 2 ** 20:>8.0f}MB {elapsed * 1000:>10.2f}ms {recall:>10.3f}")
+            index.clear()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+"""
+Full sort vs. partial selection (utils.top_k) for picking the best results out of a score vector.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_topk
+"""
+import timeit
+
+import numpy as np
+
+import utils
+
+TOPN = 20
+SIZES = [10_000, 100_000, 1_000_000]
+REPEAT = 20
+
+
+def full_sort(scores: np.ndarray, k: int) -> np.ndarray:
+    return np.argsort(scores)[::-1][:k]
+
+
+def main():
+    rng = np.random.default_rng(0)
+    print(f"{'rows':>10} {'argsort':>12} {'top_k':>12} {'speedup':>8}")
+    for size in SIZES:
+        scores = rng.random(size, dtype=np.float32)
+        assert np.array_equal(np.sort(full_sort(scores, TOPN)), np.sort(utils.top_k(scores, TOPN)))
+
+        t_sort = min(timeit.repeat(lambda: full_sort(scores, TOPN), number=1, repeat=REPEAT))
+        t_topk = min(timeit.repeat(lambda: utils.top_k(scores, TOPN), number=1, repeat=REPEAT))
+        print(f"{size:>10} {t_sort * 1000:>9.3f} ms {t_topk * 1000:>9.3f} ms {t_sort / t_topk:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
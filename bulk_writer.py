@@ -0,0 +1,143 @@
+import time
+from threading import Condition, Thread
+from typing import Callable, Iterable, List, Optional
+
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+class BulkWriter:
+    def __init__(self, mongo_collection: Collection, on_written: Optional[Callable[[List[dict]], None]] = None,
+                 batch_size: int = 64, flush_interval: float = 1.0, stats=None, exclude_fields: Iterable[str] = ()):
+        """
+        Buffer documents and insert them with unordered `insert_many` calls.
+
+        A batch is flushed when it reaches `batch_size` documents or when its oldest document
+        has waited `flush_interval` seconds. Documents rejected by the unique `filename` index
+        are skipped instead of failing the batch.
+
+        Args:
+        - mongo_collection (Collection): MongoDB collection to insert into.
+        - on_written (Callable): Called from the flushing thread with the documents that were inserted.
+        - batch_size (int): Number of documents per insert.
+        - flush_interval (float): Maximum time in seconds a document stays buffered.
+        - stats: Optional counter with a `record(n_items, seconds)` method, fed with each insert.
+        - exclude_fields (Iterable[str]): Fields left out of the inserted documents, `on_written` still gets them.
+        """
+        self.mongo_collection = mongo_collection
+        self.on_written = on_written
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats = stats
+        self.exclude_fields = frozenset(exclude_fields)
+
+        self.buffer: List[dict] = []
+        self.first_added = None
+        self.closed = False
+        # first exception of on_written, raised by close() so the flusher keeps writing until then
+        self.callback_error: Optional[Exception] = None
+        self.condition = Condition()
+        self.flusher = Thread(target=self._flush_worker, daemon=True)
+        self.flusher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add(self, document: dict) -> None:
+        """
+        Queue a document for insertion, flushing the buffer if it is full.
+
+        Args:
+        - document (dict): MongoDB document.
+        """
+        with self.condition:
+            if len(self.buffer) == 0:
+                self.first_added = time.monotonic()
+                self.condition.notify()
+            self.buffer.append(document)
+            if len(self.buffer) < self.batch_size:
+                return
+            documents = self._take()
+        self._write(documents)
+
+    def flush(self) -> None:
+        """
+        Insert all buffered documents now.
+        """
+        with self.condition:
+            documents = self._take()
+        self._write(documents)
+
+    def close(self) -> None:
+        """
+        Flush the remaining documents and stop the background flusher.
+
+        Raises the first exception of `on_written`, if any.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.flusher.join()
+        self.flush()
+        if self.callback_error is not None:
+            raise self.callback_error
+
+    def _take(self) -> List[dict]:
+        documents, self.buffer = self.buffer, []
+        return documents
+
+    def _flush_worker(self):
+        while True:
+            with self.condition:
+                while not self.closed and len(self.buffer) == 0:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                timeout = self.first_added + self.flush_interval - time.monotonic()
+                if timeout > 0:
+                    self.condition.wait(timeout)
+                    continue
+                documents = self._take()
+            self._write(documents)
+
+    def _stripped(self, documents: List[dict]) -> List[dict]:
+        if len(self.exclude_fields) == 0:
+            return documents
+        return [{key: value for key, value in document.items() if key not in self.exclude_fields}
+                for document in documents]
+
+    def _write(self, documents: List[dict]) -> None:
+        if len(documents) == 0:
+            return
+        start = time.perf_counter()
+        try:
+            self.mongo_collection.insert_many(self._stripped(documents), ordered=False)
+            written = documents
+        except BulkWriteError as e:
+            failed = set()
+            for error in e.details["writeErrors"]:
+                failed.add(error["index"])
+                if error["code"] == DUPLICATE_KEY_ERROR:
+                    print("Skipping duplicate:", documents[error["index"]]["filename"])
+                else:
+                    print(f"Error writing {documents[error['index']]['filename']}: {error['errmsg']}")
+            written = [document for i, document in enumerate(documents) if i not in failed]
+        except Exception as e:
+            print(f"Error writing batch of {len(documents)} documents: {e}")
+            return
+
+        if self.stats is not None:
+            self.stats.record(len(written), time.perf_counter() - start)
+        if self.on_written is not None and len(written) > 0:
+            try:
+                self.on_written(written)
+            except Exception as e:
+                print(f"Error handling batch of {len(written)} written documents: {e}")
+                with self.condition:
+                    if self.callback_error is None:
+                        self.callback_error = e
@@ -1,5 +1,9 @@
+import atexit
+import os
 import time
 from functools import lru_cache
+from typing import List
+import numpy as np
 from PIL import Image
 import torch
 import clip
@@ -19,6 +23,12 @@ class CLIPModel:
         else:
             self.device = self.config.get('device', 'cuda' if torch.cuda.is_available() else 'cpu')
         self.model, self.preprocess = self.get_model()
+        self.batch_size = self.config.get('clip-batch-size', 32)
+        self.text_cache = utils.LRUCache(self.config.get('text-cache-size', 1024))
+        self.text_cache_path = self.config.get('text-cache-path')
+        if self.text_cache_path:
+            self.load_text_cache()
+            atexit.register(self.save_text_cache)
 
     def get_model(self):
         """
@@ -32,41 +42,139 @@ class CLIPModel:
             args['download_root'] = self.config['clip-model-download']
         return clip.load(self.config['clip-model'], device=self.device, **args)
 
-    def get_image_feature(self, image_path):
+    def load_image(self, image_path):
         """
-        Get the image feature vector.
+        Load and preprocess an image for the image encoder.
 
         Args:
             image_path (str): Path to the image.
 
         Returns:
-            tuple: Containing the image feature vector and image size, or None if the image failed to load.
+            tuple: Containing the preprocessed image tensor and image size, or None if the image failed to load.
         """
         try:
             image = Image.open(image_path)
             image_size = image.size
-            image = self.preprocess(image).unsqueeze(0).to(self.device)
+            image = self.preprocess(image)
         except:
             return None, None  # Failed to load image
+        return image, image_size
 
+    def encode_images(self, images: List[torch.Tensor]) -> np.ndarray:
+        """
+        Encode preprocessed images in a single forward pass.
+
+        Args:
+            images (List[torch.Tensor]): Preprocessed image tensors.
+
+        Returns:
+            numpy.ndarray: Image feature vectors, one row per image.
+        """
         with torch.no_grad():
-            feat = self.model.encode_image(image)
-            feat = feat.detach().cpu().numpy()
-        return feat, image_size
+            feat = self.model.encode_image(torch.stack(images).to(self.device))
+        return feat.detach().cpu().numpy()
+
+    def get_image_features(self, image_paths: List[str], batch_size: int = None):
+        """
+        Get the feature vectors of many images, encoding them in batches.
+        Images that fail to load are skipped without affecting the rest of their batch.
+
+        Args:
+            image_paths (List[str]): Paths to the images.
+            batch_size (int): Number of images per forward pass, defaults to `clip-batch-size`.
+
+        Returns:
+            tuple: Containing the stacked feature vectors, the image sizes and the paths of
+            the images that were loaded, all in the same order.
+        """
+        batch_size = batch_size or self.batch_size
+        feature_list, image_sizes, loaded_paths = [], [], []
+        for start in range(0, len(image_paths), batch_size):
+            images = []
+            for image_path in image_paths[start:start + batch_size]:
+                image, image_size = self.load_image(image_path)
+                if image is None:
+                    continue
+                images.append(image)
+                image_sizes.append(image_size)
+                loaded_paths.append(image_path)
+            if len(images) > 0:
+                feature_list.append(self.encode_images(images))
+
+        if len(feature_list) == 0:
+            return np.empty((0, utils.get_feature_size(self.config['clip-model']))), [], []
+        return np.concatenate(feature_list, axis=0), image_sizes, loaded_paths
 
     def get_text_feature(self, text: str):
         """
-        Get the text feature vector.
+        Get the text feature vector. Repeated prompts are served from an LRU cache.
 
         Args:
             text (str): Input text.
 
         Returns:
-            numpy.ndarray: Text feature vector.
+            numpy.ndarray: Text feature vector (read-only).
         """
-        text = clip.tokenize([text]).to(self.device)
-        feat = self.model.encode_text(text)
-        return feat.detach().cpu().numpy()
+        return self.get_text_features([text])
+
+    def get_text_features(self, texts: List[str]):
+        """
+        Get the feature vectors of several texts, encoding the ones missing from the cache in a single forward pass.
+
+        Args:
+            texts (List[str]): Input texts.
+
+        Returns:
+            numpy.ndarray: Text feature vectors, one row per text (read-only).
+        """
+        feats = [self.text_cache.get(text) for text in texts]
+        missing = list(dict.fromkeys(text for text, feat in zip(texts, feats) if feat is None))
+        if len(missing) > 0:
+            tokens = clip.tokenize(missing).to(self.device)
+            with torch.no_grad():
+                encoded = dict(zip(missing, self.model.encode_text(tokens).cpu().numpy()))
+            for text in missing:
+                feat = encoded[text][np.newaxis]
+                feat.setflags(write=False)
+                self.text_cache.put(text, feat)
+                # the read-only row put in the cache, not another view of the writable batch
+                encoded[text] = feat
+            feats = [encoded[text] if feat is None else feat for text, feat in zip(texts, feats)]
+        if len(feats) == 1:
+            return feats[0]
+        feats = np.concatenate(feats, axis=0)
+        feats.setflags(write=False)
+        return feats
+
+    def load_text_cache(self):
+        """
+        Fill the text feature cache from `text-cache-path`, if it was saved with the same model.
+        """
+        if not os.path.exists(self.text_cache_path):
+            return
+        try:
+            with np.load(self.text_cache_path) as saved:
+                if str(saved["model"]) != self.config['clip-model']:
+                    return
+                for text, feat in zip(saved["texts"].tolist(), saved["features"]):
+                    feat = feat[np.newaxis]
+                    feat.setflags(write=False)
+                    self.text_cache.put(text, feat)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Failed to load text cache {self.text_cache_path}: {e}")
+
+    def save_text_cache(self):
+        """
+        Save the text feature cache to `text-cache-path`, so that warm starts skip the text encoder.
+        """
+        items = list(self.text_cache.items())
+        if len(items) == 0:
+            return
+        os.makedirs(os.path.dirname(self.text_cache_path) or ".", exist_ok=True)
+        utils.atomic_write(self.text_cache_path, lambda f: np.savez(
+            f, model=np.array(self.config['clip-model']), texts=np.array([text for text, _ in items], dtype=str),
+            features=np.concatenate([feat for _, feat in items], axis=0)))
+        print(f"[INFO]: saved text cache, {self.text_cache}")
 
 @lru_cache(maxsize=1)
 def get_model() -> CLIPModel:
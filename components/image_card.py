@@ -7,13 +7,24 @@ from import_remote import getImageResponseContent
 
 
 class ImageCard(ImageLabel):
-    def __init__(self, imagePath, parent=None, isRemote=False):
+    def __init__(self, imagePath=None, parent=None, isRemote=False):
         super().__init__(parent)
         self.imagePath = imagePath
         self.isRemote = isRemote
-        self.image = QImage(imagePath) if not isRemote else getImageResponseContent(imagePath)
         self.setBorderRadius(8, 8, 8, 8)
 
+    def setImagePath(self, imagePath, thumbnail=None):
+        self.imagePath = imagePath
+        self.setThumbnail(thumbnail)
+
+    def setThumbnail(self, thumbnail):
+        # only a downscaled image is displayed, copy and save load the original
+        self.image = thumbnail if thumbnail is not None else QImage()
+        self.update()
+
+    def loadImage(self):
+        return QImage(self.imagePath) if not self.isRemote else getImageResponseContent(self.imagePath)
+
     def mousePressEvent(self, event):
         view = CommandBarView(self)
         view.addAction(Action(FluentIcon.COPY, self.tr('Copy'), triggered=self.copyImage))
@@ -26,7 +37,7 @@ class ImageCard(ImageLabel):
 
     def copyImage(self):
         if self.isRemote:
-            pixmap = QPixmap.fromImage(self.image)
+            pixmap = QPixmap.fromImage(self.loadImage())
         else:
             pixmap = QPixmap(self.imagePath)
         if pixmap.isNull():
@@ -46,7 +57,7 @@ class ImageCard(ImageLabel):
 
     def saveImage(self):
         savePath, _ = QFileDialog.getSaveFileName(self, self.tr("Save Image"), "", "Image Files (*.png *.jpg *.bmp)")
-        if savePath and not self.image.save(savePath):
+        if savePath and not self.loadImage().save(savePath):
             InfoBar.error(
                 title=self.tr("Error"),
                 content=self.tr("Failed to save the image."),
@@ -1,12 +1,21 @@
-from PyQt5.QtCore import QEasingCurve
-from qfluentwidgets import SingleDirectionScrollArea, SmoothMode, SimpleCardWidget, FlowLayout, isDarkTheme
+from PyQt5.QtCore import QThreadPool
+from PyQt5.QtGui import QImage
+from qfluentwidgets import SingleDirectionScrollArea, SmoothMode, SimpleCardWidget, isDarkTheme
 
 import utils
 from components.image_card import ImageCard
+from components.thumbnail_loader import ThumbnailLoader, ThumbnailSignals
 from config import cfg
 
 
 class ImageGallery(SingleDirectionScrollArea):
+    cardSize = 162
+    margin = 30
+    horizontalSpacing = 10
+    verticalSpacing = 20
+    # rows of cards kept above and below the viewport, so that short scrolls show ready thumbnails
+    overscanRows = 2
+
     def __init__(self, isRemote=False):
         super().__init__()
         self.isRemote = isRemote
@@ -16,33 +25,105 @@ class ImageGallery(SingleDirectionScrollArea):
         self.setWidgetResizable(True)
         cfg.themeChanged.connect(self.__setQss)
 
-        # image flow
-        self.imageFlow = FlowLayout(self.imageContainer, needAni=False)
-        self.imageFlow.setAnimation(250, QEasingCurve.OutQuad)
-        self.imageFlow.setContentsMargins(30, 30, 30, 30)
-        self.imageFlow.setVerticalSpacing(20)
-        self.imageFlow.setHorizontalSpacing(10)
+        # only the cards in view exist, they are reused for other images while scrolling
+        self.imagePaths = []
+        self.md5s = {}
+        self.visibleCards = {}
+        self.freeCards = []
+
+        config = utils.get_config()
+        self.thumbnails = utils.LRUCache(config.get('thumbnail-cache-size', 512))
+        self.threadPool = QThreadPool(self)
+        self.threadPool.setMaxThreadCount(config.get('thumbnail-workers', 4))
+        self.thumbnailSignals = ThumbnailSignals(self)
+        self.thumbnailSignals.loaded.connect(self.onThumbnailLoaded)
+        self.pendingLoaders = {}
+
+        self.verticalScrollBar().valueChanged.connect(self.layoutCards)
         self.updateGallery()
 
         self.__setQss()
 
     def updateGallery(self, filename=None):
-        # clear all images
-        self.imageFlow.removeAllWidgets()
-
+        mongo_collection = utils.get_mongo_collection(isRemote=self.isRemote)
         if filename is None:
-            cursor = utils.get_mongo_collection(isRemote=self.isRemote).find({}, {"filename": 1})
-            image_paths = [obj["filename"] for obj in cursor]
-            for imagePath in image_paths:
-                self.addImageCard(imagePath)
+            cursor = mongo_collection.find({}, {"filename": 1, "md5": 1})
         else:
-            for imagePath in filename:
-                self.addImageCard(imagePath)
+            cursor = mongo_collection.find({"filename": {"$in": list(filename)}}, {"filename": 1, "md5": 1})
+        # thumbnails are stored by content hash
+        self.md5s = {obj["filename"]: obj.get("md5") for obj in cursor}
+        self.imagePaths = list(self.md5s) if filename is None else list(filename)
+
+        for card in self.visibleCards.values():
+            card.hide()
+            self.freeCards.append(card)
+        self.visibleCards = {}
+        self.verticalScrollBar().setValue(0)
+        self.layoutCards()
+
+    def resizeEvent(self, e):
+        super().resizeEvent(e)
+        self.layoutCards()
+
+    def columnCount(self):
+        width = self.viewport().width() - 2 * self.margin + self.horizontalSpacing
+        return max(1, width // (self.cardSize + self.horizontalSpacing))
+
+    def layoutCards(self):
+        columns = self.columnCount()
+        rowHeight = self.cardSize + self.verticalSpacing
+        rows = -(-len(self.imagePaths) // columns)
+        self.imageContainer.setMinimumHeight(2 * self.margin + max(0, rows * rowHeight - self.verticalSpacing))
+
+        top = self.verticalScrollBar().value() - self.margin
+        firstRow = max(0, top // rowHeight - self.overscanRows)
+        lastRow = min(rows - 1, (top + self.viewport().height()) // rowHeight + self.overscanRows)
+        visible = range(firstRow * columns, min(len(self.imagePaths), (lastRow + 1) * columns))
+
+        for index in [index for index in self.visibleCards if index not in visible]:
+            card = self.visibleCards.pop(index)
+            card.hide()
+            self.freeCards.append(card)
+
+        for index in visible:
+            card = self.visibleCards.get(index)
+            if card is None or card.imagePath != self.imagePaths[index]:
+                card = card or self.createCard()
+                self.visibleCards[index] = card
+                self.showImage(card, self.imagePaths[index])
+            row, column = divmod(index, columns)
+            card.move(self.margin + column * (self.cardSize + self.horizontalSpacing), self.margin + row * rowHeight)
+            card.show()
+        self.cancelLoaders({self.imagePaths[index] for index in visible})
+
+    def createCard(self):
+        if self.freeCards:
+            return self.freeCards.pop()
+        card = ImageCard(parent=self.imageContainer, isRemote=self.isRemote)
+        card.setFixedSize(self.cardSize, self.cardSize)
+        return card
+
+    def showImage(self, card, imagePath):
+        thumbnail = self.thumbnails.get(imagePath)
+        card.setImagePath(imagePath, thumbnail)
+        if thumbnail is None and imagePath not in self.pendingLoaders:
+            size = int(self.cardSize * self.devicePixelRatioF())
+            loader = ThumbnailLoader(imagePath, self.md5s.get(imagePath), size, self.isRemote, self.thumbnailSignals)
+            self.pendingLoaders[imagePath] = loader
+            self.threadPool.start(loader)
+
+    def cancelLoaders(self, wanted):
+        # drop queued decodes of images scrolled out of view, running ones finish and are cached
+        for imagePath in [imagePath for imagePath in self.pendingLoaders if imagePath not in wanted]:
+            if self.threadPool.tryTake(self.pendingLoaders[imagePath]):
+                del self.pendingLoaders[imagePath]
 
-    def addImageCard(self, imagePath):
-        imageCard = ImageCard(imagePath, isRemote=self.isRemote)
-        imageCard.setFixedSize(162, 162)
-        self.imageFlow.addWidget(imageCard)
+    def onThumbnailLoaded(self, imagePath, thumbnail: QImage):
+        self.pendingLoaders.pop(imagePath, None)
+        self.thumbnails.put(imagePath, thumbnail)
+        for card in self.visibleCards.values():
+            if card.imagePath == imagePath:
+                card.setThumbnail(thumbnail)
 
     def __setQss(self):
         self.imageContainer.setObjectName('imageContainer')
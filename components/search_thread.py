@@ -0,0 +1,90 @@
+from threading import Condition
+
+from PyQt5.QtCore import QThread, pyqtSignal
+from PyQt5.QtWidgets import QApplication
+
+from search_services import SearchService
+
+
+class SearchThread(QThread):
+    # generation of the search, filenames of the current top-k
+    resultsUpdated = pyqtSignal(int, list)
+    searchFinished = pyqtSignal(int)
+    searchFailed = pyqtSignal(int, str)
+
+    def __init__(self, search_service: SearchService, parent=None):
+        """
+        Runs the searches of a page off the GUI thread, one at a time.
+
+        Every search gets a new generation number. A newer search supersedes the running one, which
+        stops at its next chunk, and only the latest queued search is run. Results are emitted each
+        time the top-k is refined, so the gallery fills before the whole index is scored.
+
+        Args:
+        - search_service (SearchService): Search service of the page.
+        - parent (QObject): Parent object.
+        """
+        super().__init__(parent)
+        self.search_service = search_service
+        self.generation = 0
+        self.pending = None
+        self.stopped = False
+        self.condition = Condition()
+        QApplication.instance().aboutToQuit.connect(self.stop)
+
+    def search(self, kind: str, query, topn: int = 20) -> int:
+        """
+        Start a search, superseding the running one.
+
+        Args:
+        - kind (str): "prompt", "image", "fusion" or "ocr", see SearchService.search_progressive.
+        - query: Query of the search.
+        - topn (int): Number of results.
+
+        Returns:
+        - int: Generation of the search, passed along with its signals.
+        """
+        with self.condition:
+            self.generation += 1
+            self.pending = (self.generation, kind, query, topn)
+            self.condition.notify()
+            return self.generation
+
+    def cancel(self) -> None:
+        with self.condition:
+            self.generation += 1
+            self.pending = None
+
+    def stop(self) -> None:
+        with self.condition:
+            self.stopped = True
+            self.generation += 1
+            self.condition.notify()
+        self.wait()
+
+    def isCurrent(self, generation: int) -> bool:
+        return generation == self.generation
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and self.pending is None:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                (generation, kind, query, topn), self.pending = self.pending, None
+
+            last_filenames = None
+            try:
+                for filenames, _ in self.search_service.search_progressive(kind, query, topn):
+                    if not self.isCurrent(generation):
+                        break
+                    # rebuilding the gallery is the expensive part, skip chunks that changed nothing
+                    if filenames != last_filenames:
+                        self.resultsUpdated.emit(generation, filenames)
+                        last_filenames = filenames
+                else:
+                    self.searchFinished.emit(generation)
+            except Exception as e:
+                print(f"Search failed: {e}")
+                self.searchFailed.emit(generation, str(e))
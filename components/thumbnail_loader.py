@@ -0,0 +1,79 @@
+from PyQt5.QtCore import QBuffer, QObject, QRunnable, QSize, Qt, pyqtSignal
+from PyQt5.QtGui import QImage, QImageReader
+
+from import_remote import getImageResponseBytes
+from thumbnail_cache import get_thumbnail_cache
+
+
+def loadThumbnail(imagePath: str, size: int, isRemote: bool = False, md5: str = None) -> QImage:
+    """
+    Decode an image downscaled to cover a square of the given size.
+
+    The thumbnail written at import time is used if there is one. Local images imported before
+    thumbnails existed get one now, otherwise JPEG files and downloads are decoded at reduced resolution
+    directly, instead of decoding the full image and scaling it afterwards.
+
+    Args:
+    - imagePath (str): Path of a local image, or URL of a remote one.
+    - size (int): Edge length in pixels of the square the thumbnail covers.
+    - isRemote (bool): Whether imagePath is a URL.
+    - md5 (str): MD5 hash of the image file, None if unknown.
+
+    Returns:
+    - QImage: Thumbnail, null if the image cannot be read.
+    """
+    target = QSize(size, size)
+    thumbnailCache = get_thumbnail_cache()
+    thumbnailPath = thumbnailCache.get(md5)
+    if thumbnailPath is None and md5 is not None and not isRemote:
+        thumbnailPath = thumbnailCache.ensure(md5, imagePath)
+    if thumbnailPath is not None:
+        reader = QImageReader(thumbnailPath)
+    elif isRemote:
+        # the cache keeps the compressed download, decode it at reduced resolution as well
+        buffer = QBuffer()
+        buffer.setData(getImageResponseBytes(imagePath))
+        reader = QImageReader(buffer)
+    else:
+        reader = QImageReader(imagePath)
+    reader.setAutoTransform(True)
+    original = reader.size()
+    if original.isValid() and (original.width() > size or original.height() > size):
+        reader.setScaledSize(original.scaled(target, Qt.KeepAspectRatioByExpanding))
+    return reader.read()
+
+
+class ThumbnailSignals(QObject):
+    # image path, thumbnail
+    loaded = pyqtSignal(str, QImage)
+
+
+class ThumbnailLoader(QRunnable):
+    def __init__(self, imagePath: str, md5: str, size: int, isRemote: bool, signals: ThumbnailSignals):
+        """
+        Decodes one thumbnail on a QThreadPool and reports it through `signals.loaded`,
+        which is delivered on the thread owning `signals`.
+
+        Args:
+        - imagePath (str): Path of a local image, or URL of a remote one.
+        - md5 (str): MD5 hash of the image file, None if unknown.
+        - size (int): Edge length in pixels of the square the thumbnail covers.
+        - isRemote (bool): Whether imagePath is a URL.
+        - signals (ThumbnailSignals): Signals to report the thumbnail with.
+        """
+        super().__init__()
+        # kept alive by the gallery until its result arrives, so that it can be taken back from the queue
+        self.setAutoDelete(False)
+        self.imagePath = imagePath
+        self.md5 = md5
+        self.size = size
+        self.isRemote = isRemote
+        self.signals = signals
+
+    def run(self):
+        try:
+            image = loadThumbnail(self.imagePath, self.size, self.isRemote, self.md5)
+        except Exception as e:
+            print(f"Error loading thumbnail of {self.imagePath}: {e}")
+            image = QImage()
+        self.signals.loaded.emit(self.imagePath, image)
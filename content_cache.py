@@ -0,0 +1,103 @@
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+import numpy as np
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
+
+import utils
+
+
+class ContentCache:
+    def __init__(self, hash_collection: Collection, config: dict):
+        """
+        Features and OCR text of imported images keyed by the MD5 hash of the file content,
+        so copies of an image in other folders or collections are not encoded and OCR'd again.
+
+        Entries are only reused with the CLIP model and storage type they were computed with.
+        An entry without `ocr_text` was stored while OCR was disabled.
+
+        Args:
+        - hash_collection (Collection): MongoDB collection holding one entry per hash.
+        - config (dict): Configuration dictionary.
+        """
+        self.hash_collection = hash_collection
+        self.model = config['clip-model']
+        self.dtype = config['storage-type']
+
+    def get(self, md5: str) -> Optional[dict]:
+        """
+        Look up the cached results of an image.
+
+        Args:
+        - md5 (str): MD5 hash of the image file.
+
+        Returns:
+        - dict: `feature` (np.ndarray), `width`, `height`, `feature_scale` for int8 features and, if OCR was run,
+          `ocr_text`. None if not cached.
+        """
+        entry = self.hash_collection.find_one({"_id": md5, "model": self.model, "dtype": self.dtype})
+        if entry is None:
+            return None
+        entry["feature"] = np.frombuffer(entry["feature"], dtype=self.dtype)
+        return entry
+
+    def get_many(self, md5s: List[str]) -> Dict[str, dict]:
+        """
+        Look up the cached results of several images at once.
+
+        Args:
+        - md5s (List[str]): MD5 hashes of the image files.
+
+        Returns:
+        - dict: MD5 hash -> cached results as returned by get, for the hashes that are cached.
+        """
+        entries = {}
+        for entry in self.hash_collection.find({"_id": {"$in": md5s}, "model": self.model, "dtype": self.dtype}):
+            entry["feature"] = np.frombuffer(entry["feature"], dtype=self.dtype)
+            entries[entry["_id"]] = entry
+        return entries
+
+    def add_documents(self, documents: List[dict], with_ocr: bool) -> None:
+        """
+        Store the results of freshly imported images. Documents without `md5` are ignored.
+
+        Args:
+        - documents (List[dict]): Image documents as built by make_document.
+        - with_ocr (bool): Whether OCR was run, i.e. whether `ocr_text` is meaningful.
+        """
+        requests = []
+        for document in documents:
+            if document.get("md5") is None:
+                continue
+            entry = {
+                "model": self.model,
+                "dtype": self.dtype,
+                "feature": document["feature"],
+                "width": document["width"],
+                "height": document["height"],
+            }
+            if "feature_scale" in document:
+                entry["feature_scale"] = document["feature_scale"]
+            if with_ocr:
+                entry["ocr_text"] = document["ocr_text"]
+            requests.append(UpdateOne({"_id": document["md5"]}, {"$set": entry}, upsert=True))
+        if len(requests) == 0:
+            return
+        try:
+            self.hash_collection.bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            # concurrent upserts of the same hash, the entry is stored either way
+            print(f"Error caching {len(e.details['writeErrors'])} image hashes")
+
+
+@lru_cache(maxsize=1)
+def get_content_cache() -> ContentCache:
+    """
+    Get the shared content cache, using LRU cache.
+
+    Returns:
+    - ContentCache: ContentCache instance.
+    """
+    return ContentCache(utils.get_hash_collection(), utils.get_config())
@@ -0,0 +1,669 @@
+import argparse
+import os
+from threading import Lock
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+from pymongo.collection import Collection
+
+import content_cache
+import utils
+from feature_store import FeatureStore
+
+
+def normalize_features(features: np.ndarray) -> np.ndarray:
+    """
+    L2-normalize feature vectors row by row.
+
+    Args:
+    - features (np.ndarray): Feature matrix of shape (n, d).
+
+    Returns:
+    - np.ndarray: Contiguous float32 matrix with unit-length rows.
+    """
+    features = np.asarray(features, dtype=np.float32)
+    features = features.reshape(-1, features.shape[-1])
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return np.ascontiguousarray(features / norms)
+
+
+STORAGE_TYPES = ("float32", "float16", "int8")
+
+
+def mongo_excluded_fields(config: dict) -> Tuple[str, ...]:
+    """
+    Fields of the image documents that are kept in the feature store only, unless `mongo-store-features` is set.
+
+    Args:
+    - config (dict): Configuration dictionary.
+
+    Returns:
+    - tuple: Names of the fields to leave out of MongoDB.
+    """
+    if config.get('mongo-store-features', False):
+        return ()
+    return ("feature", "feature_scale")
+
+
+def encode_features(features: np.ndarray, storage_type: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Normalize feature vectors and convert them to the storage type.
+
+    int8 is scalar quantization with one scale per vector: the largest component maps to 127,
+    so that `codes * scale` approximates the normalized vector.
+
+    Args:
+    - features (np.ndarray): Raw features of shape (n, d).
+    - storage_type (str): One of STORAGE_TYPES.
+
+    Returns:
+    - tuple: Codes of shape (n, d) in the storage type, and the float32 scales of shape (n,) for int8 or None.
+    """
+    features = normalize_features(features)
+    if storage_type == "int8":
+        scales = np.abs(features).max(axis=1) / 127
+        scales[scales == 0] = 1
+        codes = np.round(features / scales[:, np.newaxis]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    return features.astype(storage_type), None
+
+
+class FeatureIndex:
+    _LOAD_BATCH_SIZE = 8192
+    _SCORE_CHUNK_SIZE = 4096
+
+    def __init__(self, mongo_collection: Collection, config: dict):
+        """
+        Pre-normalized CLIP feature matrix of a MongoDB collection, searched exhaustively.
+
+        The features live in a memory-mapped FeatureStore next to the MongoDB data, which is kept
+        in sync by the importers, so that startup does not scan the collection and a query is a
+        single matrix-vector product. Deleted rows are masked until the store is compacted.
+        Subclasses may restrict the rows that are scored for a query.
+
+        Rows are kept in `storage-type`. float16 and int8 rows are scored chunk by chunk, and int8
+        scores are the dot products of the codes multiplied by the row scales, without dequantizing.
+
+        Args:
+        - mongo_collection (Collection): MongoDB collection holding the image documents.
+        - config (dict): Configuration dictionary.
+        """
+        self.mongo_collection = mongo_collection
+        self.config = config
+        self.feat_dim = utils.get_feature_size(config['clip-model'])
+        self.storage_type = config['storage-type']
+        assert self.storage_type in STORAGE_TYPES, f"storage-type must be one of {STORAGE_TYPES}"
+        self.compact_ratio = config.get('index-compact-ratio', 0.25)
+        self.progressive_chunk_size = config.get('search-chunk-size', 65536)
+        self.store_path = os.path.join(config.get('index-path', './mongo_sample/index'), mongo_collection.name)
+        self.index_path = self.store_path + ".npz"
+        self.lock = Lock()
+        self.loaded = False
+        self._clear()
+
+    def __len__(self):
+        return len(self.store)
+
+    @property
+    def _size(self) -> int:
+        return self.store.n_rows
+
+    def clear(self) -> None:
+        """
+        Drop all features and the saved files, e.g. after the collection has been dropped.
+        """
+        with self.lock:
+            self.store.delete_files()
+            if os.path.exists(self.index_path):
+                os.remove(self.index_path)
+            self._clear()
+            self.loaded = True
+
+    def _clear(self) -> None:
+        self.store = FeatureStore(self.store_path, self.feat_dim, self.storage_type)
+
+    def load(self) -> None:
+        """
+        Map the feature store if it matches the collection, otherwise rebuild it from MongoDB.
+        """
+        with self.lock:
+            self._load()
+
+    def refresh(self) -> None:
+        """
+        Map the feature store again if another process changed it, for processes that only search it
+        such as server.py. Unsaved changes of this process would be lost.
+        """
+        self.ensure_loaded()
+        if self.store.changed():
+            with self.lock:
+                if self.store.changed():
+                    self._load()
+
+    def rebuild(self) -> None:
+        """
+        Rebuild the feature store from MongoDB, e.g. after documents were written by another program.
+        """
+        with self.lock:
+            self._clear()
+            self._load_mongo()
+            self._on_loaded()
+            self.loaded = True
+            self._save_arrays()
+
+    def ensure_loaded(self) -> None:
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded:
+                    self._load()
+
+    def _load(self) -> None:
+        self._clear()
+        if not self._load_saved():
+            self._load_mongo()
+        self._on_loaded()
+        self.loaded = True
+
+    def save(self) -> None:
+        """
+        Fold the logged changes into the saved rows, compacting the store once more than `index-compact-ratio`
+        of its rows are deleted.
+        """
+        with self.lock:
+            if not self.loaded:
+                return
+            if self._size > 0 and 1 - len(self.store) / self._size > self.compact_ratio:
+                self._compact()
+            self.store.flush()
+            self._save_arrays()
+
+    def compact(self) -> None:
+        """
+        Rewrite the feature store without the deleted rows.
+        """
+        self.ensure_loaded()
+        with self.lock:
+            self._compact()
+            self._save_arrays()
+
+    def add(self, filenames: List[str], features: np.ndarray) -> None:
+        """
+        Add features to the index. Existing filenames are replaced.
+
+        Args:
+        - filenames (List[str]): Filenames of the images.
+        - features (np.ndarray): Raw (unnormalized) features of shape (len(filenames), d).
+        """
+        if len(filenames) == 0:
+            return
+        codes, scales = encode_features(features, self.storage_type)
+        self.ensure_loaded()
+        with self.lock:
+            self._add(filenames, codes, scales)
+
+    def add_documents(self, documents: List[dict]) -> None:
+        """
+        Add the features of freshly inserted MongoDB documents to the index.
+
+        Args:
+        - documents (List[dict]): Documents with `filename`, `feature` and, for int8, `feature_scale` fields.
+        """
+        if len(documents) == 0:
+            return
+        codes, scales = self._decode(documents)
+        self.ensure_loaded()
+        with self.lock:
+            self._add([document["filename"] for document in documents], codes, scales)
+
+    def remove(self, filenames: List[str]) -> None:
+        """
+        Remove features from the index. Unknown filenames are ignored.
+
+        Args:
+        - filenames (List[str]): Filenames of the images to remove.
+        """
+        self.ensure_loaded()
+        with self.lock:
+            self._on_removed(np.array(self.store.delete(filenames), dtype=np.int64))
+
+    def rename(self, renamed: List[Tuple[str, str]]) -> None:
+        """
+        Rename entries of the index, e.g. after files were moved. Unknown filenames are ignored.
+
+        Args:
+        - renamed (List[Tuple[str, str]]): Pairs of old and new filenames.
+        """
+        self.ensure_loaded()
+        with self.lock:
+            self.store.rename(renamed)
+
+    def search(self, query_feature: np.ndarray, topn: int = 20) -> Tuple[List[str], List[float]]:
+        """
+        Find the features with the highest cosine similarity to the query.
+
+        Args:
+        - query_feature (np.ndarray): Query feature of shape (1, d) or (d,).
+        - topn (int): Number of results to return.
+
+        Returns:
+        - tuple: List of filenames and list of similarity scores, best match first.
+        """
+        return self.search_batch(query_feature, topn)[0]
+
+    def search_batch(self, query_features: np.ndarray, topn: int = 20) -> List[Tuple[List[str], List[float]]]:
+        """
+        Search several queries at once, scoring them together with one matrix-matrix product
+        instead of one pass over the features per query.
+
+        Args:
+        - query_features (np.ndarray): Query features of shape (n, d).
+        - topn (int): Number of results to return per query.
+
+        Returns:
+        - list: For every query, the list of filenames and list of similarity scores, best match first.
+        """
+        self.ensure_loaded()
+        query_features = normalize_features(query_features)
+        with self.lock:
+            if len(self.store) == 0:
+                return [([], []) for _ in range(len(query_features))]
+            results = []
+            for rows, sim_score in self._search_rows_batch(query_features, topn):
+                # fewer live rows than topn leaves masked ones in the result
+                found = self.store.live[rows]
+                results.append(([self.store.filenames[row] for row in rows[found]],
+                                [float(score) for score in sim_score[found]]))
+        return results
+
+    def search_progressive(self, query_feature: np.ndarray, topn: int = 20) -> Iterator[Tuple[List[str], List[float]]]:
+        """
+        Score the features `search-chunk-size` rows at a time, yielding the top-k of the rows scored so far
+        after every chunk. The lock is released between chunks, and a caller whose query was superseded
+        simply stops iterating.
+
+        Args:
+        - query_feature (np.ndarray): Query feature of shape (1, d) or (d,).
+        - topn (int): Number of results to return.
+
+        Returns:
+        - Iterator: Lists of filenames and of similarity scores, best match first; the last one is the result of search.
+        """
+        self.ensure_loaded()
+        query_feature = normalize_features(query_feature)[0]
+        best = {}
+        start = 0
+        while True:
+            with self.lock:
+                stop = min(start + self.progressive_chunk_size, self._size)
+                if start >= stop:
+                    break
+                rows, sim_score = self._search_rows_range(query_feature, start, stop, topn)
+                # rows are only stable under the lock, remember filenames
+                found = self.store.live[rows]
+                chunk = zip([self.store.filenames[row] for row in rows[found]], sim_score[found].tolist())
+            # keyed by filename, a compaction between two chunks may score a row twice
+            best.update(chunk)
+            best = dict(sorted(best.items(), key=lambda item: item[1], reverse=True)[:topn])
+            start = stop
+            yield list(best.keys()), list(best.values())
+        if start == 0:
+            yield [], []
+
+    def _search_rows_range(self, query_feature: np.ndarray, start: int, stop: int,
+                           topn: int) -> Tuple[np.ndarray, np.ndarray]:
+        features, scales = self.store.features, self.store.scales
+        if features.dtype == np.float32:
+            sim_score = features[start:stop] @ query_feature
+        else:
+            sim_score = np.empty(stop - start, dtype=np.float32)
+            buffer = np.empty((self._SCORE_CHUNK_SIZE, self.feat_dim), dtype=np.float32)
+            for chunk_start in range(start, stop, self._SCORE_CHUNK_SIZE):
+                chunk_stop = min(chunk_start + self._SCORE_CHUNK_SIZE, stop)
+                sim_score[chunk_start - start:chunk_stop - start] = self._score(
+                    features[chunk_start:chunk_stop], scales[chunk_start:chunk_stop],
+                    query_feature, buffer[:chunk_stop - chunk_start])
+        sim_score[~self.store.live[start:stop]] = -np.inf
+        top_n_idx = utils.top_k(sim_score, topn)
+        return top_n_idx + start, sim_score[top_n_idx]
+
+    def _search_rows(self, query_feature: np.ndarray, topn: int) -> Tuple[np.ndarray, np.ndarray]:
+        return self._search_rows_batch(query_feature[np.newaxis], topn)[0]
+
+    def _search_rows_batch(self, query_features: np.ndarray, topn: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        features, scales = self.store.features, self.store.scales
+        queries = query_features.T
+        if features.dtype == np.float32:
+            sim_score = features @ queries
+        else:
+            sim_score = np.empty((self._size, len(query_features)), dtype=np.float32)
+            # a small reused buffer stays in cache, unlike casting the whole matrix
+            buffer = np.empty((self._SCORE_CHUNK_SIZE, self.feat_dim), dtype=np.float32)
+            for start in range(0, self._size, self._SCORE_CHUNK_SIZE):
+                stop = min(start + self._SCORE_CHUNK_SIZE, self._size)
+                sim_score[start:stop] = self._score(features[start:stop], scales[start:stop],
+                                                    queries, buffer[:stop - start])
+        if len(self.store) < self._size:
+            sim_score[~self.store.live] = -np.inf
+        # one contiguous row of scores per query
+        sim_score = np.ascontiguousarray(sim_score.T)
+        results = []
+        for query_score in sim_score:
+            top_n_idx = utils.top_k(query_score, topn)
+            results.append((top_n_idx, query_score[top_n_idx]))
+        return results
+
+    def _score(self, codes: np.ndarray, scales: np.ndarray, queries: np.ndarray,
+               buffer: Optional[np.ndarray] = None) -> np.ndarray:
+        # BLAS has no float16 or int8 GEMM, cast a chunk at a time
+        if buffer is None:
+            buffer = codes.astype(np.float32)
+        else:
+            np.copyto(buffer, codes)
+        sim_score = buffer @ queries
+        if self.storage_type == "int8":
+            sim_score *= scales if sim_score.ndim == 1 else scales[:, np.newaxis]
+        return sim_score
+
+    def _rows_float(self, rows: np.ndarray) -> np.ndarray:
+        # approximate normalized features, e.g. for clustering
+        return self.store.read_float(rows)
+
+    def _load_saved(self) -> bool:
+        # the importers update the store along with MongoDB and log every change of its rows, so the store is
+        # trusted as saved; a live document count would differ whenever MongoDB changed before loading
+        if not self.store.open():
+            return False
+        if len(self.store) > 0 and self.mongo_collection.estimated_document_count() == 0:
+            print(f"Feature store {self.store_path} belongs to a dropped collection, rebuilding it from MongoDB")
+            return False
+
+        if os.path.exists(self.index_path):
+            try:
+                with np.load(self.index_path) as saved:
+                    arrays = {key: saved[key] for key in saved.files}
+            except (OSError, ValueError) as e:
+                print(f"Failed to load index {self.index_path}: {e}")
+                arrays = {}
+            # rows logged since the arrays were saved are added to them
+            if "generation" in arrays and arrays["generation"].item() == self.store.generation \
+                    and arrays["n_rows"] <= self._size:
+                self._restore_arrays(arrays)
+                self._on_rows_added(np.arange(int(arrays["n_rows"]), self._size))
+        return True
+
+    def _load_mongo(self) -> None:
+        # documents stored without features (see `mongo-store-features`) keep the rows of the previous store,
+        # converted if `storage-type` changed, or take the feature cached for their content
+        previous = FeatureStore.open_saved(self.store_path, self.feat_dim)
+        if previous is None:
+            previous = FeatureStore(self.store_path, self.feat_dim, self.storage_type)
+            if previous.exists():
+                # e.g. written for another model, kept rather than replaced by a store without its rows
+                print(f"Cannot read feature store {self.store_path}, moving it to {self.store_path}.unreadable")
+                previous.move_files(self.store_path + ".unreadable")
+        rebuilt = FeatureStore(self.store_path + ".rebuild", self.feat_dim, self.storage_type)
+        rebuilt.create()
+
+        def add_batch(documents):
+            with_feature = [document for document in documents if "feature" in document]
+            if len(with_feature) > 0:
+                rebuilt.append([document["filename"] for document in with_feature], *self._decode(with_feature))
+            without_feature = [document for document in documents if "feature" not in document]
+            rows = [previous.row_of[document["filename"]] for document in without_feature
+                    if document["filename"] in previous.row_of]
+            if len(rows) > 0:
+                if previous.dtype == rebuilt.dtype:
+                    codes, scales = previous.features[rows], previous.scales[rows]
+                else:
+                    codes, scales = encode_features(previous.read_float(rows), self.storage_type)
+                rebuilt.append([previous.filenames[row] for row in rows], codes, scales)
+            missing = [document for document in without_feature
+                       if document["filename"] not in previous.row_of and document.get("md5") is not None]
+            cached = {} if len(missing) == 0 else \
+                content_cache.get_content_cache().get_many([document["md5"] for document in missing])
+            missing = [document for document in missing if document["md5"] in cached]
+            if len(missing) > 0:
+                entries = [cached[document["md5"]] for document in missing]
+                scales = None if self.storage_type != "int8" else \
+                    np.array([entry.get("feature_scale", 1) for entry in entries], dtype=np.float32)
+                rebuilt.append([document["filename"] for document in missing],
+                               np.stack([entry["feature"] for entry in entries]), scales)
+
+        cursor = self.mongo_collection.find({}, {"_id": 0, "filename": 1, "md5": 1, "feature": 1, "feature_scale": 1})
+        documents = []
+        for doc in cursor:
+            documents.append(doc)
+            if len(documents) >= self._LOAD_BATCH_SIZE:
+                add_batch(documents)
+                documents = []
+        add_batch(documents)
+
+        previous._reset()
+        self.store.replace_with(rebuilt)
+        n_missing = self.mongo_collection.estimated_document_count() - len(self.store)
+        if n_missing > 0:
+            print(f"{n_missing} documents have no features, re-import them")
+        self._on_rows_added(np.arange(self._size))
+
+    def _decode(self, documents: List[dict]) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        codes = np.frombuffer(b"".join(document["feature"] for document in documents), dtype=self.storage_type)
+        codes = codes.reshape(len(documents), self.feat_dim)
+        if self.storage_type == "int8":
+            return codes, np.array([document["feature_scale"] for document in documents], dtype=np.float32)
+        # documents imported before features were normalized at import
+        return normalize_features(codes).astype(self.storage_type), None
+
+    def _add(self, filenames: List[str], codes: np.ndarray, scales: Optional[np.ndarray] = None) -> None:
+        rows = self.store.append(filenames, codes, scales)
+        self._on_rows_added(rows)
+
+    def _compact(self) -> None:
+        keep = self.store.compact()
+        self._on_compacted(keep)
+
+    def _save_arrays(self) -> None:
+        arrays = self._saved_arrays()
+        if len(arrays) == 0:
+            # e.g. the features of an index saved before the feature store existed
+            if os.path.exists(self.index_path):
+                os.remove(self.index_path)
+            return
+        utils.atomic_write(self.index_path, lambda f: np.savez(
+            f, n_rows=np.array(self._size), generation=np.array(self.store.generation), **arrays))
+
+    # hooks for subclasses that keep per-row state next to the feature store
+    def _on_loaded(self) -> None:
+        pass
+
+    def _on_rows_added(self, rows: np.ndarray) -> None:
+        pass
+
+    def _on_removed(self, rows: np.ndarray) -> None:
+        pass
+
+    def _on_compacted(self, keep: np.ndarray) -> None:
+        pass
+
+    def _saved_arrays(self) -> dict:
+        return {}
+
+    def _restore_arrays(self, arrays: dict) -> None:
+        pass
+
+
+class IVFFeatureIndex(FeatureIndex):
+    _MIN_POINTS_PER_LIST = 39
+    _TRAIN_POINTS_PER_LIST = 64
+    _TRAIN_ITERATIONS = 10
+
+    def __init__(self, mongo_collection: Collection, config: dict):
+        """
+        Inverted-file (IVF-flat) index: rows are clustered around k-means centroids and a query
+        only scores the rows of the `index-nprobe` closest clusters out of `index-nlist`.
+
+        Raising `index-nprobe` trades latency for recall@k. Collections too small to train
+        `index-nlist` clusters are searched exhaustively.
+
+        Args:
+        - mongo_collection (Collection): MongoDB collection holding the image documents.
+        - config (dict): Configuration dictionary.
+        """
+        self.nlist = config.get('index-nlist', 1024)
+        self.nprobe = config.get('index-nprobe', 32)
+        super().__init__(mongo_collection, config)
+
+    def _clear(self) -> None:
+        super()._clear()
+        self._centroids = None
+        self._assign = np.zeros(0, dtype=np.int32)
+        self._lists = None
+
+    def train(self) -> None:
+        """
+        Run spherical k-means on a sample of the features and assign every row to its closest centroid.
+        Does nothing if there are too few features for `index-nlist` clusters.
+        """
+        self.ensure_loaded()
+        with self.lock:
+            if self._trainable():
+                self._train()
+
+    def _train(self) -> None:
+        rng = np.random.default_rng(0)
+        live_rows = np.flatnonzero(self.store.live)
+        n_sample = min(len(live_rows), self.nlist * self._TRAIN_POINTS_PER_LIST)
+        sample = self._rows_float(np.sort(rng.choice(live_rows, n_sample, replace=False)))
+        centroids = sample[rng.choice(n_sample, self.nlist, replace=False)].copy()
+        for _ in range(self._TRAIN_ITERATIONS):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            # re-seed empty clusters with random samples
+            empty = np.bincount(assign, minlength=self.nlist) == 0
+            sums[empty] = sample[rng.choice(n_sample, int(empty.sum()), replace=False)]
+            centroids = normalize_features(sums)
+
+        self._centroids = centroids
+        self._on_rows_added(np.arange(self._size))
+
+    def _trainable(self) -> bool:
+        return len(self) >= self.nlist * self._MIN_POINTS_PER_LIST
+
+    def _on_loaded(self) -> None:
+        if self._centroids is None and self._trainable():
+            self._train()
+
+    def _on_rows_added(self, rows: np.ndarray) -> None:
+        if len(self._assign) < self._size:
+            assign = np.zeros(self._size, dtype=np.int32)
+            assign[:len(self._assign)] = self._assign
+            self._assign = assign
+        if self._centroids is None or len(rows) == 0:
+            return
+        for start in range(0, len(rows), self._LOAD_BATCH_SIZE):
+            batch = rows[start:start + self._LOAD_BATCH_SIZE]
+            self._assign[batch] = np.argmax(self._rows_float(batch) @ self._centroids.T, axis=1)
+        self._lists = None
+
+    def _on_removed(self, rows: np.ndarray) -> None:
+        # the lists only hold live rows, deleted ones would take the top-k slots of live ones
+        if len(rows) > 0:
+            self._lists = None
+
+    def _on_compacted(self, keep: np.ndarray) -> None:
+        self._assign = self._assign[keep]
+        self._lists = None
+
+    def _build_lists(self) -> None:
+        # deleted rows are left out of the lists
+        live_rows = np.flatnonzero(self.store.live)
+        order = live_rows[np.argsort(self._assign[live_rows], kind="stable")]
+        offsets = np.searchsorted(self._assign[order], np.arange(self.nlist + 1))
+        self._lists = (order, offsets)
+
+    def search_progressive(self, query_feature: np.ndarray, topn: int = 20) -> Iterator[Tuple[List[str], List[float]]]:
+        self.ensure_loaded()
+        if self._centroids is None and not self._trainable():
+            yield from super().search_progressive(query_feature, topn)
+        else:
+            # probing a few lists is fast enough to answer at once
+            yield self.search(query_feature, topn)
+
+    def _search_rows_batch(self, query_features: np.ndarray, topn: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        if self._centroids is None and not self._trainable():
+            return super()._search_rows_batch(query_features, topn)
+        # each query scores a different set of lists, a shared product would score them all
+        return [self._search_rows(query_feature, topn) for query_feature in query_features]
+
+    def _search_rows(self, query_feature: np.ndarray, topn: int) -> Tuple[np.ndarray, np.ndarray]:
+        if self._centroids is None:
+            if not self._trainable():
+                return super()._search_rows(query_feature, topn)
+            self._train()
+        if self._lists is None:
+            self._build_lists()
+
+        order, offsets = self._lists
+        probe = utils.top_k(self._centroids @ query_feature, self.nprobe)
+        candidates = np.sort(np.concatenate([order[offsets[l]:offsets[l + 1]] for l in probe]))
+        sim_score = self._score(self.store.features[candidates], self.store.scales[candidates], query_feature)
+        top_n_idx = utils.top_k(sim_score, topn)
+        return candidates[top_n_idx], sim_score[top_n_idx]
+
+    def _saved_arrays(self) -> dict:
+        arrays = super()._saved_arrays()
+        if self._centroids is not None:
+            arrays["centroids"] = self._centroids
+            arrays["assign"] = self._assign[:self._size]
+        return arrays
+
+    def _restore_arrays(self, arrays: dict) -> None:
+        if "centroids" in arrays and arrays["centroids"].shape[0] == self.nlist:
+            self._centroids = arrays["centroids"]
+            self._assign = arrays["assign"].astype(np.int32)
+
+
+INDEX_TYPES = {
+    "flat": FeatureIndex,
+    "ivf": IVFFeatureIndex,
+}
+
+
+@utils.cache_per_collection
+def get_feature_index(isRemote=False) -> FeatureIndex:
+    """
+    Get the shared feature index of the local or remote collection, using LRU cache.
+    The backend is selected by `index-type` in the configuration.
+
+    Returns:
+    - FeatureIndex: FeatureIndex instance.
+    """
+    config = utils.get_config()
+    index_type = INDEX_TYPES[config.get('index-type', 'flat')]
+    return index_type(utils.get_mongo_collection(isRemote), config)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the feature store of an image collection.")
+    parser.add_argument("command", choices=["compact", "migrate", "rebuild"],
+                        help="compact: drop deleted rows, migrate: move the features out of MongoDB, "
+                             "rebuild: rebuild the feature store from MongoDB")
+    parser.add_argument("--remote", action="store_true", help="use the remote (pixiv) collection")
+    args = parser.parse_args()
+
+    index = get_feature_index(isRemote=args.remote)
+    if args.command == "rebuild":
+        index.rebuild()
+    elif args.command == "compact":
+        index.load()
+        index.compact()
+    else:
+        index.load()
+        index.save()
+        n_documents = index.mongo_collection.estimated_document_count()
+        if len(index) < n_documents:
+            print(f"Only {len(index)} of {n_documents} documents have features, keeping them in MongoDB")
+        elif len(mongo_excluded_fields(index.config)) > 0:
+            index.mongo_collection.update_many({}, {"$unset": {"feature": "", "feature_scale": ""}})
+    print(f"[INFO]: {len(index)} features in {index.store.features_path}")
@@ -0,0 +1,367 @@
+import os
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import utils
+
+
+class FeatureStore:
+    _COPY_BATCH_SIZE = 65536
+
+    def __init__(self, path: str, feat_dim: int, dtype: str):
+        """
+        Append-only feature file with a fixed stride, memory-mapped for reading.
+
+        `{path}.features` holds the rows back to back in `dtype`, `{path}.scales` one float32 scale
+        per row, and `{path}.rows.npz` the filename of every row as of the last flush(). Appends,
+        deletions and renames since are logged to `{path}.rows.log` as they happen, appends right
+        after the rows are written, so that they survive a crash and are replayed by open().
+        Deleted rows stay in the file as tombstones until compact() rewrites it.
+
+        As the files are mapped instead of read, opening the store is nearly free and the pages
+        are shared through the OS page cache by every process that maps them. Files are never
+        shortened in place while they may be mapped: readers map only the rows they know of, the
+        writer overwrites ignored rows when it appends, and rewrites replace the files.
+
+        Args:
+        - path (str): Path prefix of the store files.
+        - feat_dim (int): Dimension of the feature vectors.
+        - dtype (str): Storage type of the feature vectors.
+        """
+        self.path = path
+        self.feat_dim = feat_dim
+        self.dtype = np.dtype(dtype)
+        self.features_path = path + ".features"
+        self.scales_path = path + ".scales"
+        self.rows_path = path + ".rows.npz"
+        self.log_path = path + ".rows.log"
+        self.opened_stamp = None
+        # identifies the files written by create(), a log only extends the rows of its own generation
+        self.generation = ""
+        self._reset()
+
+    def __len__(self):
+        return len(self.row_of)
+
+    @property
+    def n_rows(self) -> int:
+        """
+        Number of rows in the file, including deleted ones.
+        """
+        return len(self.filenames)
+
+    def _reset(self) -> None:
+        self.filenames: List[Optional[str]] = []
+        self.row_of: Dict[str, int] = {}
+        self.live = np.empty(0, dtype=bool)
+        self.features = np.empty((0, self.feat_dim), dtype=self.dtype)
+        self.scales = np.empty(0, dtype=np.float32)
+        # end of the last complete record of the log, 0 if there is no valid log
+        self.log_end = 0
+
+    def open(self) -> bool:
+        """
+        Map the store files.
+
+        Returns:
+        - bool: False if the store does not exist or was written with another dimension or storage type.
+        """
+        self._reset()
+        # taken before reading, a change while reading shows up as changed() later
+        self.opened_stamp = self._stamp()
+        if not all(os.path.exists(path) for path in [self.features_path, self.scales_path, self.rows_path]):
+            return False
+        try:
+            with np.load(self.rows_path) as saved:
+                if saved["dtype"].item() != self.dtype.name or saved["feat_dim"].item() != self.feat_dim:
+                    return False
+                names = bytes(saved["filenames"]).decode("utf-8")
+                generation = saved["generation"].item() if "generation" in saved.files else ""
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Failed to load feature store {self.rows_path}: {e}")
+            return False
+
+        filenames = names.split("\0") if len(names) > 0 else []
+        n_rows = len(filenames)
+        n_stored = min(os.path.getsize(self.features_path) // self.row_bytes, os.path.getsize(self.scales_path) // 4)
+        if n_stored < n_rows:
+            print(f"Feature store {self.features_path} is truncated")
+            return False
+        self.generation = generation
+        for kind, row, filename in self._read_log():
+            if kind == "A" and row == len(filenames) and row < n_stored:
+                filenames.append(filename)
+            elif kind in "DR" and row < len(filenames):
+                filenames[row] = filename
+            elif row >= len(filenames):
+                # rows whose features are incomplete, and the changes logged after them
+                break
+            # else an append flushed since it was logged, a crash between flush and removing the log
+
+        self.filenames = []
+        for filename in filenames:
+            filename = filename or None
+            if filename is not None and filename in self.row_of:
+                # replaced by a logged row
+                self.filenames[self.row_of[filename]] = None
+            if filename is not None:
+                self.row_of[filename] = len(self.filenames)
+            self.filenames.append(filename)
+        self.live = np.array([filename is not None for filename in self.filenames], dtype=bool)
+        self._map()
+        return True
+
+    @classmethod
+    def open_saved(cls, path: str, feat_dim: int) -> Optional["FeatureStore"]:
+        """
+        Map a store with the storage type it was written with, e.g. to convert it to another one.
+
+        Args:
+        - path (str): Path prefix of the store files.
+        - feat_dim (int): Dimension of the feature vectors.
+
+        Returns:
+        - FeatureStore: The opened store, None if it does not exist or cannot be read.
+        """
+        try:
+            with np.load(path + ".rows.npz") as saved:
+                dtype = saved["dtype"].item()
+        except (OSError, ValueError, KeyError):
+            return None
+        store = cls(path, feat_dim, dtype)
+        return store if store.open() else None
+
+    def exists(self) -> bool:
+        return any(os.path.exists(path) for path in [self.features_path, self.scales_path, self.rows_path])
+
+    def read_float(self, rows: np.ndarray) -> np.ndarray:
+        """
+        Read rows as float32 vectors, the int8 codes multiplied by their scales.
+
+        Args:
+        - rows (np.ndarray): Row numbers.
+
+        Returns:
+        - np.ndarray: Features of shape (len(rows), d).
+        """
+        features = self.features[rows].astype(np.float32)
+        if self.dtype == np.int8:
+            features *= self.scales[rows, np.newaxis]
+        return features
+
+    def _read_log(self) -> List[Tuple[str, int, str]]:
+        try:
+            with open(self.log_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return []
+        records = data.split(b"\0")
+        if records[0].decode("utf-8", errors="replace") != f"G{self.generation}":
+            return []
+        # the last record is empty, or incomplete after a crash and overwritten by the next append
+        self.log_end = len(data) - len(records[-1])
+        changes = []
+        for record in records[1:-1]:
+            record = record.decode("utf-8")
+            row, _, filename = record[1:].partition("\t")
+            if not row.isdigit():
+                break
+            changes.append((record[0], int(row), filename))
+        return changes
+
+    def changed(self) -> bool:
+        """
+        Whether the rows were flushed or appended to since open(), e.g. by another process.
+        """
+        return self._stamp() != self.opened_stamp
+
+    def _stamp(self) -> tuple:
+        stamp = []
+        for path in [self.rows_path, self.log_path]:
+            try:
+                stat = os.stat(path)
+                stamp.append((stat.st_mtime_ns, stat.st_size, stat.st_ino))
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    @property
+    def row_bytes(self) -> int:
+        return self.feat_dim * self.dtype.itemsize
+
+    def create(self) -> None:
+        """
+        Start an empty store, replacing existing files.
+        """
+        # new files rather than truncating the old ones, which other processes may have mapped
+        self.delete_files()
+        self.generation = uuid.uuid4().hex
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        for path in [self.features_path, self.scales_path]:
+            open(path, "wb").close()
+        self.flush()
+
+    def move_files(self, path: str) -> None:
+        """
+        Move the store files to another path prefix, replacing the files there.
+
+        Args:
+        - path (str): New path prefix.
+        """
+        self._reset()
+        for old_path in [self.features_path, self.scales_path, self.rows_path, self.log_path]:
+            if os.path.exists(old_path):
+                os.replace(old_path, path + old_path[len(self.path):])
+
+    def delete_files(self) -> None:
+        self._reset()
+        for path in [self.features_path, self.scales_path, self.rows_path, self.log_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def flush(self) -> None:
+        """
+        Write the filenames of the rows, making the rows appended since the last flush permanent.
+        """
+        names = "\0".join(filename or "" for filename in self.filenames).encode("utf-8")
+        utils.atomic_write(self.rows_path, lambda f: np.savez(
+            f, filenames=np.frombuffer(names, dtype=np.uint8), dtype=np.array(self.dtype.name),
+            feat_dim=np.array(self.feat_dim), generation=np.array(self.generation)))
+        # the logged rows are in the map now, a log left by a crash right here is skipped by open
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+        self.log_end = 0
+
+    def append(self, filenames: List[str], codes: np.ndarray, scales: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Append rows to the end of the store. Rows of filenames that are already stored become tombstones.
+
+        Args:
+        - filenames (List[str]): Filenames of the rows.
+        - codes (np.ndarray): Encoded features of shape (len(filenames), d).
+        - scales (np.ndarray): Scales of the rows, 1 if None.
+
+        Returns:
+        - np.ndarray: Row numbers of the appended rows.
+        """
+        codes = np.ascontiguousarray(codes, dtype=self.dtype).reshape(len(filenames), self.feat_dim)
+        if self.n_rows == 0:
+            # leftovers of an unflushed or deleted store
+            self.create()
+        if scales is None:
+            scales = np.ones(len(filenames), dtype=np.float32)
+        # rows appended after the last flush by a crashed writer are overwritten
+        utils.write_at(self.features_path, self.n_rows * self.row_bytes, codes.tobytes())
+        utils.write_at(self.scales_path, self.n_rows * 4, np.ascontiguousarray(scales, dtype=np.float32).tobytes())
+
+        rows = np.arange(self.n_rows, self.n_rows + len(filenames))
+        # replaced rows are not logged as deleted, open() turns them into tombstones again
+        self._log([f"A{row}\t{filename}" for filename, row in zip(filenames, rows)])
+        self.live = np.concatenate([self.live, np.ones(len(filenames), dtype=bool)])
+        for filename, row in zip(filenames, rows):
+            self._delete([filename])
+            self.filenames.append(filename)
+            self.row_of[filename] = int(row)
+        self._map()
+        return rows
+
+    def delete(self, filenames: List[str]) -> List[int]:
+        """
+        Turn the rows of the given filenames into tombstones. Unknown filenames are ignored.
+
+        Args:
+        - filenames (List[str]): Filenames to delete.
+
+        Returns:
+        - List[int]: Row numbers of the deleted rows.
+        """
+        rows = self._delete(filenames)
+        self._log([f"D{row}\t" for row in rows])
+        return rows
+
+    def _delete(self, filenames: List[str]) -> List[int]:
+        rows = []
+        for filename in filenames:
+            row = self.row_of.pop(filename, None)
+            if row is not None:
+                self.filenames[row] = None
+                self.live[row] = False
+                rows.append(row)
+        return rows
+
+    def rename(self, renamed: List[Tuple[str, str]]) -> None:
+        """
+        Rename rows. Unknown filenames are ignored.
+
+        Args:
+        - renamed (List[Tuple[str, str]]): Pairs of old and new filenames.
+        """
+        records = []
+        for old_filename, new_filename in renamed:
+            row = self.row_of.pop(old_filename, None)
+            if row is None:
+                continue
+            self.filenames[row] = new_filename
+            self.row_of[new_filename] = row
+            records.append(f"R{row}\t{new_filename}")
+        self._log(records)
+
+    def compact(self) -> np.ndarray:
+        """
+        Rewrite the store without its tombstones.
+
+        Returns:
+        - np.ndarray: Old row numbers of the kept rows, in their new order.
+        """
+        keep = np.flatnonzero(self.live)
+        compacted = FeatureStore(self.path + ".compact", self.feat_dim, self.dtype.name)
+        compacted.create()
+        for start in range(0, len(keep), self._COPY_BATCH_SIZE):
+            batch = keep[start:start + self._COPY_BATCH_SIZE]
+            compacted.append([self.filenames[row] for row in batch], self.features[batch], self.scales[batch])
+        self.replace_with(compacted)
+        return keep
+
+    def replace_with(self, other: "FeatureStore") -> None:
+        """
+        Move the files of another store over the files of this one and map them.
+
+        Args:
+        - other (FeatureStore): Store with a different path prefix, which is left empty.
+        """
+        other.flush()
+        other._reset()
+        # unmap before replacing the files, which Windows does not allow while they are mapped
+        self._reset()
+        os.replace(other.features_path, self.features_path)
+        os.replace(other.scales_path, self.scales_path)
+        os.replace(other.rows_path, self.rows_path)
+        # logged rows of the replaced files, ignored anyway as they belong to another generation
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+        self.open()
+
+    def _log(self, records: List[str]) -> None:
+        # records are "A{row}\t{filename}" for appended rows, "D{row}\t" for deleted and "R{row}\t{filename}"
+        # for renamed ones
+        if len(records) == 0:
+            return
+        records = "".join(record + "\0" for record in records)
+        if self.log_end == 0:
+            # no log, or a log of other files
+            records = f"G{self.generation}\0" + records
+            open(self.log_path, "wb").close()
+        records = records.encode("utf-8")
+        utils.write_at(self.log_path, self.log_end, records)
+        self.log_end += len(records)
+
+    def _map(self) -> None:
+        # an empty file cannot be mapped
+        if self.n_rows == 0:
+            self.features = np.empty((0, self.feat_dim), dtype=self.dtype)
+            self.scales = np.empty(0, dtype=np.float32)
+            return
+        self.features = np.memmap(self.features_path, dtype=self.dtype, mode="r", shape=(self.n_rows, self.feat_dim))
+        self.scales = np.memmap(self.scales_path, dtype=np.float32, mode="r", shape=(self.n_rows,))
@@ -0,0 +1,267 @@
+import os
+import re
+from stat import S_ISREG
+from threading import RLock
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+
+import clip_model
+import feature_index
+import ocr_index
+import ocr_model
+import utils
+from import_pipeline import ImportPipeline
+
+_QUERY_CHUNK_SIZE = 1000
+# the watcher, the Update button and the startup import may sync at the same time; a sync reads the
+# manifest and applies its diff as one step
+_sync_lock = RLock()
+
+
+class SyncResult:
+    def __init__(self):
+        self.added: List[str] = []
+        self.modified: List[str] = []
+        self.moved: List[Tuple[str, str]] = []
+        self.deleted: List[str] = []
+        self.touched: List[str] = []
+
+    def __str__(self):
+        return "added {}, modified {}, moved {}, deleted {}, touched {}".format(
+            len(self.added), len(self.modified), len(self.moved), len(self.deleted), len(self.touched))
+
+
+def scan_dirs(base_dirs: List[str]) -> Dict[str, Tuple[int, str]]:
+    """
+    List all files below the base directories recursively, skipping hidden files like glob does.
+
+    Args:
+    - base_dirs (List[str]): List of paths to the base directories.
+
+    Returns:
+    - dict: Mapping from file path to its size and formatted modification time.
+    """
+    files = {}
+    for base_dir in base_dirs:
+        for root, dirnames, filenames in os.walk(base_dir):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for name in filenames:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files[path] = (stat.st_size, utils.format_mtime(stat.st_mtime))
+    return files
+
+
+def load_manifest(mongo_collection: Collection, base_dirs: List[str]) -> Dict[str, dict]:
+    """
+    Load size, modification time and hash of the imported files below the base directories.
+    Files of base directories that do not exist (e.g. an unmounted drive) are left out, so they are not purged.
+
+    Args:
+    - mongo_collection (Collection): MongoDB collection holding the image documents.
+    - base_dirs (List[str]): List of paths to the base directories.
+
+    Returns:
+    - dict: Mapping from file path to its document.
+    """
+    prefixes = tuple(os.path.join(base_dir, '') for base_dir in base_dirs if os.path.isdir(base_dir))
+    if len(prefixes) == 0:
+        return {}
+    cursor = mongo_collection.find({}, {"_id": 0, "filename": 1, "filesize": 1, "date": 1, "md5": 1})
+    return {doc["filename"]: doc for doc in cursor if doc["filename"].startswith(prefixes)}
+
+
+def diff_manifest(current: Dict[str, Tuple[int, str]], saved: Dict[str, dict], use_hash: bool) -> SyncResult:
+    """
+    Compare the files on disk with the imported ones.
+
+    A file is modified if its size or modification time changed. With `use_hash`, a file whose
+    size is unchanged and whose content still matches the stored MD5 hash is only touched.
+    A deleted and an added file with the same size and modification time are treated as a move.
+
+    Args:
+    - current (dict): Files on disk, as returned by scan_dirs.
+    - saved (dict): Imported files, as returned by load_manifest.
+    - use_hash (bool): Whether to compare MD5 hashes to tell apart modified and touched files.
+
+    Returns:
+    - SyncResult: Classified changes.
+    """
+    result = SyncResult()
+    for path in current.keys() & saved.keys():
+        size, date = current[path]
+        doc = saved[path]
+        if (size, date) == (doc["filesize"], doc["date"]):
+            continue
+        if use_hash and size == doc["filesize"] and doc.get("md5") == _calc_md5(path):
+            result.touched.append(path)
+        else:
+            result.modified.append(path)
+
+    deleted_by_key: Dict[Tuple[int, str], List[str]] = {}
+    for path in saved.keys() - current.keys():
+        doc = saved[path]
+        deleted_by_key.setdefault((doc["filesize"], doc["date"]), []).append(path)
+
+    for path in sorted(current.keys() - saved.keys()):
+        candidates = deleted_by_key.get(current[path], [])
+        old_path = next((candidate for candidate in candidates
+                         if not use_hash or saved[candidate].get("md5") in (None, _calc_md5(path))), None)
+        if old_path is None:
+            result.added.append(path)
+        else:
+            candidates.remove(old_path)
+            result.moved.append((old_path, path))
+
+    result.deleted = [path for paths in deleted_by_key.values() for path in paths]
+    return result
+
+
+def sync_dirs(base_dirs: List[str], clip: clip_model.CLIPModel, ocr: ocr_model.OCRModel,
+              config: dict, mongo_collection: Collection, use_hash: Optional[bool] = None) -> SyncResult:
+    """
+    Bring the collection up to date with the files below the base directories: import added files,
+    re-import modified ones, rename moved ones and purge deleted ones, keeping the indexes in sync.
+
+    Args:
+    - base_dirs (List[str]): List of paths to the base directories.
+    - clip (clip_model.CLIPModel): Instance of the CLIP model.
+    - ocr (ocr_model.OCRModel): Instance of the OCR model.
+    - config (dict): Configuration dictionary.
+    - mongo_collection (Collection): MongoDB collection to store the image information.
+    - use_hash (bool): Whether to compare MD5 hashes of changed files, defaults to `sync-use-hash`.
+
+    Returns:
+    - SyncResult: Changes that were applied.
+    """
+    if use_hash is None:
+        use_hash = config.get('sync-use-hash', False)
+    base_dirs = [base_dir for base_dir in base_dirs if base_dir]
+    with _sync_lock:
+        current = scan_dirs(base_dirs)
+        result = diff_manifest(current, load_manifest(mongo_collection, base_dirs), use_hash)
+        apply_sync(result, current, clip, ocr, config, mongo_collection)
+    return result
+
+
+def sync_paths(paths: Iterable[str], base_dirs: List[str], clip: clip_model.CLIPModel, ocr: ocr_model.OCRModel,
+               config: dict, mongo_collection: Collection, use_hash: Optional[bool] = None,
+               save_indexes: bool = True) -> SyncResult:
+    """
+    Like sync_dirs, but only for the given files or directories, e.g. those reported by a filesystem watcher.
+    Paths outside the base directories and hidden files are ignored.
+
+    Args:
+    - paths (Iterable[str]): Changed, created or deleted files and directories.
+    - base_dirs (List[str]): List of paths to the base directories.
+    - clip (clip_model.CLIPModel): Instance of the CLIP model.
+    - ocr (ocr_model.OCRModel): Instance of the OCR model.
+    - config (dict): Configuration dictionary.
+    - mongo_collection (Collection): MongoDB collection to store the image information.
+    - use_hash (bool): Whether to compare MD5 hashes of changed files, defaults to `sync-use-hash`.
+    - save_indexes (bool): Save the indexes afterwards. The changes are logged by the indexes either way,
+      so a caller syncing often can save them less often.
+
+    Returns:
+    - SyncResult: Changes that were applied.
+    """
+    if use_hash is None:
+        use_hash = config.get('sync-use-hash', False)
+    prefixes = [os.path.join(base_dir, '') for base_dir in base_dirs if base_dir]
+    paths = {path for path in paths if _is_visible_below(path, prefixes)}
+    if len(paths) == 0:
+        return SyncResult()
+
+    with _sync_lock:
+        current = {}
+        dir_paths = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            if stat is not None and S_ISREG(stat.st_mode):
+                current[path] = (stat.st_size, utils.format_mtime(stat.st_mtime))
+            else:
+                # a directory, or a vanished path that may have been a directory
+                current.update(scan_dirs([path]))
+                dir_paths.append(path)
+
+        conditions = [{"filename": {"$in": list(paths)}}]
+        conditions += [{"filename": {"$regex": "^" + re.escape(os.path.join(path, ''))}} for path in dir_paths]
+        cursor = mongo_collection.find({"$or": conditions}, {"_id": 0, "filename": 1, "filesize": 1, "date": 1, "md5": 1})
+        saved = {doc["filename"]: doc for doc in cursor}
+
+        result = diff_manifest(current, saved, use_hash)
+        apply_sync(result, current, clip, ocr, config, mongo_collection, save_indexes)
+    return result
+
+
+def apply_sync(result: SyncResult, current: Dict[str, Tuple[int, str]], clip: clip_model.CLIPModel,
+               ocr: ocr_model.OCRModel, config: dict, mongo_collection: Collection,
+               save_indexes: bool = True) -> None:
+    """
+    Apply the changes found by diff_manifest to the collection and the indexes.
+
+    Args:
+    - result (SyncResult): Changes to apply.
+    - current (dict): Files on disk, as returned by scan_dirs.
+    - clip (clip_model.CLIPModel): Instance of the CLIP model.
+    - ocr (ocr_model.OCRModel): Instance of the OCR model.
+    - config (dict): Configuration dictionary.
+    - mongo_collection (Collection): MongoDB collection to store the image information.
+    - save_indexes (bool): Save the indexes afterwards.
+    """
+    with _sync_lock:
+        print(f"[INFO]: sync {result}")
+        index = feature_index.get_feature_index()
+        text_index = ocr_index.get_ocr_index()
+        # load the indexes before the collection changes, so that they match it when they are checked
+        index.ensure_loaded()
+        text_index.ensure_loaded()
+
+        if len(result.moved) > 0:
+            mongo_collection.bulk_write([UpdateOne({"filename": old_path}, {"$set": {"filename": new_path}})
+                                         for old_path, new_path in result.moved], ordered=False)
+            index.rename(result.moved)
+            text_index.rename(result.moved)
+
+        if len(result.touched) > 0:
+            mongo_collection.bulk_write([UpdateOne({"filename": path}, {"$set": {"date": current[path][1]}})
+                                         for path in result.touched], ordered=False)
+
+        purged = result.deleted + result.modified
+        for start in range(0, len(purged), _QUERY_CHUNK_SIZE):
+            chunk = purged[start:start + _QUERY_CHUNK_SIZE]
+            mongo_collection.delete_many({"filename": {"$in": chunk}})
+            index.remove(chunk)
+            text_index.remove(chunk)
+
+        to_import = result.added + result.modified
+        if len(to_import) > 0:
+            # the pipeline saves the indexes when it is done
+            ImportPipeline(clip, ocr, config, mongo_collection, save_indexes=save_indexes).run(to_import)
+        elif save_indexes:
+            index.save()
+            text_index.save()
+
+
+def _is_visible_below(path: str, prefixes: List[str]) -> bool:
+    for prefix in prefixes:
+        if path.startswith(prefix):
+            return not any(part.startswith('.') for part in path[len(prefix):].split(os.sep))
+    return False
+
+
+def _calc_md5(path: str) -> Optional[str]:
+    try:
+        return utils.calc_md5(path)
+    except OSError:
+        return None
@@ -0,0 +1,162 @@
+import time
+from threading import Condition, Thread
+from typing import List, Set
+
+from pymongo.collection import Collection
+from watchdog.events import FileSystemEvent, FileSystemEventHandler
+from watchdog.observers import Observer
+from watchdog.observers.polling import PollingObserver
+
+import clip_model
+import feature_index
+import ocr_index
+import ocr_model
+from folder_sync import sync_paths
+
+
+class _EventHandler(FileSystemEventHandler):
+    def __init__(self, watcher: "FolderWatcher"):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_any_event(self, event: FileSystemEvent):
+        if event.event_type in ("opened", "closed_no_write"):
+            return
+        # every change of a file also modifies its folder, syncing the folder would rescan all of it
+        if event.is_directory and event.event_type == "modified":
+            return
+        paths = [event.src_path]
+        if getattr(event, "dest_path", ""):
+            paths.append(event.dest_path)
+        self.watcher.notify(paths)
+
+
+class FolderWatcher:
+    def __init__(self, base_dirs: List[str], clip: clip_model.CLIPModel, ocr: ocr_model.OCRModel,
+                 config: dict, mongo_collection: Collection):
+        """
+        Watch the image folders and import, re-import or purge changed files as they change.
+
+        Events are collected until the folders have been quiet for `watch-debounce` seconds, or for
+        at most `watch-max-delay` seconds during a continuous burst, and the collected paths are then
+        synced in one go. inotify (or the native API of the platform) is used when available, with
+        a polling fallback every `watch-poll-interval` seconds.
+
+        The synced changes are logged by the indexes, which are saved at most every `watch-save-interval`
+        seconds and when the watcher stops rather than after every sync.
+
+        Args:
+        - base_dirs (List[str]): List of paths to the base directories.
+        - clip (clip_model.CLIPModel): Instance of the CLIP model.
+        - ocr (ocr_model.OCRModel): Instance of the OCR model.
+        - config (dict): Configuration dictionary.
+        - mongo_collection (Collection): MongoDB collection to store the image information.
+        """
+        self.base_dirs = [base_dir for base_dir in base_dirs if base_dir]
+        self.clip = clip
+        self.ocr = ocr
+        self.config = config
+        self.mongo_collection = mongo_collection
+        self.debounce = config.get('watch-debounce', 2.0)
+        self.max_delay = config.get('watch-max-delay', 10.0)
+        self.poll_interval = config.get('watch-poll-interval', 30.0)
+        self.save_interval = config.get('watch-save-interval', 300.0)
+
+        self.pending: Set[str] = set()
+        self.first_event = None
+        self.last_event = None
+        self.stopped = False
+        self.unsaved = False
+        self.last_save = time.monotonic()
+        self.condition = Condition()
+        self.observer = None
+        self.dispatcher = Thread(target=self._dispatch_worker, daemon=True)
+
+    def start(self) -> None:
+        """
+        Start watching the folders.
+        """
+        try:
+            self.observer = self._start_observer(Observer())
+        except OSError as e:
+            # e.g. the inotify watch limit is reached
+            print(f"Cannot watch folders natively, falling back to polling: {e}")
+            self.observer = self._start_observer(PollingObserver(timeout=self.poll_interval))
+        self.dispatcher.start()
+
+    def stop(self) -> None:
+        """
+        Stop watching the folders and save the indexes. Pending changes are dropped and picked up by the next
+        full sync.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+        self.dispatcher.join()
+
+    def notify(self, paths: List[str]) -> None:
+        """
+        Record changed paths. Called from the observer thread.
+
+        Args:
+        - paths (List[str]): Changed, created or deleted files and directories.
+        """
+        with self.condition:
+            now = time.monotonic()
+            if len(self.pending) == 0:
+                self.first_event = now
+            self.last_event = now
+            self.pending.update(paths)
+            self.condition.notify()
+
+    def _start_observer(self, observer):
+        for base_dir in self.base_dirs:
+            observer.schedule(_EventHandler(self), base_dir, recursive=True)
+        observer.start()
+        return observer
+
+    def _dispatch_worker(self):
+        while True:
+            with self.condition:
+                while not self.stopped and len(self.pending) == 0 and not self._save_due():
+                    # until the next event, or the next save if there are unsaved changes
+                    self.condition.wait(self.last_save + self.save_interval - time.monotonic()
+                                        if self.unsaved else None)
+                if self.stopped:
+                    break
+                paths = set()
+                if len(self.pending) > 0:
+                    now = time.monotonic()
+                    timeout = min(self.last_event + self.debounce, self.first_event + self.max_delay) - now
+                    if timeout > 0:
+                        self.condition.wait(timeout)
+                        continue
+                    paths, self.pending = self.pending, set()
+
+            if len(paths) > 0:
+                try:
+                    sync_paths(paths, self.base_dirs, self.clip, self.ocr, self.config, self.mongo_collection,
+                               save_indexes=False)
+                except Exception as e:
+                    print(f"Error syncing {len(paths)} changed paths: {e}")
+                # also after an error, part of the changes may have been applied
+                self.unsaved = True
+            if self._save_due():
+                self._save()
+        if self.unsaved:
+            self._save()
+
+    def _save_due(self) -> bool:
+        return self.unsaved and time.monotonic() >= self.last_save + self.save_interval
+
+    def _save(self):
+        self.unsaved = False
+        self.last_save = time.monotonic()
+        try:
+            feature_index.get_feature_index().save()
+            ocr_index.get_ocr_index().save()
+        except Exception as e:
+            print(f"Error saving the indexes: {e}")
@@ -0,0 +1,420 @@
+import os
+import queue
+import time
+from threading import Lock, Thread
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from pymongo.collection import Collection
+from tqdm import tqdm
+
+import clip_model
+import content_cache
+import feature_index
+import ocr_index
+import ocr_model
+import utils
+from bulk_writer import BulkWriter
+from thumbnail_cache import get_thumbnail_cache
+
+
+def make_document(filename: str, path: str, filetype: str, image_feature: np.ndarray, image_size: tuple,
+                  ocr_text: str, md5: Optional[str] = None, feature_scale: Optional[float] = None) -> dict:
+    """
+    Build the MongoDB document of an imported image.
+
+    Args:
+    - filename (str): Filename stored in the document, i.e. the local path or the remote URL.
+    - path (str): Path to the image file.
+    - filetype (str): File type of the image.
+    - image_feature (np.ndarray): Normalized image feature vector, already encoded in the storage type.
+    - image_size (tuple): Width and height of the image.
+    - ocr_text (str): Text extracted from the image.
+    - md5 (str): MD5 hash of the image file, if known.
+    - feature_scale (float): Quantization scale of an int8 feature vector.
+
+    Returns:
+    - dict: MongoDB document.
+    """
+    stat = os.stat(path)
+
+    document = {
+        'filename': filename,
+        'extension': filetype,
+        'height': image_size[1],
+        'width': image_size[0],
+        'filesize': stat.st_size,
+        'date': utils.format_mtime(stat.st_mtime),
+        'feature': image_feature.tobytes(),
+        'ocr_text': ocr_text
+    }
+    if md5 is not None:
+        document['md5'] = md5
+    if feature_scale is not None:
+        document['feature_scale'] = feature_scale
+    return document
+
+
+class ImportItem:
+    def __init__(self, path: str, filename: str):
+        self.path = path
+        self.filename = filename
+        self.filetype = None
+        self.md5 = None
+        self.image = None
+        self.image_size = None
+        self.feature = None
+        self.feature_scale = None
+        self.ocr_text = None
+        self.cached = False
+        # whether this is the first copy of its content, which the other copies wait for
+        self.claimed = False
+
+
+class StageStats:
+    def __init__(self, name: str):
+        """
+        Throughput counters of a pipeline stage. Busy time is summed over all workers of the stage.
+
+        Args:
+        - name (str): Name of the stage.
+        """
+        self.name = name
+        self.items = 0
+        self.busy = .0
+        self.lock = Lock()
+
+    def record(self, n_items: int, seconds: float) -> None:
+        with self.lock:
+            self.items += n_items
+            self.busy += seconds
+
+    def __str__(self):
+        rate = self.items / self.busy if self.busy > 0 else .0
+        return f"{self.name:<8} {self.items:>8} items {self.busy:>9.2f} s busy {rate:>9.2f} items/s"
+
+
+class ImportPipeline:
+    _SENTINEL = None
+
+    def __init__(self, clip: clip_model.CLIPModel, ocr: ocr_model.OCRModel, config: dict,
+                 mongo_collection: Collection, isRemote=False, remove_files=False, save_indexes=True):
+        """
+        Staged import pipeline connected by bounded queues:
+
+            load (thread pool: file type sniffing, decoding, preprocessing)
+            -> encode (batched CLIP forward passes)
+            -> ocr
+            -> write (buffered bulk MongoDB inserts, feature and OCR index updates)
+
+        Files whose content hash is already in the content cache skip encoding and OCR. Copies
+        of the same content submitted while it is still in flight wait for the first copy and reuse
+        its results.
+
+        All stages run at the same time, so decoding on the CPU cores overlaps with model inference.
+        Bounded queues apply backpressure to `submit` when a downstream stage is the bottleneck.
+
+        Args:
+        - clip (clip_model.CLIPModel): Instance of the CLIP model.
+        - ocr (ocr_model.OCRModel): Instance of the OCR model.
+        - config (dict): Configuration dictionary.
+        - mongo_collection (Collection): MongoDB collection to store the image information.
+        - isRemote (bool): Whether the collection holds the remote (Pixiv) images.
+        - remove_files (bool): Delete the files once they are imported or skipped, e.g. downloads.
+        - save_indexes (bool): Save the indexes in close(), otherwise the caller saves them.
+        """
+        self.clip = clip
+        self.ocr = ocr
+        self.config = config
+        self.mongo_collection = mongo_collection
+        self.feature_index = feature_index.get_feature_index(isRemote)
+        self.ocr_index = ocr_index.get_ocr_index(isRemote)
+        # load the indexes before documents are written, so that they match the collection when they are checked
+        self.feature_index.ensure_loaded()
+        self.ocr_index.ensure_loaded()
+        self.content_cache = content_cache.get_content_cache()
+
+        self.n_workers = config.get('import-workers', 4)
+        self.batch_size = clip.batch_size
+        self.batch_timeout = 0.5
+        self.enable_ocr = config.get('enable-ocr', True)
+        self.remove_files = remove_files
+        self.save_indexes = save_indexes
+
+        queue_size = config.get('import-queue-size', 256)
+        self.load_queue = queue.Queue(queue_size)
+        self.encode_queue = queue.Queue(queue_size)
+        self.ocr_queue = queue.Queue(queue_size)
+        self.write_queue = queue.Queue(queue_size)
+
+        self.stats = {name: StageStats(name) for name in ["load", "encode", "ocr", "write"]}
+        self.n_reused = 0
+        # hash -> copies waiting for the first one, and hash -> finished first copy not yet in the cache
+        self.in_flight: Dict[str, List[ImportItem]] = {}
+        self.finished: Dict[str, ImportItem] = {}
+        self.writer = BulkWriter(mongo_collection, on_written=self._on_written,
+                                 batch_size=config.get('import-write-batch', 64), stats=self.stats["write"],
+                                 exclude_fields=feature_index.mongo_excluded_fields(config))
+        self.lock = Lock()
+        self.n_done = 0
+        self.start_time = time.time()
+        self.threads = [Thread(target=self._load_worker, daemon=True) for _ in range(self.n_workers)]
+        self.threads += [
+            Thread(target=self._encode_worker, daemon=True),
+            Thread(target=self._ocr_worker, daemon=True),
+            Thread(target=self._write_worker, daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, path: str, filename: Optional[str] = None) -> None:
+        """
+        Queue an image file for import. Blocks while the pipeline is full.
+
+        Args:
+        - path (str): Path to the image file.
+        - filename (str): Filename stored in the document, defaults to the path.
+        """
+        self.load_queue.put(ImportItem(path, filename or path))
+
+    def close(self) -> None:
+        """
+        Wait until all submitted files are imported, stop the stages and print their throughput.
+        """
+        for _ in range(self.n_workers):
+            self.load_queue.put(self._SENTINEL)
+        for thread in self.threads:
+            thread.join()
+        if self.save_indexes:
+            self.feature_index.save()
+            self.ocr_index.save()
+        self.finished.clear()
+        self.print_stats()
+
+    def run(self, paths: Iterable[str]) -> None:
+        """
+        Import all given image files and wait for them to finish.
+
+        Args:
+        - paths (Iterable[str]): Paths to the image files.
+        """
+        for path in tqdm(paths):
+            self.submit(path)
+        self.close()
+
+    def print_stats(self) -> None:
+        elapsed = time.time() - self.start_time
+        print(f"[INFO]: imported {self.n_done} images in {elapsed:.2f} s, {self.n_reused} reused from duplicates")
+        for stats in self.stats.values():
+            print(f"[INFO]: {stats}")
+
+    # every stage skips the items it fails on and always passes the sentinel on, a stage that stopped
+    # would leave the next one, and submit() or close(), waiting forever
+    def _load_worker(self):
+        try:
+            while True:
+                item = self.load_queue.get()
+                if item is self._SENTINEL:
+                    return
+                try:
+                    self._load(item)
+                except Exception as e:
+                    print(f"Error loading {item.path}: {e}")
+                    self._abandon(item)
+        finally:
+            self.encode_queue.put(self._SENTINEL)
+
+    def _load(self, item: ImportItem) -> None:
+        start = time.perf_counter()
+        item.filetype = utils.get_file_type(item.path)
+        if item.filetype is None:
+            print("Skipping file:", item.path)
+            self._discard(item)
+            return
+        try:
+            item.md5 = utils.calc_md5(item.path)
+        except OSError as e:
+            print(f"Error reading {item.path}: {e}")
+            self._discard(item)
+            return
+
+        if not self._claim(item):
+            # a copy of the same content is in flight and will finish this item
+            return
+        get_thumbnail_cache().ensure(item.md5, item.path)
+        cached = self._lookup(item)
+        if cached is not None:
+            self._reuse(item, cached)
+            self.stats["load"].record(1, time.perf_counter() - start)
+            return
+
+        item.image, item.image_size = self.clip.load_image(item.path)
+        self.stats["load"].record(1, time.perf_counter() - start)
+        if item.image is None:
+            print("Skipping file:", item.path)
+            self._release(item)
+            self._discard(item)
+            return
+        self.encode_queue.put(item)
+
+    def _abandon(self, item: ImportItem) -> None:
+        # the item failed, the copies waiting for it are skipped as well
+        item.feature = None
+        item.image = None
+        if item.claimed:
+            self._release(item)
+        self._discard(item)
+
+    def _claim(self, item: ImportItem) -> bool:
+        with self.lock:
+            if item.md5 in self.in_flight:
+                self.in_flight[item.md5].append(item)
+                return False
+            self.in_flight[item.md5] = []
+            item.claimed = True
+            return True
+
+    def _release(self, item: ImportItem) -> List[ImportItem]:
+        # hand the results of a finished item over to the copies that waited for it
+        with self.lock:
+            copies = self.in_flight.pop(item.md5, [])
+            if item.feature is not None:
+                # keep the first copy, which decides whether the content still has to be cached
+                self.finished.setdefault(item.md5, item)
+        if item.feature is None:
+            for copy in copies:
+                print("Skipping file:", copy.path)
+                self._discard(copy)
+            return []
+        for copy in copies:
+            copy.feature = item.feature
+            copy.feature_scale = item.feature_scale
+            copy.image_size = item.image_size
+            copy.ocr_text = item.ocr_text
+        with self.lock:
+            self.n_reused += len(copies)
+        return copies
+
+    def _lookup(self, item: ImportItem) -> Optional[dict]:
+        with self.lock:
+            finished = self.finished.get(item.md5)
+        if finished is not None:
+            return {"feature": finished.feature, "feature_scale": finished.feature_scale,
+                    "width": finished.image_size[0], "height": finished.image_size[1], "ocr_text": finished.ocr_text}
+        return self.content_cache.get(item.md5)
+
+    def _reuse(self, item: ImportItem, cached: dict) -> None:
+        item.feature = cached["feature"]
+        item.feature_scale = cached.get("feature_scale")
+        item.image_size = (cached["width"], cached["height"])
+        item.ocr_text = cached.get("ocr_text")
+        item.cached = True
+        with self.lock:
+            self.n_reused += 1
+        if self.enable_ocr and "ocr_text" not in cached:
+            # cached while OCR was disabled
+            item.cached = False
+            self.ocr_queue.put(item)
+        else:
+            self.write_queue.put(item)
+
+    def _encode_worker(self):
+        n_finished = 0
+        batch = []
+        try:
+            while n_finished < self.n_workers:
+                try:
+                    # wait for more items only while a partial batch is pending
+                    item = self.encode_queue.get(timeout=self.batch_timeout if batch else None)
+                except queue.Empty:
+                    self._encode_batch(batch)
+                    batch = []
+                    continue
+
+                if item is self._SENTINEL:
+                    n_finished += 1
+                    continue
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    self._encode_batch(batch)
+                    batch = []
+
+            self._encode_batch(batch)
+        finally:
+            self.ocr_queue.put(self._SENTINEL)
+
+    def _encode_batch(self, batch: list) -> None:
+        if len(batch) == 0:
+            return
+        start = time.perf_counter()
+        try:
+            features = self.clip.encode_images([item.image for item in batch])
+            features, scales = feature_index.encode_features(features, self.config['storage-type'])
+        except Exception as e:
+            print(f"Error encoding batch of {len(batch)} images: {e}")
+            for item in batch:
+                self._abandon(item)
+            return
+        self.stats["encode"].record(len(batch), time.perf_counter() - start)
+
+        for i, (item, feature) in enumerate(zip(batch, features)):
+            item.image = None  # release the preprocessed tensor
+            item.feature = feature
+            item.feature_scale = None if scales is None else float(scales[i])
+            self.ocr_queue.put(item)
+
+    def _ocr_worker(self):
+        try:
+            while True:
+                item = self.ocr_queue.get()
+                if item is self._SENTINEL:
+                    return
+
+                if self.enable_ocr:
+                    start = time.perf_counter()
+                    try:
+                        item.ocr_text = self.ocr.get_ocr_text(item.path)
+                    except Exception as e:
+                        print(f"Error running OCR on {item.path}: {e}")
+                        self._abandon(item)
+                        continue
+                    self.stats["ocr"].record(1, time.perf_counter() - start)
+                self.write_queue.put(item)
+        finally:
+            self.write_queue.put(self._SENTINEL)
+
+    def _write_worker(self):
+        try:
+            while True:
+                item = self.write_queue.get()
+                if item is self._SENTINEL:
+                    return
+                for item in [item] + self._release(item):
+                    try:
+                        document = make_document(item.filename, item.path, item.filetype, item.feature,
+                                                 item.image_size, item.ocr_text, item.md5, item.feature_scale)
+                        self.writer.add(document)
+                    except Exception as e:
+                        print(f"Skipping file {item.path}: {e}")
+                    finally:
+                        self._discard(item)
+        finally:
+            self.writer.close()
+
+    def _discard(self, item: ImportItem) -> None:
+        # the item left the pipeline, its file is not read again
+        if self.remove_files:
+            try:
+                os.remove(item.path)
+            except OSError:
+                pass
+
+    def _on_written(self, documents: List[dict]) -> None:
+        self.feature_index.add_documents(documents)
+        self.ocr_index.add_documents(documents)
+        with self.lock:
+            self.n_done += len(documents)
+            fresh = [self.finished.pop(document["md5"], None) for document in documents]
+        # only the first copy of a content that was not cached is stored
+        fresh = [document for document, item in zip(documents, fresh) if item is not None and not item.cached]
+        self.content_cache.add_documents(fresh, self.enable_ocr)
@@ -10,15 +10,17 @@ import concurrent.futures as futures
 from typing import Callable, Dict, Iterable, Optional, Tuple, List, Set
 from pyquery import PyQuery
 import urllib.parse as urlparse
+from requests.adapters import HTTPAdapter
 from requests.models import Response
+from urllib3.util.retry import Retry
 from functools import wraps, lru_cache
-from threading import Lock
+from threading import Lock, local
 import clip_model
 import ocr_model
-from pymongo.collection import Collection
 import utils
-from datetime import datetime
 from config import cfg
+from import_pipeline import ImportPipeline
+from remote_image_cache import get_remote_image_cache
 
 ###################################### Tips!!! ######################################
 # if u want to show a pixiv image, u can use this function to get the image content #
@@ -73,9 +75,31 @@ DOWNLOAD_CONFIG = {
     "N_THREAD": 8,
     # delay of starting a thread
     "THREAD_DELAY": 1,
+    # backoff factor of the connection-level retries, sleeps 0.5, 1, 2... seconds
+    "BACKOFF": 0.5,
 }
 
 log_lock = Lock()
+session_local = local()
+
+@lru_cache(maxsize=1)
+def getHTTPAdapter() -> HTTPAdapter:
+    # one connection pool per host, big enough to keep a connection alive for every thread
+    retry = Retry(total=DOWNLOAD_CONFIG["N_TIMES"], backoff_factor=DOWNLOAD_CONFIG["BACKOFF"],
+                  status_forcelist=(429, 500, 502, 503, 504), allowed_methods=frozenset(["GET"]),
+                  raise_on_status=False)
+    return HTTPAdapter(pool_maxsize=DOWNLOAD_CONFIG["N_THREAD"], max_retries=retry)
+
+def getSession() -> requests.Session:
+    # a session per thread keeps cookies and headers apart, the adapter and its keep-alive connections are shared
+    session = getattr(session_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.mount("https://", getHTTPAdapter())
+        session.mount("http://", getHTTPAdapter())
+        session.headers.update(NETWORK_CONFIG["HEADER"])
+        session_local.session = session
+    return session
 
 def writeFailLog(text: str):
     with log_lock:
@@ -110,68 +134,31 @@ def checkDir(dir_path):
         os.makedirs(dir_path)
         printInfo(f"create {dir_path}")
 
-def import_single_image(filename: str, url: str, clip: clip_model.CLIPModel, ocr: ocr_model.OCRModel,
-                        config: dict, mongo_collection: Collection) -> None:
-    # if there is an item with the same url, then skip
-    if mongo_collection.find_one({"filename": url}) is not None:
-        print("Skipping file:", filename)
-        return
-    filetype = utils.get_file_type(filename)
-    if filetype is None:
-        print("Skipping file:", filename)
-        return
-
-    image_feature, image_size = clip.get_image_feature(filename)
-    if image_feature is None:
-        print("Skipping file:", filename)
-        return
-    image_feature = image_feature.astype(config['storage-type'])
-
-    ocr_text = ocr.get_ocr_text(filename)
-
-    stat = os.stat(filename)
-
-    image_mtime = datetime.fromtimestamp(stat.st_mtime)
-    image_datestr = image_mtime.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-
-    # Save to MongoDB
-    document = {
-        'filename': url,
-        'extension': filetype,
-        'height': image_size[1],
-        'width': image_size[0],
-        'filesize': stat.st_size,
-        'date': image_datestr,
-        'feature': image_feature.tobytes(),
-        'ocr_text': ocr_text
-    }
-
-    mongo_collection.insert_one(document)
-
-    try:
-        os.remove(filename)
-    except:
-        print("remove failed")
-
-@lru_cache(maxsize=128)
-def getImageResponseContent(url):
-    image_name = url[url.rfind("/") + 1:]
+def imageHeaders(url: str) -> Dict[str, str]:
+    # i.pximg.net refuses requests without the artwork page as referer
     result = re.search("/(\d+)_", url)
     printError(result is None, "bad url in image downloader")
     image_id = result.group(1)
-    headers = {"Referer": f"https://www.pixiv.net/artworks/{image_id}"}
-    headers.update(NETWORK_CONFIG["HEADER"])
+    return {"Referer": f"https://www.pixiv.net/artworks/{image_id}"}
 
-    try:
-        response = requests.get(
-        url, headers=headers,
+def fetchImageBytes(url) -> bytes:
+    response = getSession().get(
+        url, headers=imageHeaders(url),
         proxies=NETWORK_CONFIG["PROXY"],
         timeout=(3, 10))
+    response.raise_for_status()
+    return response.content
 
-        image = QImage.fromData(response.content)
-    except:
-        image = QImage.fromData(b'')
-    return image
+def getImageResponseBytes(url) -> bytes:
+    # compressed content from the byte-bounded memory and disk cache, b'' if the download failed
+    try:
+        return get_remote_image_cache().get(url, fetchImageBytes)
+    except Exception as e:
+        print(f"Error fetching {url}: {e}")
+        return b''
+
+def getImageResponseContent(url):
+    return QImage.fromData(getImageResponseBytes(url))
 
 class Downloader():
     def __init__(self, capacity):
@@ -181,19 +168,33 @@ class Downloader():
         self.ocr = ocr_model.get_ocr_model()
         self.config = utils.get_config()
         self.mongo_collection = utils.get_mongo_collection(isRemote=True)
+        self.pipeline = None
 
     def add(self, urls: Iterable[str]):
         for url in urls:
             self.url_group.add(url)
 
+    def open(self):
+        # downloads are embedded by the batched CLIP and OCR stages of the pipeline, not on the download
+        # threads; its bounded queues block saveImage while embedding is behind
+        self.pipeline = ImportPipeline(self.clip, self.ocr, self.config, self.mongo_collection,
+                                       isRemote=True, remove_files=True)
+
+    def close(self):
+        printInfo("===== downloader complete =====")
+        self.pipeline.close()
+        os.rmdir(DOWNLOAD_CONFIG["STORE_PATH"])
+
+    def saveImage(self, image_path: str, url: str, content: bytes) -> float:
+        with open(image_path, "wb") as f:
+            f.write(content)
+        # items with the same url are rejected by the unique filename index
+        self.pipeline.submit(image_path, url)
+        return len(content) / (1 << 20)
+
     def downloadImage(self, url: str) -> float:
         image_name = url[url.rfind("/") + 1:]
-        result = re.search("/(\d+)_", url)
-        printError(result is None, "bad url in image downloader")
-        image_id = result.group(1)
-        print("image_id:", image_id)    
-        headers = {"Referer": f"https://www.pixiv.net/artworks/{image_id}"}
-        headers.update(NETWORK_CONFIG["HEADER"])
+        headers = imageHeaders(url)
 
         verbose_output = OUTPUT_CONFIG["VERBOSE"]
         error_output = OUTPUT_CONFIG["PRINT_ERROR"]
@@ -209,7 +210,7 @@ class Downloader():
         wait_time = 10
         for i in range(DOWNLOAD_CONFIG["N_TIMES"]):
             try:
-                response = requests.get(
+                response = getSession().get(
                     url, headers=headers,
                     proxies=NETWORK_CONFIG["PROXY"],
                     timeout=(4, wait_time))
@@ -223,12 +224,10 @@ class Downloader():
                         wait_time += 2
                         continue
 
-                    with open(image_path, "wb") as f:
-                        f.write(response.content)
-                    import_single_image(image_path, url, self.clip, self.ocr, self.config, self.mongo_collection)
+                    image_size = self.saveImage(image_path, url, response.content)
                     if verbose_output:
                         printInfo(f"{image_name} complete")
-                    return image_size / (1 << 20)
+                    return image_size
 
             except Exception as e:
                 printWarn(error_output, e)
@@ -245,6 +244,7 @@ class Downloader():
         flow_size = .0
         printInfo("===== downloader start =====")
 
+        self.open()
         n_thread = DOWNLOAD_CONFIG["N_THREAD"]
         with futures.ThreadPoolExecutor(n_thread) as executor:
             with tqdm(total=len(self.url_group), desc="downloading") as pbar:
@@ -258,17 +258,15 @@ class Downloader():
                         executor.shutdown(wait=False, cancel_futures=True)
                         break
 
-        printInfo("===== downloader complete =====")
-        os.rmdir(DOWNLOAD_CONFIG["STORE_PATH"])
+        self.close()
         return flow_size
     
 
 def collect(args: Tuple[str, Callable, Optional[Dict]]) \
         -> Optional[Iterable[str]]:
     url, selector, additional_headers = args
-    headers = NETWORK_CONFIG["HEADER"]
-    if additional_headers is not None:
-        headers.update(additional_headers)
+    # the session sends NETWORK_CONFIG["HEADER"]
+    headers = additional_headers
 
     verbose_output = OUTPUT_CONFIG["VERBOSE"]
     error_output = OUTPUT_CONFIG["PRINT_ERROR"]
@@ -278,7 +276,7 @@ def collect(args: Tuple[str, Callable, Optional[Dict]]) \
 
     for i in range(DOWNLOAD_CONFIG["N_TIMES"]):
         try:
-            response = requests.get(
+            response = getSession().get(
                 url, headers=headers,
                 proxies=NETWORK_CONFIG["PROXY"],
                 timeout=4)
@@ -317,21 +315,13 @@ class Collector():
         n_thread = DOWNLOAD_CONFIG["N_THREAD"]
         with futures.ThreadPoolExecutor(n_thread) as executor:
             with tqdm(total=len(self.id_group), desc="collecting tags") as pbar:
-                urls = [f"https://www.pixiv.net/artworks/{illust_id}"
-                        for illust_id in self.id_group]
-                additional_headers = {
-                    "Referer": "https://www.pixiv.net/bookmark.php?type=user"}
                 for illust_id, tags in zip(
-                        self.id_group, executor.map(collect, zip(
-                            urls, [selectTag] * len(urls),
-                            [additional_headers] * len(urls)))):
+                        self.id_group, executor.map(collect, map(tagRequest, self.id_group))):
                     if tags is not None:
                         self.tags[illust_id] = tags
                     pbar.update()
 
-        file_path = DOWNLOAD_CONFIG["STORE_PATH"] + "tags.json"
-        with open(file_path, "w", encoding="utf-8") as f:
-            f.write(json.dumps(self.tags, indent=4, ensure_ascii=False))
+        saveTags(self.tags)
 
         printInfo("===== tag collector complete =====")
 
@@ -344,16 +334,7 @@ class Collector():
         n_thread = DOWNLOAD_CONFIG["N_THREAD"]
         with futures.ThreadPoolExecutor(n_thread) as executor:
             with tqdm(total=len(self.id_group), desc="collecting urls") as pbar:
-                urls = [f"https://www.pixiv.net/ajax/illust/{illust_id}/pages?lang=zh"
-                        for illust_id in self.id_group]
-                additional_headers = [
-                    {
-                        "Referer": f"https://www.pixiv.net/artworks/{illust_id}",
-                        "x-user-id": cfg.uid.value
-                    }
-                    for illust_id in self.id_group]
-                for urls in executor.map(collect, zip(
-                        urls, [selectPage] * len(urls), additional_headers)):
+                for urls in executor.map(collect, map(pageRequest, self.id_group)):
                     if urls is not None:
                         self.downloader.add(urls)
                     pbar.update()
@@ -361,6 +342,20 @@ class Collector():
         printInfo("===== collector complete =====")
         printInfo(f"total images: {len(self.downloader.url_group)}")
 
+def tagRequest(illust_id: str) -> Tuple[str, Callable, Dict]:
+    return (f"https://www.pixiv.net/artworks/{illust_id}", selectTag,
+            {"Referer": "https://www.pixiv.net/bookmark.php?type=user"})
+
+def pageRequest(illust_id: str) -> Tuple[str, Callable, Dict]:
+    # original urls of the images of an artwork
+    return (f"https://www.pixiv.net/ajax/illust/{illust_id}/pages?lang=zh", selectPage,
+            {"Referer": f"https://www.pixiv.net/artworks/{illust_id}", "x-user-id": cfg.uid.value})
+
+def saveTags(tags: Dict[str, List]):
+    file_path = DOWNLOAD_CONFIG["STORE_PATH"] + "tags.json"
+    with open(file_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(tags, indent=4, ensure_ascii=False))
+
 def selectTag(response: Response) -> List[str]:
     result = re.search("artworks/(\d+)", response.url)
     printError(result is None, "bad response in selectTag")
@@ -414,11 +409,10 @@ class BookmarkCrawler():
         printInfo("===== requesting bookmark count =====")
 
         headers = {"COOKIE": cfg.cookie.value}
-        headers.update(NETWORK_CONFIG["HEADER"])
         error_output = OUTPUT_CONFIG["PRINT_ERROR"]
         for i in range(DOWNLOAD_CONFIG["N_TIMES"]):
             try:
-                response = requests.get(
+                response = getSession().get(
                     url, headers=headers,
                     proxies=NETWORK_CONFIG["PROXY"],
                     timeout=4)
@@ -440,23 +434,26 @@ class BookmarkCrawler():
         printWarn(True, "check COOKIE config")
         printError(True, "===== fail to get bookmark count =====")
 
-    def collect(self):
+    def prepare(self):
+        self.__requestCount()
+
+    def listingRequests(self) -> List[Tuple[str, Callable, Dict]]:
         ARTWORK_PER = 48
         n_page = (self.n_images - 1) // ARTWORK_PER + 1  # ceil
-        printInfo(f"===== start collecting {self.uid}'s bookmarks =====")
+        additional_headers = {"COOKIE": cfg.cookie.value}
+        return [(self.url + "/bookmarks?tag=&" +
+                 f"offset={i * ARTWORK_PER}&limit={ARTWORK_PER}&rest=show&lang=zh",
+                 selectBookmark, additional_headers)
+                for i in range(n_page)]
 
-        urls: Set[str] = set()
-        for i in range(n_page):
-            urls.add(self.url + "/bookmarks?tag=&" +
-                     f"offset={i * ARTWORK_PER}&limit={ARTWORK_PER}&rest=show&lang=zh")
+    def collect(self):
+        printInfo(f"===== start collecting {self.uid}'s bookmarks =====")
 
+        requests_args = self.listingRequests()
         n_thread = DOWNLOAD_CONFIG["N_THREAD"]
         with futures.ThreadPoolExecutor(n_thread) as executor:
-            with tqdm(total=len(urls), desc="collecting ids") as pbar:
-                additional_headers = {"COOKIE": cfg.cookie.value}
-                for image_ids in executor.map(collect, zip(
-                        urls, [selectBookmark] * len(urls),
-                        [additional_headers] * len(urls))):
+            with tqdm(total=len(requests_args), desc="collecting ids") as pbar:
+                for image_ids in executor.map(collect, requests_args):
                     if image_ids is not None:
                         self.collector.add(image_ids)
                     pbar.update()
@@ -465,7 +462,7 @@ class BookmarkCrawler():
         printInfo(f"downloadable artworks: {len(self.collector.id_group)}")
 
     def run(self):
-        self.__requestCount()
+        self.prepare()
         self.collect()
         self.collector.collect()
         return self.downloader.download()
@@ -478,15 +475,20 @@ class UserCrawler():
         self.downloader = Downloader(capacity)
         self.collector = Collector(self.downloader)
 
-    def collect(self):
+    def prepare(self):
+        pass
+
+    def listingRequests(self) -> List[Tuple[str, Callable, Dict]]:
         url = f"https://www.pixiv.net/ajax/user/{self.artist_id}/profile/all?lang=zh"
         additional_headers = {
             "Referer": f"https://www.pixiv.net/users/{self.artist_id}/illustrations",
             "x-user-id": cfg.uid.value,
             "COOKIE": cfg.cookie.value
         }
-        image_ids = collect(
-            (url, selectUser, additional_headers))
+        return [(url, selectUser, additional_headers)]
+
+    def collect(self):
+        image_ids = collect(self.listingRequests()[0])
         if image_ids is not None:
             self.collector.add(image_ids)
         printInfo(f"===== collect user {self.artist_id} complete =====")
@@ -512,26 +514,27 @@ class KeywordCrawler():
         self.downloader = Downloader(capacity)
         self.collector = Collector(self.downloader)
 
-    def collect(self):
+    def prepare(self):
+        pass
+
+    def listingRequests(self) -> List[Tuple[str, Callable, Dict]]:
         ARTWORK_PER = 60
         n_page = (self.n_images - 1) // ARTWORK_PER + 1  # ceil
-        printInfo(f"===== start collecting {self.keyword} =====")
-
-        urls: Set[str] = set()
         url = "https://www.pixiv.net/ajax/search/artworks/" + \
             "{}?word={}".format(urlparse.quote(self.keyword, safe="()"), urlparse.quote(self.keyword)) + \
             "&order={}".format("popular_d" if self.order else "date_d") + \
             f"&mode={self.mode}" + "&p={}&s_mode=s_tag&type=all&lang=zh"
-        for i in range(n_page):
-            urls.add(url.format(i + 1))
+        additional_headers = {"COOKIE": cfg.cookie.value}
+        return [(url.format(i + 1), selectKeyword, additional_headers) for i in range(n_page)]
+
+    def collect(self):
+        printInfo(f"===== start collecting {self.keyword} =====")
 
+        requests_args = self.listingRequests()
         n_thread = DOWNLOAD_CONFIG["N_THREAD"]
         with futures.ThreadPoolExecutor(n_thread) as executor:
-            with tqdm(total=len(urls), desc="collecting ids") as pbar:
-                additional_headers = {"COOKIE": cfg.cookie.value}
-                for image_ids in executor.map(collect, zip(
-                        urls, [selectKeyword] * len(urls),
-                        [additional_headers] * len(urls))):
+            with tqdm(total=len(requests_args), desc="collecting ids") as pbar:
+                for image_ids in executor.map(collect, requests_args):
                     if image_ids is not None:
                         self.collector.add(image_ids)
                     pbar.update()
@@ -10,6 +10,7 @@ from qframelesswindow import FramelessWindow, StandardTitleBar
 
 
 from config import cfg
+from ocr_scorer import get_ocr_scorer
 from page.local_search import LocalSearchInterface
 from page.pixiv_search import PixivSearchInterface
 from page.settings import SettingInterface
@@ -126,6 +127,9 @@ class Window(FramelessWindow):
 
 
 if __name__ == '__main__':
+    # while there is no other thread, see OCRScorer.start
+    get_ocr_scorer().start()
+
     QApplication.setHighDpiScaleFactorRoundingPolicy(
         Qt.HighDpiScaleFactorRoundingPolicy.PassThrough)
     QApplication.setAttribute(Qt.AA_EnableHighDpiScaling)
@@ -0,0 +1,376 @@
+import heapq
+import json
+import os
+import re
+from collections import Counter
+import uuid
+from threading import Lock
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from pymongo.collection import Collection
+
+import utils
+from ocr_scorer import get_ocr_scorer
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _is_cjk(char: str) -> bool:
+    code = ord(char)
+    return (0x3040 <= code <= 0x30ff      # hiragana, katakana
+            or 0x3400 <= code <= 0x4dbf   # CJK extension A
+            or 0x4e00 <= code <= 0x9fff   # CJK unified ideographs
+            or 0xac00 <= code <= 0xd7af   # hangul syllables
+            or 0xf900 <= code <= 0xfaff)  # CJK compatibility ideographs
+
+
+def text_grams(text: Optional[str]) -> Set[str]:
+    """
+    Split text into the character grams used as index terms.
+
+    Text is case-folded and whitespace runs are collapsed. Every character bigram is a term, since
+    neither Chinese nor Japanese separate words by spaces. A single CJK character already carries
+    meaning, so CJK characters are unigram terms as well.
+
+    Args:
+    - text (str): OCR text or query, may be None.
+
+    Returns:
+    - set: Index terms of the text.
+    """
+    if not text:
+        return set()
+    text = _WHITESPACE.sub(" ", text.casefold()).strip()
+    grams = {text[i:i + 2] for i in range(len(text) - 1)}
+    grams.update(char for char in text if _is_cjk(char))
+    return grams
+
+
+class OCRTextIndex:
+    def __init__(self, mongo_collection: Collection, config: dict):
+        """
+        Inverted character n-gram index over the OCR text of a MongoDB collection.
+
+        A query first shortlists the `ocr-shortlist-size` documents sharing the most grams with it,
+        and only the shortlist is re-ranked with `fuzz.partial_ratio` by the OCR scorer. Like the feature index,
+        it is loaded once, kept in sync by the importers and saved next to the MongoDB data. Changes since the
+        last save() are logged to `{collection}.ocr.log` as they happen and replayed by load().
+
+        Args:
+        - mongo_collection (Collection): MongoDB collection holding the image documents.
+        - config (dict): Configuration dictionary.
+        """
+        self.mongo_collection = mongo_collection
+        self.config = config
+        self.shortlist_size = config.get('ocr-shortlist-size', 1000)
+        self.index_path = os.path.join(config.get('index-path', './mongo_sample/index'),
+                                       f"{mongo_collection.name}.ocr.npz")
+        self.log_path = self.index_path[:-len(".npz")] + ".log"
+        self.lock = Lock()
+        self.loaded = False
+        self.loaded_stamp = None
+        self._clear()
+
+    def __len__(self):
+        return len(self._id_of)
+
+    def clear(self) -> None:
+        """
+        Drop the index and replace the saved one with an empty index, e.g. after the collection has been dropped.
+        """
+        with self.lock:
+            self._clear()
+            self.loaded = True
+            self._save()
+
+    def _clear(self) -> None:
+        self._filenames: List[Optional[str]] = []
+        self._texts: List[str] = []
+        self._id_of: Dict[str, int] = {}
+        self._free_ids: List[int] = []
+        self._postings: Dict[str, Set[int]] = {}
+        # identifies the saved index, a log only extends the index of its own generation
+        self.generation = ""
+        # end of the last complete record of the log, 0 if there is no valid log
+        self.log_end = 0
+
+    def load(self) -> None:
+        """
+        Load the saved index from disk if it matches the collection, otherwise rebuild it from MongoDB.
+        """
+        with self.lock:
+            self._load()
+
+    def refresh(self) -> None:
+        """
+        Apply the changes another process logged since, or load the saved index again if it saved it,
+        for processes that only search it such as server.py. Unsaved changes of this process would be lost.
+        """
+        self.ensure_loaded()
+        if self._stamp() != self.loaded_stamp:
+            with self.lock:
+                stamp = self._stamp()
+                if stamp == self.loaded_stamp:
+                    return
+                if stamp[0] == self.loaded_stamp[0] and self.generation != "":
+                    # the same saved index, only the log grew
+                    self.loaded_stamp = stamp
+                    self._replay(self._read_log(self.log_end))
+                else:
+                    self._load()
+
+    def ensure_loaded(self) -> None:
+        if not self.loaded:
+            self.load()
+
+    def _load(self) -> None:
+        # taken before reading, a save while reading shows up as another stamp later
+        self.loaded_stamp = self._stamp()
+        self._clear()
+        if not self._load_saved():
+            self._clear()
+            cursor = self.mongo_collection.find({}, {"_id": 0, "filename": 1, "ocr_text": 1})
+            for doc in cursor:
+                self._add(doc["filename"], doc.get("ocr_text"))
+            # saved right away, so that changes are logged against it
+            self._save()
+            self.loaded_stamp = self._stamp()
+        self.loaded = True
+
+    def _stamp(self) -> tuple:
+        stamp = []
+        for path in [self.index_path, self.log_path]:
+            try:
+                stat = os.stat(path)
+                stamp.append((stat.st_mtime_ns, stat.st_size, stat.st_ino))
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def save(self) -> None:
+        """
+        Save the documents and posting lists with the logged changes, so that the next start reads
+        neither the collection nor the log.
+        """
+        with self.lock:
+            if self.loaded:
+                self._save()
+
+    def _save(self) -> None:
+        ids = np.array(sorted(self._id_of.values()), dtype=np.int64)
+        new_id = np.full(len(self._filenames), -1, dtype=np.int64)
+        new_id[ids] = np.arange(len(ids))
+        # posting lists in CSR form, renumbered without the freed ids
+        grams = list(self._postings.keys())
+        lengths = np.array([len(self._postings[gram]) for gram in grams], dtype=np.int64)
+        postings = np.fromiter((doc_id for gram in grams for doc_id in self._postings[gram]),
+                               dtype=np.int64, count=int(lengths.sum()))
+        texts = [self._texts[i] for i in ids]
+        arrays = {
+            "filenames": np.array([self._filenames[i] for i in ids], dtype=str),
+            # one string and the lengths, a fixed-width array would pad every text to the longest one
+            "text_data": np.array(["".join(texts)]),
+            "text_lengths": np.array([len(text) for text in texts], dtype=np.int64),
+            "grams": np.array(grams, dtype=str),
+            "offsets": np.concatenate([[0], np.cumsum(lengths)]),
+            "postings": new_id[postings].astype(np.int32),
+        }
+        generation = uuid.uuid4().hex
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        utils.atomic_write(self.index_path, lambda f: np.savez(f, generation=np.array(generation), **arrays))
+        self.generation = generation
+        # the logged changes are in the saved index now, a log left by a crash right here is skipped by load
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+        self.log_end = 0
+
+    def add_documents(self, documents: List[dict]) -> None:
+        """
+        Index the OCR text of freshly inserted MongoDB documents. Existing filenames are re-indexed.
+
+        Args:
+        - documents (List[dict]): Documents with `filename` and `ocr_text` fields.
+        """
+        with self.lock:
+            for document in documents:
+                self._remove(document["filename"])
+                self._add(document["filename"], document.get("ocr_text"))
+            self._log([["A", document["filename"], document.get("ocr_text") or ""] for document in documents])
+
+    def remove(self, filenames: List[str]) -> None:
+        """
+        Remove documents from the index. Unknown filenames are ignored.
+
+        Args:
+        - filenames (List[str]): Filenames of the images to remove.
+        """
+        with self.lock:
+            self._log([["D", filename] for filename in filenames if self._remove(filename)])
+
+    def rename(self, renamed: List[Tuple[str, str]]) -> None:
+        """
+        Rename documents of the index, e.g. after files were moved. Unknown filenames are ignored.
+
+        Args:
+        - renamed (List[Tuple[str, str]]): Pairs of old and new filenames.
+        """
+        with self.lock:
+            self._log([["R", old_filename, new_filename] for old_filename, new_filename in renamed
+                       if self._rename(old_filename, new_filename)])
+
+    def search(self, query_text: str, topn: int = 20) -> Tuple[List[str], List[int]]:
+        """
+        Find the documents whose OCR text matches the query best.
+
+        Args:
+        - query_text (str): Text to search for.
+        - topn (int): Number of results to return.
+
+        Returns:
+        - tuple: List of filenames and list of `fuzz.partial_ratio` scores, best match first.
+        """
+        self.ensure_loaded()
+        with self.lock:
+            candidates = self._shortlist(text_grams(query_text))
+            filenames = [self._filenames[doc_id] for doc_id in candidates]
+            texts = [self._texts[doc_id] for doc_id in candidates]
+
+        score_list = get_ocr_scorer().score(query_text, texts)
+        sorted_indices = utils.top_k(score_list, topn)
+        return [filenames[i] for i in sorted_indices], [score_list[i] for i in sorted_indices]
+
+    def _shortlist(self, grams: Set[str]) -> List[int]:
+        if len(grams) == 0:
+            # e.g. a single latin character, which is not an index term
+            return list(self._id_of.values())
+        counts = Counter()
+        for gram in grams:
+            counts.update(self._postings.get(gram, ()))
+        if len(counts) <= self.shortlist_size:
+            return list(counts.keys())
+        return [doc_id for doc_id, _ in heapq.nlargest(self.shortlist_size, counts.items(), key=lambda x: x[1])]
+
+    def _add(self, filename: str, text: Optional[str]) -> None:
+        text = text or ""
+        if self._free_ids:
+            doc_id = self._free_ids.pop()
+            self._filenames[doc_id] = filename
+            self._texts[doc_id] = text
+        else:
+            doc_id = len(self._filenames)
+            self._filenames.append(filename)
+            self._texts.append(text)
+        self._id_of[filename] = doc_id
+        for gram in text_grams(text):
+            self._postings.setdefault(gram, set()).add(doc_id)
+
+    def _remove(self, filename: str) -> bool:
+        doc_id = self._id_of.pop(filename, None)
+        if doc_id is None:
+            return False
+        for gram in text_grams(self._texts[doc_id]):
+            posting = self._postings[gram]
+            posting.discard(doc_id)
+            if len(posting) == 0:
+                del self._postings[gram]
+        self._filenames[doc_id] = None
+        self._texts[doc_id] = ""
+        self._free_ids.append(doc_id)
+        return True
+
+    def _rename(self, old_filename: str, new_filename: str) -> bool:
+        doc_id = self._id_of.pop(old_filename, None)
+        if doc_id is None:
+            return False
+        # a document already indexed under the new name is replaced, as in MongoDB
+        self._remove(new_filename)
+        self._filenames[doc_id] = new_filename
+        self._id_of[new_filename] = doc_id
+        return True
+
+    def _replay(self, changes: List[list]) -> None:
+        for change in changes:
+            if change[0] == "A":
+                self._remove(change[1])
+                self._add(change[1], change[2])
+            elif change[0] == "D":
+                self._remove(change[1])
+            elif change[0] == "R":
+                self._rename(change[1], change[2])
+
+    def _log(self, changes: List[list]) -> None:
+        # changes are ["A", filename, text] for added documents, ["D", filename] for removed and
+        # ["R", old_filename, new_filename] for renamed ones, JSON escapes the "\0" separating them
+        if len(changes) == 0 or self.generation == "":
+            return
+        records = "".join(json.dumps(change, ensure_ascii=False) + "\0" for change in changes)
+        if self.log_end == 0 or not os.path.exists(self.log_path):
+            # no log, a log of another saved index, or removed by a save of another process
+            records = f"G{self.generation}\0" + records
+            open(self.log_path, "wb").close()
+        records = records.encode("utf-8")
+        utils.write_at(self.log_path, self.log_end, records)
+        self.log_end += len(records)
+
+    def _read_log(self, start: int) -> List[list]:
+        try:
+            with open(self.log_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return []
+        header = f"G{self.generation}\0".encode("utf-8")
+        if self.generation == "" or not data.startswith(header):
+            return []
+        self.log_end = max(start, len(header))
+        changes = []
+        # the last record is empty, or incomplete after a crash and overwritten by the next change
+        for record in data[self.log_end:].split(b"\0")[:-1]:
+            try:
+                changes.append(json.loads(record.decode("utf-8")))
+            except ValueError:
+                break
+            self.log_end += len(record) + 1
+        return changes
+
+    def _load_saved(self) -> bool:
+        if not os.path.exists(self.index_path):
+            return False
+        try:
+            with np.load(self.index_path) as saved:
+                arrays = {key: saved[key] for key in saved.files}
+        except (OSError, ValueError) as e:
+            print(f"Failed to load OCR index {self.index_path}: {e}")
+            return False
+
+        if "generation" not in arrays:
+            # saved before changes were logged, any change since is missing
+            print(f"OCR index {self.index_path} is out of date, rebuilding it from MongoDB")
+            return False
+        # the importers update the index along with MongoDB and log every change, so the index is trusted
+        # as saved; a live document count would differ whenever MongoDB changed before loading
+        if len(arrays["filenames"]) > 0 and self.mongo_collection.estimated_document_count() == 0:
+            print(f"OCR index {self.index_path} belongs to a dropped collection, rebuilding it from MongoDB")
+            return False
+        self._filenames = arrays["filenames"].tolist()
+        text_data = str(arrays["text_data"][0])
+        text_offsets = np.concatenate([[0], np.cumsum(arrays["text_lengths"])]).tolist()
+        self._texts = [text_data[text_offsets[i]:text_offsets[i + 1]] for i in range(len(self._filenames))]
+        self._id_of = {filename: doc_id for doc_id, filename in enumerate(self._filenames)}
+        offsets, postings = arrays["offsets"], arrays["postings"].tolist()
+        self._postings = {gram: set(postings[offsets[i]:offsets[i + 1]])
+                          for i, gram in enumerate(arrays["grams"].tolist())}
+        self.generation = arrays["generation"].item()
+        self._replay(self._read_log(0))
+        return True
+
+
+@utils.cache_per_collection
+def get_ocr_index(isRemote=False) -> OCRTextIndex:
+    """
+    Get the shared OCR text index of the local or remote collection, using LRU cache.
+
+    Returns:
+    - OCRTextIndex: OCRTextIndex instance.
+    """
+    return OCRTextIndex(utils.get_mongo_collection(isRemote), utils.get_config())
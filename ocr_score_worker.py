@@ -0,0 +1,13 @@
+"""
+Scoring function run by the worker processes of the OCR scorer.
+
+Kept apart from ocr_scorer.py, whose imports pull in MongoDB and CLIP through utils, so that a
+spawned worker only imports fuzzywuzzy besides the main module.
+"""
+from typing import List
+
+from fuzzywuzzy import fuzz
+
+
+def score_chunk(query_text: str, texts: List[str]) -> List[int]:
+    return [fuzz.partial_ratio(query_text, text) for text in texts]
@@ -0,0 +1,111 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait
+from functools import lru_cache
+from threading import Lock
+from typing import Dict, List, Optional
+
+import utils
+from ocr_score_worker import score_chunk
+
+
+class OCRScorer:
+    _CHUNK_SIZE = 2000
+
+    def __init__(self, config: dict):
+        """
+        Scores a query against many OCR strings with `fuzz.partial_ratio`, giving the same scores as
+        calling it pair by pair.
+
+        Each distinct text is scored once, since OCR text repeats a lot (e.g. images without text).
+        Batches of at least `ocr-score-parallel-min` distinct texts are split across a pool of
+        `ocr-score-workers` processes (all CPU cores if 0), smaller ones are scored in-process
+        where the pool overhead would not pay off. Call start() at startup so that the first large
+        batch does not wait for the workers.
+
+        Args:
+        - config (dict): Configuration dictionary.
+        """
+        self.n_workers = config.get('ocr-score-workers', 0) or os.cpu_count() or 1
+        self.parallel_min = config.get('ocr-score-parallel-min', 500)
+        self.lock = Lock()
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+    def score(self, query_text: str, texts: List[str]) -> List[int]:
+        """
+        Score a query against a batch of OCR strings.
+
+        Args:
+        - query_text (str): Text to search for.
+        - texts (List[str]): OCR texts to score.
+
+        Returns:
+        - List[int]: `fuzz.partial_ratio(query_text, text)` for every text, in order.
+        """
+        unique_texts = list(dict.fromkeys(texts))
+        if self.n_workers > 1 and len(unique_texts) >= self.parallel_min:
+            unique_scores = self._score_parallel(query_text, unique_texts)
+        else:
+            unique_scores = score_chunk(query_text, unique_texts)
+        score_of: Dict[str, int] = dict(zip(unique_texts, unique_scores))
+        return [score_of[text] for text in texts]
+
+    def start(self) -> None:
+        """
+        Start the worker processes now instead of at the first large batch.
+
+        Called while the process has no other thread, e.g. first thing in a `__main__` block, the
+        workers are forked: they start at once and share the memory of the process instead of
+        importing the main module again. Otherwise they are started from a fork server, or spawned
+        where there is none (Windows), as a fork while another thread holds a lock could deadlock them.
+        """
+        if self.n_workers <= 1:
+            return
+        executor = self._get_executor()
+        # the pool starts its processes as tasks arrive
+        wait([executor.submit(score_chunk, "", []) for _ in range(self.n_workers)])
+
+    def close(self) -> None:
+        """
+        Shut the worker processes down.
+        """
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+    def _score_parallel(self, query_text: str, texts: List[str]) -> List[int]:
+        # at least one chunk per worker, at most _CHUNK_SIZE texts per chunk
+        chunk_size = min(self._CHUNK_SIZE, -(-len(texts) // self.n_workers))
+        chunks = [texts[start:start + chunk_size] for start in range(0, len(texts), chunk_size)]
+        futures = [self._get_executor().submit(score_chunk, query_text, chunk) for chunk in chunks]
+        return [score for future in futures for score in future.result()]
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(self.n_workers, mp_context=self._mp_context())
+            return self.executor
+
+    @staticmethod
+    def _mp_context():
+        methods = multiprocessing.get_all_start_methods()
+        if "fork" in methods and threading.active_count() == 1:
+            return multiprocessing.get_context("fork")
+        if "forkserver" in methods:
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(["ocr_score_worker"])
+            return context
+        return multiprocessing.get_context("spawn")
+
+
+@lru_cache(maxsize=1)
+def get_ocr_scorer() -> OCRScorer:
+    """
+    Get the shared OCR scorer, using LRU cache.
+
+    Returns:
+    - OCRScorer: OCRScorer instance.
+    """
+    return OCRScorer(utils.get_config())
@@ -1,5 +1,3 @@
-import os
-
 from PIL import Image
 from PyQt5.QtCore import Qt, QTimer, QThread, pyqtSignal
 from PyQt5.QtWidgets import QWidget, QHBoxLayout, QVBoxLayout, QLabel, QStackedWidget, QApplication
@@ -13,16 +11,19 @@ import ocr_model
 from components.fusion_input import FusionInput
 from components.image_gallery import ImageGallery
 from components.image_input import ImageInput
+from components.search_thread import SearchThread
 from components.text_input import PromptInput, OCRInput
 from config import cfg
 from search_services import SearchService
-from import_images import import_single_image, import_dirs
+from folder_sync import sync_dirs
+from folder_watcher import FolderWatcher
 
 
 class LocalSearchInterface(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
         self.importThread = None
+        self.folderWatcher = None
         self.setObjectName("Local-Search-Interface")
         layout = QVBoxLayout()
         self.mongo_collection = utils.get_mongo_collection()
@@ -89,6 +90,17 @@ class LocalSearchInterface(QWidget):
         self.stateTooltip.setState(True)
         self.stateTooltip = None
         self.inputCard.enableButtons()
+        self.startFolderWatcher()
+
+    def startFolderWatcher(self):
+        config = utils.get_config()
+        if self.folderWatcher is not None or not config.get('watch-folders', False):
+            return
+        self.folderWatcher = FolderWatcher(cfg.folder.value, clip_model.get_model(), ocr_model.get_ocr_model(),
+                                           config, self.mongo_collection)
+        self.folderWatcher.start()
+        # saves the indexes the watcher changed since its last save
+        QApplication.instance().aboutToQuit.connect(self.folderWatcher.stop)
 
     def showStateTooltip(self):
         self.stateTooltip = StateToolTip('Importing images...', 'Please wait', self)
@@ -107,6 +119,10 @@ class SearchMethods(SimpleCardWidget):
         self.vBoxLayout = QVBoxLayout(self)
 
         self.search_service = SearchService()
+        self.searchThread = SearchThread(self.search_service, self)
+        self.searchThread.resultsUpdated.connect(self.onSearchResultsUpdated)
+        self.searchThread.searchFailed.connect(self.onSearchFailed)
+        self.searchThread.start()
         self.PromptInterface = PromptInput()
         self.OCRInterface = OCRInput()
         self.ImageInterface = ImageInput(800, 180)
@@ -153,26 +169,35 @@ class SearchMethods(SimpleCardWidget):
         )
 
     def onSearchButtonClicked(self):
-        results = None
         currentInterface = self.stackedWidget.currentWidget()
         query = self.getQueryFromInterface(currentInterface)
         if query is None:
             return
         if isinstance(currentInterface, FusionInput):
-            results = self.search_service.search_fusion(query['text'], query['image'], query['weight'], topn=20)
-        elif isinstance(query, str):
-            if isinstance(currentInterface, PromptInput):
-                results = self.search_service.search_image(query, topn=20)
-            elif isinstance(currentInterface, OCRInput):
-                results = self.search_service.search_ocr(query, topn=20)
+            kind = "fusion"
+        elif isinstance(currentInterface, PromptInput):
+            kind = "prompt"
+        elif isinstance(currentInterface, OCRInput):
+            kind = "ocr"
         elif isinstance(query, Image.Image):
-            results = self.search_service.search_image(query, topn=20)
-
-        if results is not None:
-            filenames = [filename for filename, _ in results]
-            self.parent().outputCard.updateGallery(filenames)
+            kind = "image"
         else:
             print("Unknown interface")
+            return
+        # runs off the GUI thread, results arrive through onSearchResultsUpdated
+        self.searchThread.search(kind, query, topn=20)
+
+    def onSearchResultsUpdated(self, generation, filenames):
+        if self.searchThread.isCurrent(generation):
+            self.parent().outputCard.updateGallery(filenames)
+
+    def onSearchFailed(self, generation, message):
+        if self.searchThread.isCurrent(generation):
+            InfoBar.error(
+                title=self.tr("Error"),
+                content=self.tr("Search failed: ") + message,
+                parent=self
+            ).show()
 
     def onClearButtonClicked(self):
         currentInterface = self.stackedWidget.currentWidget()
@@ -190,27 +215,8 @@ class SearchMethods(SimpleCardWidget):
             return
 
     def onUpdateButtonClicked(self):
-        self.parent().showStateTooltip()
         print("Start updating...\n")
-        base_dirs = cfg.folder.value
-        cursor = self.parent().mongo_collection.find({}, {"filename": 1})
-        saved_filename_list = [obj["filename"] for obj in cursor]
-        current_filename_list = []
-        for base_dir in base_dirs:
-            abs_files = [os.path.join(base_dir, file) for file in os.listdir(base_dir)]
-            current_filename_list.extend(abs_files)
-        
-        # 检测新增
-        cnt = 0
-        for current_filename in current_filename_list:
-            if current_filename not in saved_filename_list:
-                cnt += 1
-                import_single_image(current_filename, clip_model.get_model(), 
-                                    ocr_model.get_ocr_model(), 
-                                    utils.get_config(), 
-                                    utils.get_mongo_collection())
-
-        self.parent().onImportFinished()
+        self.parent().startImportThread(cfg.folder.value)
 
     def onCurrentIndexChanged(self, index):
         widget = self.stackedWidget.widget(index)
@@ -272,9 +278,5 @@ class ImportThread(QThread):
         self.mongo_collection = utils.get_mongo_collection()
 
     def run(self):
-        if self.mongo_collection.count_documents({}) == 0:
-            import_dirs(self.base_dirs, self.clip, self.ocr, self.config, self.mongo_collection)
-            self.localThreadFinished.emit()
-        else:
-            print("Database is not empty. Skipping import.")
-            self.localThreadFinished.emit()
+        sync_dirs(self.base_dirs, self.clip, self.ocr, self.config, self.mongo_collection)
+        self.localThreadFinished.emit()
@@ -9,9 +9,13 @@ import utils
 from components.fusion_input import FusionInput
 from components.image_gallery import ImageGallery
 from components.image_input import ImageInput
+from components.search_thread import SearchThread
 from components.pixiv_filter import SearchOptionCard
 from components.text_input import PromptInput, OCRInput
 from config import cfg
+from feature_index import get_feature_index
+from ocr_index import get_ocr_index
+from async_crawler import AsyncCrawler
 from import_remote import BookmarkCrawler, UserCrawler, KeywordCrawler
 from search_services import SearchService
 
@@ -96,6 +100,10 @@ class SearchMethods(SimpleCardWidget):
         self.vBoxLayout = QVBoxLayout(self)
 
         self.search_service = SearchService(isRemote=True)
+        self.searchThread = SearchThread(self.search_service, self)
+        self.searchThread.resultsUpdated.connect(self.onSearchResultsUpdated)
+        self.searchThread.searchFailed.connect(self.onSearchFailed)
+        self.searchThread.start()
         self.PromptInterface = PromptInput()
         self.OCRInterface = OCRInput()
         self.ImageInterface = ImageInput(800, 180)
@@ -156,7 +164,6 @@ class SearchMethods(SimpleCardWidget):
             return
 
     def onSearchButtonClicked(self):
-        results = None
         if not self.checkDatabase():
             return
         currentInterface = self.stackedWidget.currentWidget()
@@ -164,20 +171,30 @@ class SearchMethods(SimpleCardWidget):
         if query is None:
             return
         if isinstance(currentInterface, FusionInput):
-            results = self.search_service.search_fusion(query['text'], query['image'], query['weight'], topn=20)
-        elif isinstance(query, str):
-            if isinstance(currentInterface, PromptInput):
-                results = self.search_service.search_image(query, topn=20)
-            elif isinstance(currentInterface, OCRInput):
-                results = self.search_service.search_ocr(query, topn=20)
+            kind = "fusion"
+        elif isinstance(currentInterface, PromptInput):
+            kind = "prompt"
+        elif isinstance(currentInterface, OCRInput):
+            kind = "ocr"
         elif isinstance(query, Image.Image):
-            results = self.search_service.search_image(query, topn=20)
-
-        if results is not None:
-            filenames = [filename for filename, _ in results]
-            self.parent().outputCard.updateGallery(filenames)
+            kind = "image"
         else:
             print("Unknown interface")
+            return
+        # runs off the GUI thread, results arrive through onSearchResultsUpdated
+        self.searchThread.search(kind, query, topn=20)
+
+    def onSearchResultsUpdated(self, generation, filenames):
+        if self.searchThread.isCurrent(generation):
+            self.parent().outputCard.updateGallery(filenames)
+
+    def onSearchFailed(self, generation, message):
+        if self.searchThread.isCurrent(generation):
+            InfoBar.error(
+                title=self.tr("Error"),
+                content=self.tr("Search failed: ") + message,
+                parent=self
+            ).show()
 
     def checkDatabase(self):
         if self.parent().mongo_collection.count_documents({}) == 0:
@@ -274,7 +291,12 @@ class SearchMethods(SimpleCardWidget):
                 return None
         else:
             return None
+        if utils.get_config().get('crawler-engine', 'thread') == 'async':
+            app = AsyncCrawler(app)
         self.parent().mongo_collection.drop()
+        utils.create_indexes(self.parent().mongo_collection)
+        get_feature_index(isRemote=True).clear()
+        get_ocr_index(isRemote=True).clear()
         self.parent().showStateTooltip()
 
         self.importThread = ImportThread(app)
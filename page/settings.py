@@ -10,6 +10,8 @@ from qfluentwidgets import (ScrollArea, SettingCardGroup, OptionsSettingCard, Hy
 from qfluentwidgets import FluentIcon as FIF
 
 import utils
+from feature_index import get_feature_index
+from ocr_index import get_ocr_index
 from config import cfg, EMAIL, URL, AUTHOR, VERSION, YEAR
 
 
@@ -157,6 +159,9 @@ class SettingInterface(ScrollArea):
 
     def clearDB(self):
         self.mongo_collection.drop()
+        utils.create_indexes(self.mongo_collection)
+        get_feature_index().clear()
+        get_ocr_index().clear()
 
 class AccountSettingCard(SettingCard):
     def __init__(self, icon: Union[str, QIcon, FluentIconBase], title, content=None, parent=None):
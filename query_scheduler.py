@@ -0,0 +1,176 @@
+import time
+from concurrent.futures import Future
+from threading import Condition, Thread
+from typing import List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+import utils
+from search_services import SearchService, get_search_service
+
+
+class _Query:
+    def __init__(self, prompt: Optional[str], image: Optional[Image.Image], weight: float, topn: int):
+        self.prompt = prompt
+        self.image = image
+        # weight of the prompt, the image gets 1 - weight
+        self.weight = weight
+        self.topn = topn
+        self.future = Future()
+        self.arrival = time.monotonic()
+
+
+class QueryScheduler:
+    def __init__(self, search_service: SearchService, config: dict):
+        """
+        Micro-batches concurrent CLIP searches (text, image and fusion).
+
+        Queries arriving within `query-batch-wait` seconds of the oldest waiting one, up to
+        `query-batch-size` of them, are encoded with one text and one image forward pass and scored
+        with one matrix-matrix product against the feature index. Each caller gets its own top-k.
+
+        Args:
+        - search_service (SearchService): Search service providing the model and the feature index.
+        - config (dict): Configuration dictionary.
+        """
+        self.search_service = search_service
+        self.max_batch_size = config.get('query-batch-size', 32)
+        self.max_wait = config.get('query-batch-wait', 0.005)
+
+        self.queue: List[_Query] = []
+        self.closed = False
+        self.condition = Condition()
+        self.worker = Thread(target=self._batch_worker, daemon=True)
+        self.worker.start()
+
+    def submit_text(self, prompt: str, topn: int = 20) -> Future:
+        """
+        Queue a text search.
+
+        Args:
+        - prompt (str): Text describing the images.
+        - topn (int): Number of results.
+
+        Returns:
+        - Future: Resolves to the list of filenames and list of similarity scores, best match first.
+        """
+        return self._submit(_Query(prompt, None, 1., topn))
+
+    def submit_image(self, image: Image.Image, topn: int = 20) -> Future:
+        """
+        Queue an image search.
+
+        Args:
+        - image (Image.Image): Query image.
+        - topn (int): Number of results.
+
+        Returns:
+        - Future: Resolves to the list of filenames and list of similarity scores, best match first.
+        """
+        return self._submit(_Query(None, image, 0., topn))
+
+    def submit_fusion(self, prompt: str, image: Image.Image, weight: float, topn: int = 20) -> Future:
+        """
+        Queue a fusion search, as in SearchService.search_fusion.
+
+        Args:
+        - prompt (str): Text describing the images.
+        - image (Image.Image): Query image.
+        - weight (float): Weight of the prompt, the image is weighted 1 - weight.
+        - topn (int): Number of results.
+
+        Returns:
+        - Future: Resolves to the list of filenames and list of similarity scores, best match first.
+        """
+        return self._submit(_Query(prompt, image, weight, topn))
+
+    def close(self) -> None:
+        """
+        Run the queued queries and stop the batching thread.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.worker.join()
+
+    def _submit(self, query: _Query) -> Future:
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("QueryScheduler is closed")
+            self.queue.append(query)
+            self.condition.notify()
+        return query.future
+
+    def _take(self) -> Optional[List[_Query]]:
+        with self.condition:
+            while not self.closed and len(self.queue) == 0:
+                self.condition.wait()
+            if len(self.queue) == 0:
+                return None
+            # wait for more queries until the batch is full or its oldest query waited long enough
+            while not self.closed and len(self.queue) < self.max_batch_size:
+                timeout = self.queue[0].arrival + self.max_wait - time.monotonic()
+                if timeout <= 0:
+                    break
+                self.condition.wait(timeout)
+            batch, self.queue = self.queue[:self.max_batch_size], self.queue[self.max_batch_size:]
+        return batch
+
+    def _batch_worker(self):
+        while True:
+            batch = self._take()
+            if batch is None:
+                return
+            batch = [query for query in batch if query.future.set_running_or_notify_cancel()]
+            if len(batch) == 0:
+                continue
+            try:
+                results = self._search(batch)
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0].future.set_exception(e)
+                else:
+                    # e.g. a prompt longer than the context of the text encoder, searched one by one
+                    # so that only its own query fails
+                    for query in batch:
+                        self._search_alone(query)
+                continue
+            for query, result in zip(batch, results):
+                query.future.set_result(result)
+
+    def _search_alone(self, query: _Query) -> None:
+        try:
+            query.future.set_result(self._search([query])[0])
+        except Exception as e:
+            query.future.set_exception(e)
+
+    def _search(self, batch: List[_Query]) -> List[Tuple[List[str], List[float]]]:
+        feat_dim = self.search_service.feat_dim
+        text_features = np.zeros((len(batch), feat_dim), dtype=np.float32)
+        image_features = np.zeros((len(batch), feat_dim), dtype=np.float32)
+        with_prompt = [i for i, query in enumerate(batch) if query.prompt is not None]
+        with_image = [i for i, query in enumerate(batch) if query.image is not None]
+        if len(with_prompt) > 0:
+            text_features[with_prompt] = self.search_service.model.get_text_features(
+                [batch[i].prompt for i in with_prompt])
+        if len(with_image) > 0:
+            image_features[with_image] = self.search_service.get_image_features(
+                [batch[i].image for i in with_image])
+
+        weights = np.array([[query.weight] for query in batch], dtype=np.float32)
+        target_features = weights * text_features + (1 - weights) * image_features
+        results = self.search_service.feature_index.search_batch(
+            target_features, topn=max(query.topn for query in batch))
+        return [(filenames[:query.topn], scores[:query.topn]) for query, (filenames, scores) in zip(batch, results)]
+
+
+@utils.cache_per_collection
+def get_query_scheduler(isRemote=False) -> QueryScheduler:
+    """
+    Get the shared query scheduler of the local or remote collection, using LRU cache.
+
+    Returns:
+    - QueryScheduler: QueryScheduler instance.
+    """
+    return QueryScheduler(get_search_service(isRemote), utils.get_config())
@@ -0,0 +1,139 @@
+import hashlib
+import os
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import lru_cache
+from threading import Lock
+from typing import Callable, Dict, Optional
+
+import utils
+
+
+class RemoteImageCache:
+    def __init__(self, config: dict):
+        """
+        Two-tier cache of downloaded images, holding the compressed file content rather than decoded images.
+
+        The memory tier is an LRU bounded to `remote-cache-memory-mb`, entries evicted from it stay in
+        the disk tier under `remote-cache-path`, which is bounded to `remote-cache-disk-mb` and survives
+        restarts. Any thread may fill it; concurrent requests of the same url share one download.
+
+        Args:
+        - config (dict): Configuration dictionary.
+        """
+        self.memory = utils.LRUCache(maxsize=1 << 20, max_bytes=config.get('remote-cache-memory-mb', 64) * 2 ** 20)
+        self.base_dir = config.get('remote-cache-path', './mongo_sample/remote_cache')
+        self.max_disk_bytes = config.get('remote-cache-disk-mb', 1024) * 2 ** 20
+        self.lock = Lock()
+        # disk entries, least recently used first
+        self.disk_files: Optional[OrderedDict] = None
+        self.disk_bytes = 0
+        self.in_flight: Dict[str, Future] = {}
+
+    def get(self, url: str, fetch: Callable[[str], bytes]) -> bytes:
+        """
+        Get the content of a url, downloading it on a miss.
+
+        Args:
+        - url (str): Image url.
+        - fetch (Callable): Downloads the content of a url, may raise.
+
+        Returns:
+        - bytes: Content of the url.
+        """
+        data = self.memory.get(url)
+        if data is not None:
+            return data
+        data = self._read_disk(url)
+        if data is not None:
+            self.memory.put(url, data)
+            return data
+
+        with self.lock:
+            future = self.in_flight.get(url)
+            owner = future is None
+            if owner:
+                future = self.in_flight[url] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            data = fetch(url)
+            self.memory.put(url, data)
+            self._write_disk(url, data)
+            future.set_result(data)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[url]
+        return data
+
+    def path_of(self, url: str) -> str:
+        name = url[url.rfind("/") + 1:]
+        ext = name[name.rfind(".") + 1:] if "." in name else "bin"
+        return utils.get_full_path(self.base_dir, f"{hashlib.md5(url.encode()).hexdigest()}.{ext}")
+
+    def _read_disk(self, url: str) -> Optional[bytes]:
+        path = self.path_of(url)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        with self.lock:
+            self._scan_disk()
+            if path in self.disk_files:
+                self.disk_files.move_to_end(path)
+        return data
+
+    def _write_disk(self, url: str, data: bytes) -> None:
+        if len(data) > self.max_disk_bytes:
+            return
+        path = self.path_of(url)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            utils.atomic_write(path, lambda f: f.write(data))
+        except OSError as e:
+            print(f"Error caching {url}: {e}")
+            return
+
+        with self.lock:
+            self._scan_disk()
+            self.disk_bytes += len(data) - self.disk_files.pop(path, 0)
+            self.disk_files[path] = len(data)
+            while self.disk_bytes > self.max_disk_bytes:
+                old_path, size = self.disk_files.popitem(last=False)
+                self.disk_bytes -= size
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+
+    def _scan_disk(self) -> None:
+        # files left by earlier runs, oldest first
+        if self.disk_files is not None:
+            return
+        files = []
+        for root, _, names in os.walk(self.base_dir):
+            for name in names:
+                path = os.path.join(root, name).replace(os.sep, "/")
+                if name.endswith(".tmp"):
+                    continue
+                stat = os.stat(path)
+                files.append((stat.st_mtime, path, stat.st_size))
+        files.sort()
+        self.disk_files = OrderedDict((path, size) for _, path, size in files)
+        self.disk_bytes = sum(self.disk_files.values())
+
+
+@lru_cache(maxsize=1)
+def get_remote_image_cache() -> RemoteImageCache:
+    """
+    Get the shared remote image cache, using LRU cache.
+
+    Returns:
+    - RemoteImageCache: RemoteImageCache instance.
+    """
+    return RemoteImageCache(utils.get_config())
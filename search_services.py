@@ -1,20 +1,13 @@
+import hashlib
 import os
 from typing import List
 
 import numpy as np
-import torch
 from PIL import Image
 import utils
 from clip_model import get_model
-from fuzzywuzzy import fuzz
-
-
-def cosine_similarity(query_feature, feature_list):
-    query_feature = query_feature / np.linalg.norm(query_feature, axis=1, keepdims=True)
-    feature_list = feature_list / np.linalg.norm(feature_list, axis=1, keepdims=True)
-    sim_score = (query_feature @ feature_list.T)
-
-    return sim_score[0]
+from feature_index import get_feature_index
+from ocr_index import get_ocr_index
 
 
 class SearchService:
@@ -25,56 +18,17 @@ class SearchService:
 
         self.model = get_model()
         self.mongo_collection = utils.get_mongo_collection(isRemote)
-        self._MAX_SPLIT_SIZE = 8192
+        self.feature_index = get_feature_index(isRemote)
+        self.ocr_index = get_ocr_index(isRemote)
+        # md5 of the query image pixels -> image feature
+        self.image_cache = utils.LRUCache(self.config.get('query-image-cache-size', 16))
 
     def search_nearest_clip_feature(self, query_feature, topn=20):
-        cursor = self.mongo_collection.find({}, {"_id": 0, "filename": 1, "feature": 1})
-
-        filename_list = []
-        feature_list = []
-        sim_score_list = []
-        for doc in cursor:
-            feature_list.append(np.frombuffer(doc["feature"], self.config["storage-type"]))
-            filename_list.append(doc["filename"])
-
-            if len(feature_list) >= self._MAX_SPLIT_SIZE:
-                feature_list = np.array(feature_list)
-                sim_score_list.append(cosine_similarity(query_feature, feature_list))
-                feature_list = []
-
-        if len(feature_list) > 0:
-            feature_list = np.array(feature_list)
-            sim_score_list.append(cosine_similarity(query_feature, feature_list))
-
-        if len(sim_score_list) == 0:
-            return [], []
-
-        sim_score = np.concatenate(sim_score_list, axis=0)
-
-        top_n_idx = np.argsort(sim_score)[::-1][:topn]
-        top_n_filename = [filename_list[idx] for idx in top_n_idx]
-        top_n_score = [float(sim_score[idx]) for idx in top_n_idx]
-
-        return top_n_filename, top_n_score
+        return self.feature_index.search(query_feature, topn=topn)
 
     def search_ocr_text(self, query_text, topn=20):
-        # fuzzy search
-        cursor = self.mongo_collection.find({}, {"_id": 0, "filename": 1, "ocr_text": 1})
-
-        filename_list = []
-        ocr_text_list = []
-        for doc in cursor:
-            filename_list.append(doc["filename"])
-            ocr_text_list.append(doc["ocr_text"])
-
-        # use fuzzywuzzy to calculate similarity score
-        score_list = [fuzz.partial_ratio(query_text, ocr_text) for ocr_text in ocr_text_list]
-
-        sorted_indices = sorted(range(len(score_list)), key=lambda k: score_list[k], reverse=True)
-        sorted_filename = [filename_list[i] for i in sorted_indices[:topn]]
-        sorted_scores = [score_list[i] for i in sorted_indices[:topn]]
-
-        return sorted_filename, sorted_scores
+        # fuzzy search over the candidates of the n-gram index
+        return self.ocr_index.search(query_text, topn=topn)
 
     def convert_result(self, filename_list: List[str], score_list: List[float]):
         doc_result = self.mongo_collection.find(
@@ -85,7 +39,10 @@ class SearchService:
         filename_to_doc_dict = {d['filename']: d for d in doc_result}
         ret_list = []
         for filename, score in zip(filename_list, score_list):
-            doc = filename_to_doc_dict[filename]
+            doc = filename_to_doc_dict.get(filename)
+            if doc is None:
+                # deleted from MongoDB by another process since the index was loaded
+                continue
 
             s = ""
             s += "Score = {:.5f}\n".format(score)
@@ -99,16 +56,35 @@ class SearchService:
             ret_list.append((filename, s))
         return ret_list
 
+    def get_image_feature(self, image: Image.Image):
+        return self.get_image_features([image])[0][np.newaxis]
+
+    def get_image_features(self, images: List[Image.Image]) -> np.ndarray:
+        # the same image is searched again e.g. when only the fusion weight changed
+        keys = []
+        for image in images:
+            md5 = hashlib.md5(f"{image.mode} {image.size}".encode())
+            md5.update(image.tobytes())
+            keys.append(md5.hexdigest())
+        image_features = [self.image_cache.get(key) for key in keys]
+        missing = [i for i, image_feature in enumerate(image_features) if image_feature is None]
+        if len(missing) > 0:
+            # encode all uncached images in one forward pass
+            encoded = self.model.encode_images([self.model.preprocess(images[i]) for i in missing])
+            for i, image_feature in zip(missing, encoded):
+                image_feature = image_feature[np.newaxis]
+                image_feature.setflags(write=False)
+                self.image_cache.put(keys[i], image_feature)
+                image_features[i] = image_feature
+        return np.concatenate(image_features, axis=0)
+
     def search_image(self, query, topn):
-        with torch.no_grad():
-            if isinstance(query, str):
-                target_feature = self.model.get_text_feature(query)
-            elif isinstance(query, Image.Image):
-                image_input = self.model.preprocess(query).unsqueeze(0).to(self.model.device)
-                image_feature = self.model.model.encode_image(image_input)
-                target_feature = image_feature.cpu().detach().numpy()
-            else:
-                assert False, "Invalid query (input) type"
+        if isinstance(query, str):
+            target_feature = self.model.get_text_feature(query)
+        elif isinstance(query, Image.Image):
+            target_feature = self.get_image_feature(query)
+        else:
+            assert False, "Invalid query (input) type"
 
         filename_list, score_list = self.search_nearest_clip_feature(target_feature, topn=int(topn))
         return self.convert_result(filename_list, score_list)
@@ -120,16 +96,13 @@ class SearchService:
         topn:显示前n匹配结果
         weight:prompt和image权重为weight和1-weight
         '''
-        with torch.no_grad():
-            if isinstance(prompt,str) and isinstance(image, Image.Image):
-                target_feature1 = self.model.get_text_feature(prompt)
-                image_input = self.model.preprocess(image).unsqueeze(0).to(self.model.device)
-                image_feature = self.model.model.encode_image(image_input)
-                target_feature2 = image_feature.cpu().detach().numpy()
-                w1, w2 = weight, 1-weight
-                target_feature = w1 * target_feature1 + w2 * target_feature2
-            else:
-                assert False, "Invalid query (input) type"
+        if isinstance(prompt,str) and isinstance(image, Image.Image):
+            target_feature1 = self.model.get_text_feature(prompt)
+            target_feature2 = self.get_image_feature(image)
+            w1, w2 = weight, 1-weight
+            target_feature = w1 * target_feature1 + w2 * target_feature2
+        else:
+            assert False, "Invalid query (input) type"
 
         filename_list, score_list = self.search_nearest_clip_feature(target_feature, topn=int(topn))
         return self.convert_result(filename_list, score_list)
@@ -137,3 +110,35 @@ class SearchService:
     def search_ocr(self, query_text, topn):
         filename_list, score_list = self.search_ocr_text(query_text, topn=int(topn), )
         return self.convert_result(filename_list, score_list)
+
+    def search_progressive(self, kind, query, topn=20):
+        '''
+        kind: "prompt", "image", "fusion" or "ocr"
+        query: text, image, or for fusion a dict with 'text', 'image' and 'weight'
+        yields (filename_list, score_list) of the rows scored so far, refined chunk by chunk;
+        OCR search is answered at once
+        '''
+        if kind == "ocr":
+            yield self.search_ocr_text(query, topn=int(topn))
+            return
+        if kind == "fusion":
+            target_feature = query['weight'] * self.model.get_text_feature(query['text']) \
+                + (1 - query['weight']) * self.get_image_feature(query['image'])
+        elif isinstance(query, str):
+            target_feature = self.model.get_text_feature(query)
+        elif isinstance(query, Image.Image):
+            target_feature = self.get_image_feature(query)
+        else:
+            assert False, "Invalid query (input) type"
+        yield from self.feature_index.search_progressive(target_feature, topn=int(topn))
+
+
+@utils.cache_per_collection
+def get_search_service(isRemote=False) -> SearchService:
+    """
+    Get the shared search service of the local or remote collection, using LRU cache.
+
+    Returns:
+    - SearchService: SearchService instance.
+    """
+    return SearchService(isRemote)
@@ -0,0 +1,210 @@
+"""
+Headless HTTP search server, serving the text, image, OCR and fusion search of the GUI to many clients
+from one resident CLIP model and index.
+
+Run from the repository root with MongoDB started:
+
+    python server.py
+
+All endpoints take a `topn` (default 20) and a `remote` flag selecting the remote (pixiv) collection, and
+answer `{"results": [[filename, info], ...]}`, the pairs returned by SearchService.convert_result.
+
+- POST /search/text    JSON `{"query": "a cat"}`
+- POST /search/ocr     JSON `{"query": "some text"}`
+- POST /search/image   multipart form with an `image` file
+- POST /search/fusion  multipart form with an `image` file, a `prompt` and a `weight` of the prompt in [0, 1]
+"""
+import asyncio
+import io
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import clip
+from aiohttp import web
+from PIL import Image, UnidentifiedImageError
+
+import utils
+from ocr_scorer import get_ocr_scorer
+from query_scheduler import QueryScheduler, get_query_scheduler
+from search_services import SearchService, get_search_service
+
+_EXECUTOR = web.AppKey("executor", ThreadPoolExecutor)
+_MAX_TOPN = web.AppKey("max_topn", int)
+
+
+def _parse_bool(value) -> bool:
+    if isinstance(value, str):
+        return value.lower() in ("1", "true", "yes")
+    return bool(value)
+
+
+def _parse_topn(value, max_topn: int) -> int:
+    try:
+        topn = int(value)
+    except (TypeError, ValueError):
+        raise web.HTTPBadRequest(text="topn must be an integer")
+    if not 0 < topn <= max_topn:
+        raise web.HTTPBadRequest(text=f"topn must be between 1 and {max_topn}")
+    return topn
+
+
+def _open_image(data: bytes) -> Image.Image:
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except (UnidentifiedImageError, OSError) as e:
+        raise web.HTTPBadRequest(text=f"Invalid image: {e}")
+    return image
+
+
+async def _run(request: web.Request, func: Callable, *args):
+    # models and indexes are blocking, keep the event loop free for other clients
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(request.app[_EXECUTOR], func, *args)
+
+
+def _check_prompt(prompt: str) -> None:
+    # the text encoder fails on prompts longer than its context, answer 400 instead of 500
+    try:
+        clip.tokenize([prompt])
+    except RuntimeError:
+        raise web.HTTPBadRequest(text="prompt is too long for the text encoder")
+
+
+async def _read_json(request: web.Request) -> dict:
+    try:
+        params = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text="Request body must be JSON")
+    if not isinstance(params, dict) or not isinstance(params.get("query"), str) or not params["query"]:
+        raise web.HTTPBadRequest(text="query must be a non-empty string")
+    return params
+
+
+async def _read_form(request: web.Request) -> dict:
+    if not request.content_type.startswith("multipart/"):
+        raise web.HTTPBadRequest(text="Request body must be multipart/form-data")
+    form = await request.post()
+    params = {key: value for key, value in form.items() if isinstance(value, str)}
+    image = form.get("image")
+    if not isinstance(image, web.FileField):
+        raise web.HTTPBadRequest(text="image file is missing")
+    params["image"] = image.file.read()
+    return params
+
+
+def _respond(results) -> web.Response:
+    return web.json_response({"results": [[filename, info] for filename, info in results]})
+
+
+def _get_service(params: dict) -> SearchService:
+    return get_search_service(_parse_bool(params.get("remote", False)))
+
+
+def _get_scheduler(isRemote: bool) -> QueryScheduler:
+    scheduler = get_query_scheduler(isRemote)
+    # map the images the GUI imported or deleted since the index was loaded
+    scheduler.search_service.feature_index.refresh()
+    return scheduler
+
+
+def _search_ocr(params: dict, topn: int) -> list:
+    service = _get_service(params)
+    # index the OCR text of the images the GUI imported or deleted since the index was loaded
+    service.ocr_index.refresh()
+    return service.search_ocr(params["query"], topn)
+
+
+async def _search_clip(request: web.Request, params: dict, submit: Callable) -> web.Response:
+    # concurrent CLIP searches are encoded and scored together by the query scheduler
+    scheduler = await _run(request, _get_scheduler, _parse_bool(params.get("remote", False)))
+    filename_list, score_list = await asyncio.wrap_future(submit(scheduler))
+    return _respond(await _run(request, scheduler.search_service.convert_result, filename_list, score_list))
+
+
+async def search_text(request: web.Request) -> web.Response:
+    params = await _read_json(request)
+    topn = _parse_topn(params.get("topn", 20), request.app[_MAX_TOPN])
+    await _run(request, _check_prompt, params["query"])
+    return await _search_clip(request, params, lambda scheduler: scheduler.submit_text(params["query"], topn))
+
+
+async def search_ocr(request: web.Request) -> web.Response:
+    params = await _read_json(request)
+    topn = _parse_topn(params.get("topn", 20), request.app[_MAX_TOPN])
+    results = await _run(request, _search_ocr, params, topn)
+    return _respond(results)
+
+
+async def search_image(request: web.Request) -> web.Response:
+    params = await _read_form(request)
+    topn = _parse_topn(params.get("topn", 20), request.app[_MAX_TOPN])
+
+    image = await _run(request, _open_image, params["image"])
+    return await _search_clip(request, params, lambda scheduler: scheduler.submit_image(image, topn))
+
+
+async def search_fusion(request: web.Request) -> web.Response:
+    params = await _read_form(request)
+    topn = _parse_topn(params.get("topn", 20), request.app[_MAX_TOPN])
+    if not params.get("prompt"):
+        raise web.HTTPBadRequest(text="prompt must be a non-empty string")
+    try:
+        weight = float(params.get("weight", 0.5))
+    except ValueError:
+        raise web.HTTPBadRequest(text="weight must be a number")
+    if not 0 <= weight <= 1:
+        raise web.HTTPBadRequest(text="weight must be between 0 and 1")
+    await _run(request, _check_prompt, params["prompt"])
+
+    image = await _run(request, _open_image, params["image"])
+    return await _search_clip(request, params,
+                              lambda scheduler: scheduler.submit_fusion(params["prompt"], image, weight, topn))
+
+
+def _warm_up() -> None:
+    # load the model and map the local index before the first request instead of during it
+    service = get_search_service()
+    service.feature_index.ensure_loaded()
+    service.ocr_index.ensure_loaded()
+
+
+async def _on_startup(app: web.Application) -> None:
+    await asyncio.get_running_loop().run_in_executor(app[_EXECUTOR], _warm_up)
+
+
+async def _on_cleanup(app: web.Application) -> None:
+    app[_EXECUTOR].shutdown()
+
+
+def create_app(config: dict) -> web.Application:
+    """
+    Create the search server application.
+
+    Requests are handled concurrently: the handlers only parse and answer on the event loop, the
+    searches run on a pool of `server-workers` threads sharing one model and index per collection.
+    Text, image and fusion searches are micro-batched by the query scheduler.
+
+    Args:
+    - config (dict): Configuration dictionary.
+
+    Returns:
+    - web.Application: aiohttp application.
+    """
+    app = web.Application(client_max_size=config.get('server-max-upload', 20) * 2 ** 20)
+    app[_EXECUTOR] = ThreadPoolExecutor(config.get('server-workers', 4), thread_name_prefix="search")
+    app[_MAX_TOPN] = config.get('server-max-topn', 200)
+    app.router.add_post("/search/text", search_text)
+    app.router.add_post("/search/ocr", search_ocr)
+    app.router.add_post("/search/image", search_image)
+    app.router.add_post("/search/fusion", search_fusion)
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    config = utils.get_config()
+    # while there is no other thread, see OCRScorer.start
+    get_ocr_scorer().start()
+    web.run_app(create_app(config), host=config['server-host'], port=config['server-port'])
@@ -0,0 +1,88 @@
+import os
+from functools import lru_cache
+from typing import Optional
+
+from PIL import Image, ImageOps
+
+import utils
+
+
+class ThumbnailCache:
+    def __init__(self, config: dict):
+        """
+        Downscaled copies of the imported images, keyed by the MD5 hash of the file content and laid
+        out like the downloaded images (see utils.get_full_path), e.g. `{thumbnail-path}/jpg/ab/ab12....jpg`.
+
+        Thumbnails are written at import time, with their shorter side scaled down to `thumbnail-size`
+        pixels, so that galleries never decode the originals. Copies of an image share one thumbnail,
+        also across the local and remote collections.
+
+        Args:
+        - config (dict): Configuration dictionary.
+        """
+        self.base_dir = config.get('thumbnail-path', './mongo_sample/thumbnails')
+        self.size = config.get('thumbnail-size', 320)
+        self.format = config.get('thumbnail-format', 'jpg')
+        assert self.format in ("jpg", "webp"), "thumbnail-format must be jpg or webp"
+        self.quality = config.get('thumbnail-quality', 85)
+
+    def path_of(self, md5: str) -> str:
+        return utils.get_full_path(self.base_dir, f"{md5}.{self.format}")
+
+    def get(self, md5: Optional[str]) -> Optional[str]:
+        """
+        Look up the thumbnail of an image.
+
+        Args:
+        - md5 (str): MD5 hash of the image file, may be None for documents imported without one.
+
+        Returns:
+        - str: Path of the thumbnail, None if there is none.
+        """
+        if md5 is None:
+            return None
+        path = self.path_of(md5)
+        return path if os.path.exists(path) else None
+
+    def ensure(self, md5: str, image_path: str) -> Optional[str]:
+        """
+        Create the thumbnail of an image unless it exists.
+
+        Args:
+        - md5 (str): MD5 hash of the image file.
+        - image_path (str): Path to the image file.
+
+        Returns:
+        - str: Path of the thumbnail, None if the image cannot be read.
+        """
+        path = self.path_of(md5)
+        if os.path.exists(path):
+            return path
+        try:
+            with Image.open(image_path) as image:
+                # JPEG decodes at a fraction of the resolution directly
+                image.draft("RGB", (self.size, self.size))
+                image = ImageOps.exif_transpose(image)
+                image = image.convert("RGB")
+                scale = self.size / min(image.size)
+                if scale < 1:
+                    image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                                         Image.LANCZOS)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                utils.atomic_write(path, lambda f: image.save(
+                    f, format="JPEG" if self.format == "jpg" else "WEBP", quality=self.quality))
+        except Exception as e:
+            print(f"Error creating thumbnail of {image_path}: {e}")
+            return None
+        return path
+
+
+@lru_cache(maxsize=1)
+def get_thumbnail_cache() -> ThumbnailCache:
+    """
+    Get the shared thumbnail cache, using LRU cache.
+
+    Returns:
+    - ThumbnailCache: ThumbnailCache instance.
+    """
+    return ThumbnailCache(utils.get_config())
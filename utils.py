@@ -1,11 +1,16 @@
 import os
-import subprocess
 
 import yaml
 import hashlib
-from functools import lru_cache
+from datetime import datetime
+import numpy as np
+from collections import OrderedDict
+from functools import lru_cache, wraps
+from threading import Lock, get_ident
+from typing import BinaryIO, Callable, Hashable, Iterator, Optional, Tuple, TypeVar
 import pymongo
 from pymongo.collection import Collection
+from pymongo.errors import OperationFailure
 import clip
 
 
@@ -48,36 +53,81 @@ def get_feature_size(model_name: str) -> int:
         raise ValueError("Unknown model")
 
 
+_MAGIC_BYTES = [
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"II*\x00", "tiff"),
+    (b"MM\x00*", "tiff"),
+]
+# sizes of the known BMP info headers, which follow the 14-byte file header
+_BMP_INFO_HEADER_SIZES = {12, 40, 52, 56, 64, 108, 124}
+
+
 def get_file_type(image_path: str) -> str:
     """
-    Get the file type of an image using the 'file' command.
+    Get the file type of an image from the magic bytes at the start of the file.
 
     Args:
     - image_path (str): Path to the image file.
 
     Returns:
-    - str: File type (e.g., 'png', 'jpg', 'gif', 'bmp') or None if it cannot be determined.
+    - str: File type ('png', 'jpg', 'gif', 'bmp', 'webp' or 'tiff') or None if it cannot be determined.
     """
     try:
-        result = subprocess.run(["file", "--mime-type", "-b", image_path], capture_output=True, text=True,
-                                encoding='utf-8')
-        libmagic_output = result.stdout.strip()
-    except Exception as e:
-        print(f"Error executing file command: {e}")
+        with open(image_path, 'rb') as f:
+            header = f.read(18)
+    except OSError as e:
+        print(f"Error reading file: {e}")
         return None
 
-    if "png" in libmagic_output:
-        return "png"
-    if "jpeg" in libmagic_output:
-        return "jpg"
-    if "gif" in libmagic_output:
-        return "gif"
-    if "bmp" in libmagic_output:
+    for magic, filetype in _MAGIC_BYTES:
+        if header.startswith(magic):
+            return filetype
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    if header[:2] == b"BM" and len(header) == 18 \
+            and int.from_bytes(header[14:18], "little") in _BMP_INFO_HEADER_SIZES:
         return "bmp"
     return None
 
 
+T = TypeVar("T")
+
+
+def cache_per_collection(getter: Callable[[bool], T]) -> Callable[..., T]:
+    """
+    Cache a getter taking the `isRemote` flag, keeping one instance for the local and one for the remote
+    collection. lru_cache alone would key f(), f(False) and f(isRemote=False) apart and create one each.
+
+    Args:
+    - getter (Callable): Function of `isRemote` creating the instance.
+
+    Returns:
+    - Callable: Cached getter, `isRemote` defaults to False.
+    """
+    cached = lru_cache(maxsize=2)(getter)
+
+    @wraps(getter)
+    def get(isRemote=False) -> T:
+        return cached(bool(isRemote))
+    return get
+
+
 @lru_cache(maxsize=1)
+def get_mongo_client() -> pymongo.MongoClient:
+    """
+    Get the MongoDB client shared by all collections, using LRU cache.
+
+    Returns:
+    - pymongo.MongoClient: MongoDB client.
+    """
+    config = get_config()
+    return pymongo.MongoClient("mongodb://{}:{}/".format(config['mongodb-host'], config['mongodb-port']))
+
+
+@cache_per_collection
 def get_mongo_collection(isRemote=False) -> Collection:
     """
     Get MongoDB collection based on configuration settings.
@@ -86,17 +136,83 @@ def get_mongo_collection(isRemote=False) -> Collection:
     - Collection: MongoDB collection.
     """
     config = get_config()
-    mongo_client = pymongo.MongoClient("mongodb://{}:{}/".format(config['mongodb-host'], config['mongodb-port']))
     if isRemote:
-        mongo_collection = mongo_client[config['mongodb-database']][config['mongodb-collection-remote']]
+        mongo_collection = get_mongo_client()[config['mongodb-database']][config['mongodb-collection-remote']]
     else:
-        mongo_collection = mongo_client[config['mongodb-database']][config['mongodb-collection']]
+        mongo_collection = get_mongo_client()[config['mongodb-database']][config['mongodb-collection']]
+    create_indexes(mongo_collection)
     return mongo_collection
 
 
+@lru_cache(maxsize=1)
+def get_hash_collection() -> Collection:
+    """
+    Get the MongoDB collection mapping content hashes to image features and OCR text,
+    shared by the local and remote collections.
+
+    Returns:
+    - Collection: MongoDB collection.
+    """
+    config = get_config()
+    return get_mongo_client()[config['mongodb-database']][config.get('mongodb-collection-hash', 'image_hashes')]
+
+
+def create_indexes(mongo_collection: Collection) -> None:
+    """
+    Create the indexes of an image collection. Needs to be called again after the collection is dropped.
+
+    Args:
+    - mongo_collection (Collection): MongoDB collection.
+    """
+    # duplicate imports are rejected by the index instead of being checked with a query first
+    try:
+        mongo_collection.create_index("filename", unique=True)
+    except OperationFailure as e:
+        print(f"Cannot create unique filename index, remove duplicate documents first: {e}")
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Select the indices of the k highest scores in O(n) with a partial sort.
+
+    Args:
+    - scores (np.ndarray): 1-D array of scores.
+    - k (int): Number of indices to select.
+
+    Returns:
+    - np.ndarray: Indices of the k highest scores, highest first.
+    """
+    scores = np.asarray(scores)
+    n = len(scores)
+    k = min(k, n)
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k < n:
+        top_idx = np.argpartition(scores, n - k)[n - k:]
+    else:
+        top_idx = np.arange(n)
+    return top_idx[np.argsort(scores[top_idx])[::-1]]
+
+
+def format_mtime(mtime: float) -> str:
+    """
+    Format a file modification time the way it is stored in the `date` field of the image documents.
+
+    Args:
+    - mtime (float): Modification time as returned by os.stat.
+
+    Returns:
+    - str: Formatted date.
+    """
+    return datetime.fromtimestamp(mtime).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+_HASH_BUFFER_SIZE = 1 << 20
+
+
 def calc_md5(filepath: str) -> str:
     """
-    Calculate MD5 hash of a file.
+    Calculate MD5 hash of a file, streaming it through a reused 1 MiB buffer.
 
     Args:
     - filepath (str): Path to the file.
@@ -104,14 +220,54 @@ def calc_md5(filepath: str) -> str:
     Returns:
     - str: MD5 hash of the file.
     """
-    with open(filepath, 'rb') as f:
-        md5 = hashlib.md5()
+    md5 = hashlib.md5()
+    buffer = bytearray(_HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(filepath, 'rb', buffering=0) as f:
         while True:
-            data = f.read(4096)
-            if not data:
+            n = f.readinto(buffer)
+            if not n:
                 break
-            md5.update(data)
-        return md5.hexdigest()
+            md5.update(view[:n])
+    return md5.hexdigest()
+
+
+def atomic_write(path: str, writer: Callable[[BinaryIO], None]) -> None:
+    """
+    Write a file through a temporary file next to it, so that a crash never leaves a truncated file
+    behind and readers see either the old or the new file.
+
+    Args:
+    - path (str): Path of the file.
+    - writer (Callable): Called with the temporary file, opened for binary writing.
+    """
+    # one temporary file per process and thread, several may write the same file at once
+    tmp_path = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            writer(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_at(path: str, offset: int, data: bytes) -> None:
+    """
+    Overwrite the end of an existing file from an offset on, e.g. to append after the last complete record
+    and drop an incomplete one left by a crash.
+
+    Args:
+    - path (str): Path of the file.
+    - offset (int): Offset to write the data at, the file is cut off after it.
+    - data (bytes): Data to write.
+    """
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        f.write(data)
+        # only the writer trims the file, past anything a reader relies on
+        f.truncate()
 
 
 def get_full_path(basedir: str, basename: str) -> str:
@@ -126,4 +282,93 @@ def get_full_path(basedir: str, basename: str) -> str:
     - str: Full file path.
     """
     md5hash, ext = basename.split(".")
-    return "{}/{}/{}/{}".format(basedir, ext, md5hash[:2], basename)
\ No newline at end of file
+    return "{}/{}/{}/{}".format(basedir, ext, md5hash[:2], basename)
+
+
+class LRUCache:
+    def __init__(self, maxsize: int = 128, max_bytes: Optional[int] = None,
+                 size_of: Optional[Callable[[object], int]] = None):
+        """
+        Thread-safe bounded mapping that evicts the least recently used entry, counting hits and misses.
+
+        Args:
+        - maxsize (int): Maximum number of entries.
+        - max_bytes (int): Maximum total size of the values, unbounded if None. Values larger than this are not cached.
+        - size_of (Callable): Size in bytes of a value, `len` by default.
+        """
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.size_of = size_of or len
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+        self._data = OrderedDict()
+        self._sizes = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def __str__(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total > 0 else .0
+        size = f"{len(self)}/{self.maxsize} entries"
+        if self.max_bytes is not None:
+            size += f", {self.total_bytes / 2 ** 20:.1f}/{self.max_bytes / 2 ** 20:.1f} MiB"
+        return f"{size}, {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate)"
+
+    def get(self, key: Hashable, default=None):
+        """
+        Look up an entry and mark it as recently used.
+
+        Args:
+        - key (Hashable): Key of the entry.
+        - default: Value returned on a miss.
+
+        Returns:
+        - The cached value, or `default` if the key is not cached.
+        """
+        with self.lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key: Hashable, value) -> None:
+        """
+        Insert or replace an entry, evicting the least recently used ones beyond `maxsize` or `max_bytes`.
+
+        Args:
+        - key (Hashable): Key of the entry.
+        - value: Value to cache.
+        """
+        size = self.size_of(value) if self.max_bytes is not None else 0
+        with self.lock:
+            self._pop(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._data[key] = value
+            self._sizes[key] = size
+            self.total_bytes += size
+            while len(self._data) > self.maxsize or (self.max_bytes is not None and self.total_bytes > self.max_bytes):
+                self._pop(next(iter(self._data)))
+
+    def items(self) -> Iterator[Tuple[Hashable, object]]:
+        """
+        Snapshot of the entries, least recently used first. Does not count as use.
+        """
+        with self.lock:
+            return iter(list(self._data.items()))
+
+    def clear(self) -> None:
+        with self.lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.total_bytes = 0
+
+    def _pop(self, key: Hashable) -> None:
+        if key in self._data:
+            del self._data[key]
+            self.total_bytes -= self._sizes.pop(key)